@@ -0,0 +1,318 @@
+"""
+Load benchmarks for TestPoint.
+
+Builds the application through testpoint.create_app against a throwaway embedded SQLite database and a local SMTP
+sink, runs scripted load profiles with Flask test clients and reports throughput, latency percentiles and SQL
+statements per request. Compares the SQL statements per request and the failed requests with a baseline and exits
+with status 1 if a profile regressed. Throughput and latency depend on the machine and are reported for information.
+
+Usage from the repository root:
+    python -m benchmarks.run [--profile NAME] [--requests N] [--concurrency N] [--update-baseline]
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+from urllib.parse import urlsplit
+from .smtp_sink import SMTPSink
+
+BASELINE = Path(__file__).with_name('baseline.json')
+TRAY_SIZE = 96
+
+BENCHMARK_CONFIG = """
+[DATABASE]
+BACKEND = sqlite
+PATH = {database_path}
+
+[EMAIL]
+USER = benchmark@testpoint.local
+PW = benchmark
+SERVER = 127.0.0.1
+PORT = {smtp_port}
+SECURITY = none
+
+[LOGIN]
+THROTTLE_PATH = {throttle_path}
+
+[SLOTS]
+LANES = 4
+CAPACITY = 1000
+
+[WEBSITE]
+URL = http://testpoint.local
+PORT = 5000
+"""
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed by the current thread.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    def count(self, *args) -> None:
+        """
+        Engine event listener counting one statement.
+        :return: None.
+        """
+        self._local.statements = getattr(self._local, 'statements', 0) + 1
+
+    def reset(self) -> None:
+        """
+        Starts counting from zero for the current thread.
+        :return: None.
+        """
+        self._local.statements = 0
+
+    @property
+    def statements(self) -> int:
+        """
+        Statements counted for the current thread since the last reset.
+        :return: Number of statements.
+        """
+        return getattr(self._local, 'statements', 0)
+
+
+def booking_form(number: int) -> dict:
+    """
+    Returns the booking form of a distinct person for a slot spread over the booking window.
+    :param number: Running number of the booking.
+    :return: Form data as dictionary.
+    """
+    day = dt.date.today() + dt.timedelta(days=1 + number % 13)
+    return {'appointment_day': day.isoformat(),
+            'appointment_time': f"{8 + number % 14}:{15 * (number % 4):02d}",
+            'first_name': 'Bench', 'last_name': 'Mark',
+            'email1': f'booking{number}@testpoint.local', 'email2': f'booking{number}@testpoint.local',
+            'tel': '+49 228 12345678', 'birthdate': '1990-01-01', 'gender': 'd',
+            'street': 'Muensterplatz', 'number': '1', 'post_code': '53111', 'city': 'Bonn', 'country': 'Germany',
+            'passport': ''}
+
+
+def seed_appointments(db, models, new_public_id: Callable, count: int, prefix: str, verified: str,
+                      with_result: bool) -> list:
+    """
+    Inserts persons with one appointment each, optionally with results.
+    :param db: Database handle of the application.
+    :param models: testpoint.models module.
+    :param new_public_id: Function generating appointment and result IDs.
+    :param count: Number of persons and appointments.
+    :param prefix: Prefix making email addresses unique.
+    :param verified: Verified flag of the appointments.
+    :param with_result: True to add a result for every appointment.
+    :return: List of tuples with appointment internal ID, appointment ID and email address.
+    """
+    day = dt.date.today() + dt.timedelta(days=1)
+    seeded = []
+    for number in range(count):
+        person = models.Person(first_name='Bench', last_name='Mark', email=f'{prefix}{number}@testpoint.local',
+                               birthdate=dt.date(1990, 1, 1), post_code='53111')
+        db.session.add(person)
+        db.session.flush()
+        appointment = models.Appointment(appointment_id=new_public_id(), person_id=person.person_id,
+                                         appointment_day=day, appointment_time=dt.time(8 + number % 14),
+                                         verified=verified)
+        db.session.add(appointment)
+        db.session.flush()
+        if with_result:
+            db.session.add(models.Result(result_id=new_public_id(), appointment_key=appointment.id,
+                                         person_id=person.person_id, result='NEGATIVE', test_day=day,
+                                         test_time=dt.time(8 + number % 14)))
+        seeded.append((appointment.id, appointment.appointment_id, person.email))
+    db.session.commit()
+    return seeded
+
+
+def is_error(response, expected: int) -> bool:
+    """
+    Checks whether a response failed, including redirects to the login page of requests that were not logged in.
+    :param response: Response of the test client.
+    :param expected: Status code of a successful response.
+    :return: True if the response failed.
+    """
+    return response.status_code != expected or urlsplit(response.location or '').path == '/login/'
+
+
+def run_profile(app, counter: QueryCounter, requests: int, concurrency: int,
+                prepare: Callable, send: Callable, expected: int) -> dict:
+    """
+    Sends the given number of requests from several threads, each with its own test client, and measures them.
+    :param app: Flask application.
+    :param counter: Query counter attached to the database engine.
+    :param requests: Number of requests.
+    :param concurrency: Number of threads sending requests.
+    :param prepare: Function called with a fresh test client before a thread sends its first request.
+    :param send: Function called with test client and request number sending one request, returns the response.
+    :param expected: Status code of a successful request, all other responses count as errors.
+    :return: Statistics as dictionary.
+    """
+    local = threading.local()
+    latencies = []
+    statements = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(number: int) -> None:
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            prepare(local.client)
+        counter.reset()
+        start = time.perf_counter()
+        response = send(local.client, number)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statements.append(counter.statements)
+            if is_error(response=response, expected=expected):
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(share: float) -> float:
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))] * 1000
+
+    return {'requests': requests,
+            'errors': len(errors),
+            'throughput': round(requests / duration, 2),
+            'p50_ms': round(percentile(0.50), 2),
+            'p95_ms': round(percentile(0.95), 2),
+            'p99_ms': round(percentile(0.99), 2),
+            'queries_per_request': round(sum(statements) / len(statements), 2)}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compares benchmark results with the baseline. Only figures that do not depend on the machine are compared: failed
+    requests and SQL statements per request.
+    :param results: Statistics per profile.
+    :param baseline: Baseline statistics per profile.
+    :param tolerance: Allowed relative increase of the queries per request.
+    :return: List of regressions as strings, empty if there are none.
+    """
+    regressions = []
+    for profile, stats in results.items():
+        if stats['errors']:
+            regressions.append(f"{profile}: {stats['errors']} requests failed")
+        reference = baseline.get(profile)
+        if not reference:
+            continue
+        if stats['queries_per_request'] > reference['queries_per_request'] * (1 + tolerance):
+            regressions.append(f"{profile}: {stats['queries_per_request']} queries per request > baseline "
+                               f"{reference['queries_per_request']}")
+    return regressions
+
+
+def main() -> int:
+    """
+    Runs the selected profiles and compares them with the baseline or updates it.
+    :return: Exit status, 1 if a profile regressed or requests failed, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Run the TestPoint load benchmarks.')
+    parser.add_argument('--profile', action='append', choices=['booking_storm', 'result_lookup', 'bulk_results'],
+                        help='profile to run, may be given several times (default: all)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per profile')
+    parser.add_argument('--concurrency', type=int, default=4, help='threads sending requests')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative increase of queries per request')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as new baseline')
+    args = parser.parse_args()
+    profiles = args.profile or ['booking_storm', 'result_lookup', 'bulk_results']
+
+    sink = SMTPSink()
+    sink.start()
+    workdir = tempfile.mkdtemp(prefix='testpoint-benchmark-')
+    config_path = os.path.join(workdir, 'config.ini')
+    with open(config_path, 'w') as config_file:
+        config_file.write(BENCHMARK_CONFIG.format(database_path=os.path.join(workdir, 'benchmark.db'),
+                                                  throttle_path=os.path.join(workdir, 'login-throttle.db'),
+                                                  smtp_port=sink.server_address[1]))
+    os.environ['TESTPOINT_CONFIG'] = config_path
+
+    from sqlalchemy import event
+    from werkzeug.security import generate_password_hash
+    from testpoint import create_app, models
+    from testpoint.notification import send_queued_mails
+    from testpoint.slots import ensure_slots
+    from testpoint.storage import db
+    from testpoint.storagehandler import new_public_id
+
+    app = create_app({'TESTING': True})
+    counter = QueryCounter()
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', counter.count)
+        db.session.add(models.Staff(email='staff@testpoint.local', admin='N'))
+        db.session.add(models.User(username='staff@testpoint.local', password=generate_password_hash('benchmark')))
+        db.session.commit()
+        lookups = seed_appointments(db, models, new_public_id, count=args.requests, prefix='lookup', verified='Y',
+                                    with_result=True) if 'result_lookup' in profiles else []
+        trays = seed_appointments(db, models, new_public_id, count=args.requests * TRAY_SIZE, prefix='tray',
+                                  verified='Y', with_result=False) if 'bulk_results' in profiles else []
+        if 'booking_storm' in profiles:
+            # Creating the slots up front keeps the statements per booking independent of the number of requests.
+            ensure_slots(days=sorted({dt.date.fromisoformat(booking_form(number=number)['appointment_day'])
+                                      for number in range(args.requests)}))
+
+    def no_preparation(client) -> None:
+        return None
+
+    def login(client) -> None:
+        client.post('/login/', data={'username': 'staff@testpoint.local', 'password': 'benchmark'})
+
+    def book(client, number: int):
+        return client.post('/appointment/', data=booking_form(number=number))
+
+    def look_up(client, number: int):
+        _, appointment_id, email = lookups[number]
+        return client.post(f'/results/{appointment_id}/', data={'birthdate': '1990-01-01', 'email_address': email})
+
+    def enter_tray(client, number: int):
+        tray = trays[number * TRAY_SIZE:(number + 1) * TRAY_SIZE]
+        form = {f'result_{key}': 'NEGATIVE' for key, _, _ in tray}
+        form['bulk'] = 'Y'
+        return client.post('/staff/', data=form)
+
+    scenarios = {'booking_storm': (no_preparation, book, 302),
+                 'result_lookup': (no_preparation, look_up, 200),
+                 'bulk_results': (login, enter_tray, 200)}
+    results = {}
+    for profile in profiles:
+        prepare, send, expected = scenarios[profile]
+        results[profile] = run_profile(app, counter, requests=args.requests, concurrency=args.concurrency,
+                                       prepare=prepare, send=send, expected=expected)
+        print(f"{profile}: {json.dumps(results[profile])}")
+    with app.app_context():
+        while sum(send_queued_mails(batch_size=100)):
+            pass
+    print(f"SMTP sink received {sink.messages} messages")
+    sink.shutdown()
+
+    if args.update_baseline:
+        baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+        baseline.update({profile: {'queries_per_request': stats['queries_per_request']}
+                         for profile, stats in results.items()})
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+        print(f"Updated {BASELINE}")
+        return 0
+
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    regressions = compare(results=results, baseline=baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import socketserver
+import threading
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough plain SMTP for smtplib to log in and deliver messages, which are counted and dropped.
+    """
+
+    def reply(self, line: str) -> None:
+        """
+        Sends one reply line to the client.
+        :param line: Reply including status code as string.
+        :return: None.
+        """
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        """
+        Answers the commands of one SMTP session.
+        :return: None.
+        """
+        self.reply("220 localhost TestPoint SMTP sink")
+        for raw in self.rfile:
+            command = raw.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif verb == 'AUTH':
+                self.reply("235 Authentication successful")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for data in self.rfile:
+                    if data in (b".\r\n", b".\n"):
+                        break
+                self.server.count_message()
+                self.reply("250 OK")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the mail server used by the benchmarks.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        """
+        :param host: Address to listen on.
+        :param port: Port to listen on, 0 picks a free port.
+        """
+        super().__init__((host, port), SMTPSinkHandler)
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def count_message(self) -> None:
+        """
+        Counts a delivered message.
+        :return: None.
+        """
+        with self._lock:
+            self.messages += 1
+
+    def start(self) -> None:
+        """
+        Serves connections in a background thread.
+        :return: None.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -1,29 +1,73 @@
 from datetime import timedelta
 from secrets import token_urlsafe
+from typing import Optional
 from flask import Flask
-from .storage import db
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .storage import db, get_database_uri, get_engine_options, get_replica_binds
 from .loginManager import login_manager
 from .views import views
 from .auth import auth
 from .routes import routes
-from .config import DB_USER, DB_PW, DB_ADDRESS, DB_PORT, DB_NAME
+from .health import health
+from .metrics import init_metrics
+from .replicas import init_replicas
+from .events import queue_events
+from .sessions import init_sessions
+from .throttle import login_throttle
+from .commands import init_db_command, migrate_command, check_plans_command, import_bookings_command, \
+    send_mail_command, mail_worker_command, export_results_command, rebuild_stats_command, purge_expired_command, \
+    sweep_sessions_command
+from .migrations import upgrade_schema
+from .config import DB_BACKEND, SESSION_SECRET_KEY, SESSION_OLD_SECRET_KEYS, SESSION_LIFETIME, LOGIN_PROXIES
 
 
-def create_app() -> Flask:
+def create_app(overrides: Optional[dict] = None) -> Flask:
     """
     Creates a Flask application setting, its secret and linking it with the database.
+    :param overrides: Flask settings that replace the settings from config.ini, e.g. another database for
+    benchmarks, or None.
     :return: Flask application.
     """
     app = Flask(__name__)
-    app.config['SECRET_KEY'] = token_urlsafe(nbytes=256)
+    if LOGIN_PROXIES:
+        # The login throttle counts attempts per client, not per proxy.
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=LOGIN_PROXIES)
+    # Without a configured key, every process signs with its own key, so sessions only work with a single process.
+    app.config['SECRET_KEY'] = SESSION_SECRET_KEY or token_urlsafe(nbytes=256)
+    app.config['SECRET_KEY_FALLBACKS'] = SESSION_OLD_SECRET_KEYS
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{DB_USER}:{DB_PW}@{DB_ADDRESS}:{DB_PORT}/{DB_NAME}'
-    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options()
+    app.config['SQLALCHEMY_BINDS'] = get_replica_binds()
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=SESSION_LIFETIME)
+    app.config.update(overrides or {})
     db.init_app(app=app)
     login_manager.init_app(app=app)
 
+    if DB_BACKEND == 'sqlite':
+        with app.app_context():
+            upgrade_schema()
+            db.engine.dispose()
+
     app.register_blueprint(views,  url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
     app.register_blueprint(routes, url_prefix='/')
+    app.register_blueprint(health, url_prefix='/')
+    init_metrics(app=app)
+    init_replicas(app=app)
+    queue_events.init_app(app=app)
+    init_sessions(app=app)
+    login_throttle.init_app(app=app)
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_plans_command)
+    app.cli.add_command(import_bookings_command)
+    app.cli.add_command(send_mail_command)
+    app.cli.add_command(mail_worker_command)
+    app.cli.add_command(export_results_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(purge_expired_command)
+    app.cli.add_command(sweep_sessions_command)
 
     return app
@@ -0,0 +1,114 @@
+import asyncio
+import re
+import time
+from typing import Optional
+from a2wsgi import WSGIMiddleware
+from flask import Flask
+from quart import Quart, g, request
+from quart.sessions import SessionInterface
+from . import create_app
+from .asyncstorage import async_db
+from .asyncviews import async_views
+from .metrics import REQUEST_SECONDS
+from .sessions import ServerSideSession, ServerSideSessionInterface, ServerSideSessions, save_session_cookie, \
+    session_signer
+
+ASYNC_PATHS = re.compile(r'/appointment/|/results/[^/]+/|/staff/events')
+SHARED_SETTINGS = ('SECRET_KEY', 'SECRET_KEY_FALLBACKS', 'PERMANENT_SESSION_LIFETIME', 'SESSION_COOKIE_NAME',
+                   'SESSION_COOKIE_DOMAIN', 'SESSION_COOKIE_PATH', 'SESSION_COOKIE_HTTPONLY', 'SESSION_COOKIE_SECURE',
+                   'SESSION_COOKIE_SAMESITE')
+
+
+class AsyncServerSideSessionInterface(SessionInterface):
+    """
+    Quart session interface reading and writing the same server-side sessions as the Flask application. The store is
+    accessed in a worker thread, so the event loop keeps serving other requests meanwhile.
+    """
+
+    def __init__(self, sessions: ServerSideSessions) -> None:
+        """
+        :param sessions: Server-side sessions of the Flask application.
+        """
+        self.sessions = sessions
+
+    async def open_session(self, app: Quart, request) -> Optional[ServerSideSession]:
+        return await asyncio.to_thread(self.sessions.open, signer=session_signer(app=app),
+                                       cookie=request.cookies.get(self.get_cookie_name(app)))
+
+    async def save_session(self, app: Quart, session: ServerSideSession, response) -> None:
+        if response is None:
+            # Websockets cannot set cookies.
+            return
+        value = await asyncio.to_thread(self.sessions.persist, signer=session_signer(app=app), session=session,
+                                        lifetime=app.permanent_session_lifetime)
+        save_session_cookie(interface=self, app=app, session=session, response=response, value=value)
+
+
+async def start_request_timer() -> None:
+    """
+    Starts measuring the time of the current request.
+    :return: None.
+    """
+    g.request_start = time.perf_counter()
+
+
+async def observe_request(response):
+    """
+    Records the latency of the finished request like metrics.observe_request.
+    :param response: Response of the request.
+    :return: Unchanged response.
+    """
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(endpoint=request.endpoint or 'unknown', method=request.method,
+                               status=response.status_code).observe(time.perf_counter() - g.request_start)
+    return response
+
+
+async def close_connections() -> None:
+    """
+    Closes the database connections of the worker process when the server shuts down.
+    :return: None.
+    """
+    await async_db.dispose()
+
+
+def create_async_app(flask_app: Flask) -> Quart:
+    """
+    Creates the Quart application serving the async views. It renders the same templates and shares the sessions
+    with the given Flask application, so flash messages and logins work across both.
+    :param flask_app: Flask application as created by create_app.
+    :return: Quart application.
+    """
+    app = Quart(__name__)
+    app.config.update({setting: flask_app.config[setting] for setting in SHARED_SETTINGS
+                       if setting in flask_app.config})
+    if isinstance(flask_app.session_interface, ServerSideSessionInterface):
+        app.session_interface = AsyncServerSideSessionInterface(sessions=flask_app.session_interface.sessions)
+    app.register_blueprint(async_views, url_prefix='/')
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    app.before_serving(async_db.init)
+    app.after_serving(close_connections)
+    return app
+
+
+def create_asgi_app(overrides: Optional[dict] = None):
+    """
+    Creates the ASGI application: the public booking and results pages are served by the async views, so a single
+    worker keeps many bookings in flight while waiting for the database and the mail server. The event streams of
+    the staff panels are served there as well, so open panels do not hold a thread each. All other pages are served
+    by the Flask application in a thread pool.
+    :param overrides: Flask settings that replace the settings from config.ini, or None.
+    :return: ASGI application.
+    """
+    flask_app = create_app(overrides=overrides)
+    async_app = create_async_app(flask_app=flask_app)
+    wsgi_app = WSGIMiddleware(flask_app)
+
+    async def app(scope, receive, send) -> None:
+        if scope['type'] == 'lifespan' or ASYNC_PATHS.fullmatch(scope.get('path', '')):
+            await async_app(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
+
+    return app
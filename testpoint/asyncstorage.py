@@ -0,0 +1,250 @@
+import asyncio
+import datetime as dt
+from contextlib import nullcontext
+from typing import AsyncContextManager, Optional
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from .config import DB_BACKEND, SLOTS_LANES
+from .models import Appointment, MailQueue, Person, QueueEvent, Result, Slot, Staff, User
+from .slots import availability_index, available_slots_query, booking_window, format_available_slots, \
+    group_available_slots, missing_slots, reserve_lane_statement
+from .stats import count_stats_statement, stats_rows
+from .storage import get_async_database_uri, get_async_engine_options, sqlite_pragmas
+from .storagehandler import booked_appointment_query, booking_confirmation_mail, new_public_id, person_values, \
+    seconds_from_now, upsert_person_statement, upserted_person_id
+from .validation import parse_date, parse_time
+
+
+class AsyncDatabase:
+    """
+    Async engine and session factory of a worker process. Both are created when the ASGI server starts serving, so
+    every worker process opens its own connections on its own event loop.
+    """
+
+    def __init__(self) -> None:
+        self.engine: Optional[AsyncEngine] = None
+        self.sessions: Optional[async_sessionmaker] = None
+        self.write_lock: Optional[asyncio.Lock] = None
+
+    def init(self) -> None:
+        """
+        Creates the engine with the async driver of the configured backend and the same pool settings as the WSGI
+        application.
+        :return: None.
+        """
+        self.engine = create_async_engine(get_async_database_uri(), **get_async_engine_options())
+        if DB_BACKEND == 'sqlite':
+            event.listen(self.engine.sync_engine, 'connect', configure_async_sqlite)
+            self.write_lock = asyncio.Lock()
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def dispose(self) -> None:
+        """
+        Closes all pooled connections.
+        :return: None.
+        """
+        if self.engine is not None:
+            await self.engine.dispose()
+
+    def session(self) -> AsyncSession:
+        """
+        Returns a new session, to be used as async context manager.
+        :return: Async session.
+        """
+        return self.sessions()
+
+    def writing(self) -> AsyncContextManager:
+        """
+        Returns the context manager to wrap write transactions in. SQLite only allows one writer at a time and a
+        writer holds the lock while its coroutine waits for the event loop between statements, so concurrent writers
+        of a process queue on an asyncio lock instead of polling in SQLite's busy handler until they time out.
+        :return: Async context manager.
+        """
+        return self.write_lock or nullcontext()
+
+
+async_db = AsyncDatabase()
+availability_lock = asyncio.Lock()
+
+
+def configure_async_sqlite(dbapi_connection, connection_record) -> None:
+    """
+    Tunes every new aiosqlite connection with the same PRAGMAs as the connections of the WSGI application.
+    :param dbapi_connection: New DBAPI connection.
+    :param connection_record: Pool record of the connection.
+    :return: None.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas():
+        cursor.execute(pragma)
+    cursor.close()
+
+
+async def ensure_slots(session: AsyncSession, days: list[dt.date]) -> None:
+    """
+    Creates the slot inventory for all lanes of the given days unless it exists already.
+    :param session: Async session.
+    :param days: Days to create the slot inventory for.
+    :return: None.
+    """
+    existing = set((await session.execute(select(Slot.slot_day).where(Slot.slot_day.in_(days)).distinct()))
+                   .scalars())
+    missing = missing_slots(days=days, existing=existing)
+    if not missing:
+        return
+    try:
+        await session.execute(insert(Slot.__table__), missing)
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+
+
+async def reserve_slot(session: AsyncSession, appointment_day: str, appointment_time: str) -> Optional[int]:
+    """
+    Reserves one place in the given slot on the first lane that still has room, see slots.reserve_slot. Does not
+    commit.
+    :param session: Async session.
+    :param appointment_day: Date of the appointment as string (YYYY-MM-DD).
+    :param appointment_time: Time of the appointment as string (HH:MM).
+    :return: Lane the place was reserved on or None if the slot is fully booked or does not exist.
+    """
+    slot_day = parse_date(appointment_day)
+    slot_time = parse_time(appointment_time)
+    lane = await reserve_lane(session=session, slot_day=slot_day, slot_time=slot_time)
+    if lane is None and slot_day in booking_window(today=dt.date.today()) and \
+            (await session.execute(select(Slot.id).where(Slot.slot_day == slot_day).limit(1))).first() is None:
+        await ensure_slots(session=session, days=[slot_day])
+        lane = await reserve_lane(session=session, slot_day=slot_day, slot_time=slot_time)
+    if lane is not None:
+        availability_index.invalidate()
+    return lane
+
+
+async def reserve_lane(session: AsyncSession, slot_day: dt.date, slot_time: dt.time) -> Optional[int]:
+    """
+    Reserves one place in the given slot on the first lane with room using a conditional update per lane.
+    :param session: Async session.
+    :param slot_day: Date of the slot.
+    :param slot_time: Time of the slot.
+    :return: Lane the place was reserved on or None if no lane has room.
+    """
+    for lane in range(1, SLOTS_LANES + 1):
+        if (await session.execute(reserve_lane_statement(slot_day=slot_day, slot_time=slot_time, lane=lane))).rowcount:
+            return lane
+    return None
+
+
+async def get_available_slots(now: Optional[dt.datetime] = None) -> dict[str, list[str]]:
+    """
+    Returns the bookable slots of the booking window that still have room and are not in the past. Uses the same
+    per-process availability index as the WSGI application and rebuilds it with one query when it is outdated.
+    :param now: Current date and time, defaults to now.
+    :return: Dictionary mapping each day (YYYY-MM-DD) to a list of bookable slot times (H:MM) as used by the form.
+    """
+    now = now or dt.datetime.now()
+    today = now.date()
+    available = availability_index.cached(today=today)
+    if available is None:
+        async with availability_lock:
+            available = availability_index.cached(today=today)
+            if available is None:
+                days = booking_window(today=today)
+                async with async_db.writing(), async_db.session() as session:
+                    await ensure_slots(session=session, days=days)
+                    rows = (await session.execute(available_slots_query(days=days))).all()
+                available = group_available_slots(days=days, rows=rows)
+                availability_index.store(today=today, available=available)
+    return format_available_slots(available=available, now=now)
+
+
+async def book_appointment(person: dict) -> Optional[str]:
+    """
+    Books an appointment and queues its confirmation in a single transaction like storagehandler.book_appointment.
+    :param person: Person and appointment details as a dictionary as sent by the booking form.
+    :return: Appointment ID of the new appointment or None if the person already booked this slot.
+    """
+    async with async_db.writing(), async_db.session() as session:
+        dialect = session.bind.dialect.name
+        if await reserve_slot(session=session, appointment_day=person['appointment_day'],
+                              appointment_time=person['appointment_time']) is None:
+            await session.rollback()
+            if (await session.execute(booked_appointment_query(person=person))).first() is not None:
+                return None
+            raise RuntimeError("The selected appointment slot is fully booked. Please choose another slot.")
+        statement = upsert_person_statement(values=person_values(person=person), dialect=dialect)
+        person_id = upserted_person_id(result=await session.execute(statement), dialect=dialect)
+        appointment_id = new_public_id()
+        try:
+            await session.execute(insert(Appointment.__table__).values(appointment_id=appointment_id,
+                                                                       person_id=person_id,
+                                                                       appointment_day=person['appointment_day'],
+                                                                       appointment_time=person['appointment_time']))
+            await session.execute(count_stats_statement(dialect=dialect),
+                                  stats_rows(counts={(person['appointment_day'], person['appointment_time']):
+                                                     {'bookings': 1}}))
+            await session.execute(insert(MailQueue.__table__)
+                                  .values(**booking_confirmation_mail(person=person, appointment_id=appointment_id)))
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return None
+    return appointment_id
+
+
+async def get_appointment(appointment_id: str) -> Optional[Appointment]:
+    """
+    Returns the Appointment object for the given appointment ID.
+    :param appointment_id: Appointment ID as string.
+    :return: Appointment object or None.
+    """
+    async with async_db.session() as session:
+        return (await session.execute(select(Appointment).where(Appointment.appointment_id == appointment_id))) \
+            .scalars().first()
+
+
+async def get_person_by_email(email: str) -> Optional[Person]:
+    """
+    Returns the person with the given email address.
+    :param email: Email address as string.
+    :return: Person object or None.
+    """
+    async with async_db.session() as session:
+        return (await session.execute(select(Person).where(Person.email == email))).scalars().first()
+
+
+async def get_result_by_app_id(appointment_id: str) -> Optional[Result]:
+    """
+    Return Result object for given appointment ID.
+    :param appointment_id: Appointment ID as string.
+    :return: Result object or None if no such object exists.
+    """
+    async with async_db.session() as session:
+        return (await session.execute(select(Result)
+                                      .join(Appointment, Appointment.id == Result.appointment_key)
+                                      .where(Appointment.appointment_id == appointment_id))).scalars().first()
+
+
+async def get_identity(user_id: str) -> Optional[tuple[int, str, bool]]:
+    """
+    Returns ID, username and admin flag of a user like storagehandler.get_identity.
+    :param user_id: User ID as string.
+    :return: Tuple of user ID, username and True if the user is an admin or None if the user does not exist.
+    """
+    async with async_db.session() as session:
+        row = (await session.execute(select(User.id, User.username, Staff.admin)
+                                     .join(Staff, Staff.email == User.username, isouter=True)
+                                     .where(User.id == user_id))).first()
+    return (row[0], row[1], row[2] == 'Y') if row else None
+
+
+async def get_last_queue_event_id(grace: int) -> int:
+    """
+    Async version of storagehandler.get_last_queue_event_id.
+    :param grace: Seconds after which the transaction of an event is assumed to be committed.
+    :return: Event ID, 0 if the queue never changed.
+    """
+    async with async_db.session() as session:
+        return (await session.execute(select(QueueEvent.id)
+                                      .where(QueueEvent.created_at <= seconds_from_now(seconds=-grace))
+                                      .order_by(QueueEvent.id.desc()).limit(1))).scalar() or 0
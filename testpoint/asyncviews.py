@@ -0,0 +1,174 @@
+import datetime as dt
+from typing import Awaitable, Callable, NamedTuple, Optional
+from quart import Blueprint, Response, render_template, request, flash, redirect, make_response, session
+from .asyncstorage import book_appointment, get_appointment, get_available_slots, get_person_by_email, \
+    get_result_by_app_id, get_identity, get_last_queue_event_id
+from .config import SLOTS_BOOKING_DAYS
+from .events import EVENTS_GRACE_SECONDS, MAX_CATCH_UP, PANELS, AsyncSubscriber, queue_events, subscriber_from_args
+from .metrics import BOOKINGS
+from .pagecache import APPOINTMENT_MAX_AGE, page_etag, page_is_cacheable, rendered_pages, set_cache_headers
+from .slots import SLOT_TIMES
+from .validation import validate, birthdate_is_valid, email_is_valid, public_id_is_valid
+
+async_views = Blueprint('async_views', __name__)
+
+
+class SessionUser(NamedTuple):
+    is_authenticated: bool
+
+
+@async_views.app_context_processor
+async def inject_user() -> dict:
+    """
+    Provides current_user to the shared templates. Staff log in through the WSGI application, so a user counts as
+    authenticated if the shared session cookie carries a Flask-Login user ID.
+    :return: Template context.
+    """
+    return {'current_user': SessionUser(is_authenticated='_user_id' in session)}
+
+
+async def cached_page(etag: str, render: Callable[[], Awaitable[str]], max_age: int) -> Response:
+    """
+    Async version of views.cached_page.
+    :param etag: Entity tag of the page, see pagecache.page_etag.
+    :param render: Coroutine function rendering the page.
+    :param max_age: Seconds browsers and proxies may reuse the page without asking again.
+    :return: Response.
+    """
+    body, last_modified = rendered_pages.get(etag=etag) or rendered_pages.put(etag=etag, body=await render())
+    response = await make_response(body)
+    set_cache_headers(response=response, etag=etag, last_modified=last_modified, max_age=max_age)
+    return await response.make_conditional(request)
+
+
+async def render_appointment_page(user_input: Optional[dict] = None, availability: Optional[dict] = None) -> str:
+    """
+    Renders the appointment booking page offering only slots that still have room.
+    :param user_input: Form data to fill the form with again or None for an empty form.
+    :param availability: Bookable slots as returned by get_available_slots or None to get them.
+    :return: String of HTML template for appointment booking page.
+    """
+    if availability is None:
+        availability = await get_available_slots()
+    offered = {slot_time for slot_times in availability.values() for slot_time in slot_times}
+    return await render_template('appointment.html',
+                                 user_input=user_input,
+                                 slots=[slot for slot in SLOT_TIMES if f"{slot.hour}:{slot.minute:02d}" in offered],
+                                 availability=availability,
+                                 today=dt.date.today(),
+                                 max_days=dt.date.today() + dt.timedelta(days=SLOTS_BOOKING_DAYS))
+
+
+@async_views.route('/appointment/', methods=['GET', 'POST'])
+async def appointment() -> any:
+    """
+    Async version of views.appointment.
+    :return: String of HTML template for appointment booking page or homepage if booking was successful.
+    """
+    if request.method == 'POST':
+        user_input = (await request.form).to_dict()
+        errors = validate(record=user_input)
+        if errors:
+            BOOKINGS.labels(outcome='invalid').inc()
+            for message in dict.fromkeys(errors.values()):
+                await flash(message, category='error')
+            return await render_appointment_page(user_input=user_input)
+
+        try:
+            appointment_id = await book_appointment(person=user_input)
+        except RuntimeError as e:
+            BOOKINGS.labels(outcome='full').inc()
+            await flash(f"{e}", category='error')
+            return await render_appointment_page(user_input=user_input)
+        BOOKINGS.labels(outcome='booked' if appointment_id else 'duplicate').inc()
+        if appointment_id:
+            await flash('Appointment booked successfully! The booking confirmation will arrive in your inbox '
+                        'shortly.', category='success')
+        else:
+            await flash('Appointment is already booked! Please check your inbox for the booking confirmation.',
+                        category='error')
+        return redirect('/')
+
+    availability = await get_available_slots()
+    if not page_is_cacheable(authenticated='_user_id' in session, session=session):
+        return await render_appointment_page(availability=availability)
+    return await cached_page(etag=page_etag('appointment.html', dt.date.today().isoformat(), availability),
+                             render=lambda: render_appointment_page(availability=availability),
+                             max_age=APPOINTMENT_MAX_AGE)
+
+
+@async_views.route('/results/<app_id>/', methods=['GET', 'POST'])
+async def results(app_id: str) -> str:
+    """
+    Async version of views.results.
+    :param app_id: Appointment ID to get the corresponding result of.
+    :return: HTML templates for entering credentials,
+    """
+    if not public_id_is_valid(app_id) or not await get_appointment(appointment_id=app_id):
+        return await render_template('sorry.html')
+
+    if request.method == 'POST':
+        form = await request.form
+        birthdate = form.get('birthdate')
+        email = form.get('email_address')
+
+        if not birthdate_is_valid(birthdate) or not email_is_valid(email):
+            await flash(f'No match for {birthdate} and {email}. Please check your inputs.', category='error')
+            return await render_template('results.html')
+
+        person = await get_person_by_email(email=email)
+        if not person:
+            await flash(f'User {email} not found. Please check your inputs.', category='error')
+            return await render_template('results.html')
+
+        if not person.email == email or not person.birthdate.strftime("%Y-%m-%d") == birthdate:
+            await flash('Email or birthdate is incorrect. Please try again.', category='error')
+            return await render_template('results.html')
+
+        test_result = await get_result_by_app_id(appointment_id=app_id)
+        if not test_result:
+            await flash('No result available yet. Please wait.', category='error')
+            return await render_template('results.html')
+
+        return await render_template('testresult.html',
+                                     result=test_result.result,
+                                     name=f"{person.first_name} {person.last_name}",
+                                     birthdate=birthdate,
+                                     post_code=person.post_code)
+    return await render_template('results.html')
+
+
+@async_views.route('/staff/events', methods=['GET'])
+async def events() -> Response:
+    """
+    Async version of routes.events, so open staff panels do not hold a worker thread each.
+    :return: Event stream.
+    """
+    identity = await get_identity(user_id=session['_user_id']) if '_user_id' in session else None
+    if identity is None:
+        return Response('Please log in.', status=401)
+    args = request.args.to_dict()
+    if 'Last-Event-ID' in request.headers:
+        args['after_event'] = request.headers['Last-Event-ID']
+    try:
+        subscriber = AsyncSubscriber(*subscriber_from_args(args=args))
+    except ValueError:
+        return Response('Invalid last event.', status=400)
+    if subscriber.panel not in PANELS or (subscriber.panel == 'admin' and not identity[2]):
+        return Response('Unknown panel.', status=400)
+    if await get_last_queue_event_id(grace=EVENTS_GRACE_SECONDS) - subscriber.after_event > MAX_CATCH_UP:
+        subscriber.overflow = True
+    else:
+        queue_events.subscribe(subscriber=subscriber)
+
+    async def stream():
+        try:
+            async for message in subscriber.stream():
+                yield message.encode()
+        finally:
+            queue_events.unsubscribe(subscriber=subscriber)
+
+    response = await make_response(stream(), {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                             'X-Accel-Buffering': 'no'})
+    response.timeout = None
+    return response
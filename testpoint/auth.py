@@ -1,9 +1,12 @@
+import math
 from flask import Blueprint, render_template, request, flash, redirect, url_for, session
 from flask_login import login_required, logout_user, login_user
 from .loginManager import login_manager
 from werkzeug.security import check_password_hash
-from testpoint.models import User
-from testpoint.storagehandler import get_user, get_user_pw, is_admin
+from testpoint.identity import load_identity, remember_identity
+from testpoint.metrics import LOGINS, LOGIN_THROTTLED
+from testpoint.storagehandler import get_login
+from testpoint.throttle import login_throttle
 from testpoint.validation import email_is_valid
 
 auth = Blueprint('auth', __name__)
@@ -14,11 +17,10 @@ def load_user(user_id: str):
     """
     Check if user is logged in on every page load.
     :param user_id: User ID given as string.
-    :return: User ID or None.
+    :return: Identity of the user or None.
     """
-    """"""
     if user_id is not None:
-        return User.query.get(user_id)
+        return load_identity(user_id=user_id)
     return None
 
 
@@ -35,26 +37,42 @@ def unauthorized():
 @auth.route('/login/', methods=['GET', 'POST'])
 def login():
     """
-    Login with the provided username and password if they are correct.
+    Login with the provided username and password if they are correct. Attempts over the limit of the username or
+    the client are rejected before the user is looked up; only failed attempts count towards the username.
     :return: Redirect to staff page or admin panel.
     """
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
+        username = request.form.get('username') or ''
+        password = request.form.get('password') or ''
+
+        throttled = login_throttle.attempt(username=username, address=request.remote_addr)
+        if throttled is not None:
+            bucket, retry_after = throttled
+            LOGINS.labels(outcome='throttled').inc()
+            LOGIN_THROTTLED.labels(bucket=bucket).inc()
+            minutes = math.ceil(retry_after / 60)
+            flash(f"Too many login attempts. Please try again in {minutes} minute{'s' if minutes > 1 else ''}.",
+                  category='error')
+            return render_template('login.html'), 429, {'Retry-After': str(math.ceil(retry_after))}
 
         if not email_is_valid(username):
+            LOGINS.labels(outcome='invalid').inc()
             flash(f'Please provide a valid email address.', category='error')
             return render_template('login.html')
 
-        user = get_user(username=username)
-        if not user or not check_password_hash(get_user_pw(username=username), password):
+        login = get_login(username=username)
+        if not login or not login[2] or not check_password_hash(login[2], password):
+            LOGINS.labels(outcome='failed').inc()
+            login_throttle.failed(username=username, address=request.remote_addr)
             flash(f'Username or password is incorrect. Please try again.', category='error')
             return render_template('login.html')
 
-        login_user(user)
+        LOGINS.labels(outcome='success').inc()
+        identity = remember_identity(user_id=login[0], username=login[1], admin=login[3])
+        login_user(identity)
         session.permanent = True
 
-        if is_admin(username=username):
+        if identity.is_admin:
             return redirect(url_for('routes.admin'))
 
         return redirect(url_for('routes.staff'))
@@ -0,0 +1,236 @@
+import datetime as dt
+import signal
+import smtplib
+import sys
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from prometheus_client import start_http_server
+from .config import EMAIL_POOL_SIZE, IMPORT_CHUNK_SIZE, OUTBOX_BATCH_SIZE, OUTBOX_INTERVAL, RETENTION_DAYS, \
+    RETENTION_CHUNK_SIZE, RETENTION_PAUSE
+from .export import EXPORT_FORMATS, export_results
+from .importer import IMPORT_FORMATS, import_bookings, import_format, read_rows
+from .migrations import pending_migrations, upgrade_schema
+from .notification import send_queued_mails
+from .outbox import MailWorker
+from .queryplans import check_query_plans
+from .retention import purge_expired
+from .sessions import ServerSideSessionInterface, utcnow
+from .stats import rebuild_stats
+from .storage import db
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command() -> None:
+    """
+    Creates all tables of the TestPoint schema that do not exist yet and applies pending migrations.
+    :return: None.
+    """
+    upgrade_schema()
+    click.echo('Created missing tables and applied pending migrations.')
+
+
+@click.command('migrate')
+@click.option('--dry-run', is_flag=True, help='Only list the pending migrations.')
+@with_appcontext
+def migrate_command(dry_run: bool) -> None:
+    """
+    Applies all pending schema migrations to the database.
+    :param dry_run: True to only list the pending migrations.
+    :return: None.
+    """
+    if dry_run:
+        for migration in pending_migrations():
+            click.echo(f"Pending migration {migration.version}: {migration.description}")
+        return
+    for migration in upgrade_schema():
+        click.echo(f"Applied migration {migration.version}: {migration.description}")
+    click.echo('Schema is up to date.')
+
+
+@click.command('check-plans')
+@with_appcontext
+def check_plans_command() -> None:
+    """
+    Explains the queries of storagehandler and fails if any of them scans a whole table.
+    :return: None.
+    """
+    findings = check_query_plans()
+    for name, scans in findings.items():
+        click.echo(f"{name}: full table scan ({'; '.join(scans)})")
+    if findings:
+        raise SystemExit(1)
+    click.echo('All queries use indexes.')
+
+
+@click.command('import-bookings')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(IMPORT_FORMATS), default=None,
+              help='Format of the file, derived from its extension by default.')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='Rows booked per transaction.')
+@with_appcontext
+def import_bookings_command(path: str, file_format: str, chunk_size: int) -> None:
+    """
+    Books appointments for all rows of a CSV or NDJSON file and queues their booking confirmations.
+    :param path: Path of the file.
+    :param file_format: csv, ndjson or None to derive the format from the file extension.
+    :param chunk_size: Number of rows booked per transaction.
+    :return: None.
+    """
+    def reject(row: int, errors: dict[str, str]) -> None:
+        click.echo(f"Row {row} rejected: {' '.join(dict.fromkeys(errors.values()))}", err=True)
+
+    rows = {'read': 0}
+
+    def progress(totals: dict) -> None:
+        rows['read'] = totals['rows']
+        click.echo(f"{totals['rows']} rows read, {totals['booked']} booked, {totals['rejected']} rejected")
+
+    with open(path, newline='', encoding='utf-8-sig') as stream:
+        try:
+            import_bookings(rows=read_rows(stream=stream, file_format=file_format or import_format(filename=path)),
+                            chunk_size=chunk_size, reject=reject, progress=progress)
+        except UnicodeDecodeError:
+            db.session.rollback()
+            click.echo(f"The file is not UTF-8 encoded, the import stopped after row {rows['read']}.", err=True)
+            raise SystemExit(1)
+    click.echo('Import finished, the booking confirmations are queued for the mail worker.')
+
+
+@click.command('send-mail')
+@click.option('--batch-size', default=OUTBOX_BATCH_SIZE, show_default=True, help='Emails sent per SMTP session.')
+@with_appcontext
+def send_mail_command(batch_size: int) -> None:
+    """
+    Sends all queued emails that are due in batches once, e.g. from cron instead of running the mail worker.
+    :param batch_size: Number of emails sent per SMTP session.
+    :return: None.
+    """
+    total_sent = total_failed = 0
+    while True:
+        try:
+            sent, failed = send_queued_mails(batch_size=batch_size)
+        except (OSError, smtplib.SMTPException) as e:
+            click.echo(f"Sent {total_sent} emails, then the mail server failed: {e}", err=True)
+            raise SystemExit(1)
+        total_sent += sent
+        total_failed += failed
+        if sent + failed < batch_size:
+            break
+    click.echo(f"Sent {total_sent} emails, {total_failed} emails failed and are retried later or dead letters.")
+
+
+@click.command('mail-worker')
+@click.option('--batch-size', default=OUTBOX_BATCH_SIZE, show_default=True, help='Emails sent per SMTP session.')
+@click.option('--concurrency', type=click.IntRange(min=1, max=EMAIL_POOL_SIZE), default=EMAIL_POOL_SIZE,
+              show_default=True, help='Batches sent in parallel, each over its own SMTP session.')
+@click.option('--interval', type=click.FloatRange(min=0.1), default=OUTBOX_INTERVAL, show_default=True,
+              help='Seconds to wait when no email is due.')
+@click.option('--metrics-port', type=int, default=0, help='Port to expose the metrics of the worker on.')
+@with_appcontext
+def mail_worker_command(batch_size: int, concurrency: int, interval: float, metrics_port: int) -> None:
+    """
+    Sends the queued emails continuously until it is stopped with SIGTERM or Ctrl+C.
+    :param batch_size: Number of emails sent per SMTP session.
+    :param concurrency: Number of batches sent in parallel.
+    :param interval: Seconds to wait when no email is due.
+    :param metrics_port: Port to expose the metrics on in Prometheus text format, 0 to only write them to the
+    metrics directory.
+    :return: None.
+    """
+    if metrics_port:
+        start_http_server(port=metrics_port)
+    worker = MailWorker(app=current_app._get_current_object(), batch_size=batch_size, concurrency=concurrency,
+                        interval=interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    click.echo(f"Mail worker sending with {concurrency} SMTP sessions.")
+    worker.run()
+    click.echo(f"Mail worker stopped after sending {worker.totals['sent']} emails, "
+               f"{worker.totals['failed']} emails failed.")
+
+
+@click.command('export-results')
+@click.option('--from', 'date_from', required=True, type=click.DateTime(formats=['%Y-%m-%d']),
+              help='First test day (YYYY-MM-DD).')
+@click.option('--to', 'date_to', required=True, type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Last test day (YYYY-MM-DD).')
+@click.option('--format', 'file_format', type=click.Choice(EXPORT_FORMATS), default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), default='-',
+              help='File to write to, standard output by default.')
+@with_appcontext
+def export_results_command(date_from: dt.datetime, date_to: dt.datetime, file_format: str, compress: bool,
+                           output: str) -> None:
+    """
+    Exports all results tested in the given period with their appointment and person.
+    :param date_from: First test day.
+    :param date_to: Last test day.
+    :param file_format: csv or ndjson.
+    :param compress: True to gzip the output.
+    :param output: Path of the output file or - for standard output.
+    :return: None.
+    """
+    chunks = export_results(date_from=date_from.date(), date_to=date_to.date(), file_format=file_format,
+                            compress=compress)
+    if output == '-':
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        return
+    with open(output, 'wb') as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command() -> None:
+    """
+    Recomputes the daily statistics rollups from the appointments and results, keeping the rollups of purged days.
+    :return: None.
+    """
+    with db.engine.begin() as connection:
+        slots = rebuild_stats(connection=connection)
+    click.echo(f"Rebuilt statistics of {slots} slots.")
+
+
+@click.command('purge-expired')
+@click.option('--days', type=click.IntRange(min=0), default=RETENTION_DAYS, show_default=True,
+              help='Days after the appointment day the data is kept.')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=RETENTION_CHUNK_SIZE, show_default=True,
+              help='Rows deleted per transaction.')
+@click.option('--pause', type=click.FloatRange(min=0), default=RETENTION_PAUSE, show_default=True,
+              help='Seconds to wait between two chunks.')
+@with_appcontext
+def purge_expired_command(days: int, chunk_size: int, pause: float) -> None:
+    """
+    Deletes results, appointments, persons, queued emails and slots of appointments older than the retention period.
+    :param days: Days after the appointment day the data is kept.
+    :param chunk_size: Rows deleted per transaction.
+    :param pause: Seconds to wait between two chunks.
+    :return: None.
+    """
+    def progress(totals: dict) -> None:
+        click.echo(', '.join(f"{deleted} {table} rows" for table, deleted in totals.items()) + ' deleted')
+
+    totals = purge_expired(retention_days=days, chunk_size=chunk_size, pause=pause, progress=progress)
+    click.echo(f"Purge finished, deleted {sum(totals.values())} expired rows.")
+
+
+@click.command('sweep-sessions')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=RETENTION_CHUNK_SIZE, show_default=True,
+              help='Sessions deleted per transaction.')
+@with_appcontext
+def sweep_sessions_command(chunk_size: int) -> None:
+    """
+    Deletes the expired sessions of the server-side session store.
+    :param chunk_size: Sessions deleted per transaction.
+    :return: None.
+    """
+    if not isinstance(current_app.session_interface, ServerSideSessionInterface):
+        click.echo('Sessions are kept in cookies, nothing to sweep.')
+        return
+    deleted = current_app.session_interface.sessions.store.sweep(now=utcnow(), chunk_size=chunk_size)
+    click.echo(f"Deleted {deleted} expired sessions.")
@@ -1,17 +1,98 @@
+import os
 from configparser import ConfigParser
 
 config = ConfigParser()
-config.read('config.ini')
-DB_USER = config['DATABASE']['USER']
-DB_PW = config['DATABASE']['PW']
-DB_ADDRESS = config['DATABASE']['ADDRESS']
-DB_PORT = config['DATABASE']['PORT']
-DB_NAME = config['DATABASE']['NAME']
+config.read(os.environ.get('TESTPOINT_CONFIG', 'config.ini'))
+DB_BACKEND = config.get('DATABASE', 'BACKEND', fallback='mysql')
+if DB_BACKEND not in ('mysql', 'sqlite'):
+    raise ValueError(f"Unsupported database backend {DB_BACKEND}, use mysql or sqlite.")
+if DB_BACKEND == 'mysql':
+    DB_USER = config['DATABASE']['USER']
+    DB_PW = config['DATABASE']['PW']
+    DB_ADDRESS = config['DATABASE']['ADDRESS']
+    DB_PORT = config['DATABASE']['PORT']
+    DB_NAME = config['DATABASE']['NAME']
+else:
+    DB_USER = DB_PW = DB_ADDRESS = DB_PORT = DB_NAME = None
+DB_PATH = config.get('DATABASE', 'PATH', fallback='testpoint.db')
+DB_SQLITE_SYNCHRONOUS = config.get('DATABASE', 'SQLITE_SYNCHRONOUS', fallback='NORMAL')
+DB_SQLITE_CACHE_SIZE = config.getint('DATABASE', 'SQLITE_CACHE_SIZE', fallback=65536)
+DB_SQLITE_MMAP_SIZE = config.getint('DATABASE', 'SQLITE_MMAP_SIZE', fallback=268435456)
+DB_SQLITE_BUSY_TIMEOUT = config.getint('DATABASE', 'SQLITE_BUSY_TIMEOUT', fallback=5000)
+DB_POOL_SIZE = config.getint('DATABASE', 'POOL_SIZE', fallback=5)
+DB_MAX_OVERFLOW = config.getint('DATABASE', 'MAX_OVERFLOW', fallback=10)
+DB_POOL_TIMEOUT = config.getfloat('DATABASE', 'POOL_TIMEOUT', fallback=30.0)
+DB_POOL_RECYCLE = config.getint('DATABASE', 'POOL_RECYCLE', fallback=3600)
+DB_POOL_PRE_PING = config.getboolean('DATABASE', 'POOL_PRE_PING', fallback=True)
+DB_MIGRATION_LOCK_TIMEOUT = config.getint('DATABASE', 'MIGRATION_LOCK_TIMEOUT', fallback=5)
+DB_REPLICAS = [replica.strip() for replica in config.get('DATABASE', 'REPLICAS', fallback='').split(',')
+               if replica.strip()]
+DB_REPLICA_MAX_LAG = config.getfloat('DATABASE', 'REPLICA_MAX_LAG', fallback=5.0)
+DB_REPLICA_CHECK_INTERVAL = config.getfloat('DATABASE', 'REPLICA_CHECK_INTERVAL', fallback=5.0)
+DB_REPLICA_CONNECT_TIMEOUT = config.getint('DATABASE', 'REPLICA_CONNECT_TIMEOUT', fallback=2)
 
 EMAIL_USER = config['EMAIL']['USER']
 EMAIL_PW = config['EMAIL']['PW']
 EMAIL_SERVER = config['EMAIL']['SERVER']
 EMAIL_PORT = config['EMAIL']['PORT']
+EMAIL_SECURITY = config.get('EMAIL', 'SECURITY', fallback='ssl')
+EMAIL_POOL_SIZE = config.getint('EMAIL', 'POOL_SIZE', fallback=2)
+EMAIL_POOL_MAX_IDLE = config.getfloat('EMAIL', 'POOL_MAX_IDLE', fallback=60.0)
+
+QRCODE_WORKERS = config.getint('QRCODE', 'WORKERS', fallback=1)
+QRCODE_CACHE_SIZE = config.getint('QRCODE', 'CACHE_SIZE', fallback=256)
+QRCODE_FORMAT = config.get('QRCODE', 'FORMAT', fallback='png')
+QRCODE_BOX_SIZE = config.getint('QRCODE', 'BOX_SIZE', fallback=4)
+QRCODE_BORDER = config.getint('QRCODE', 'BORDER', fallback=2)
+
+METRICS_DIR = config.get('METRICS', 'DIR', fallback='')
+METRICS_ENDPOINT = config.getboolean('METRICS', 'ENDPOINT', fallback=True)
+METRICS_ALLOWED_ADDRESSES = [address.strip() for address in
+                             config.get('METRICS', 'ALLOWED_ADDRESSES', fallback='127.0.0.1, ::1').split(',')
+                             if address.strip()]
 
 WEBSITE_URL = config['WEBSITE']['URL']
 WEBSITE_PORT = config['WEBSITE']['PORT']
+WEBSITE_PAGE_SIZE = config.getint('WEBSITE', 'PAGE_SIZE', fallback=50)
+WEBSITE_IDENTITY_TTL = config.getfloat('WEBSITE', 'IDENTITY_TTL', fallback=60.0)
+WEBSITE_STATS_DAYS = config.getint('WEBSITE', 'STATS_DAYS', fallback=14)
+WEBSITE_CACHE_MAX_AGE = config.getint('WEBSITE', 'CACHE_MAX_AGE', fallback=300)
+WEBSITE_PAGE_CACHE_SIZE = config.getint('WEBSITE', 'PAGE_CACHE_SIZE', fallback=64)
+WEBSITE_EVENTS_INTERVAL = config.getfloat('WEBSITE', 'EVENTS_INTERVAL', fallback=1.0)
+
+SESSION_SECRET_KEY = config.get('SESSION', 'SECRET_KEY', fallback='')
+SESSION_OLD_SECRET_KEYS = [key.strip() for key in config.get('SESSION', 'OLD_SECRET_KEYS', fallback='').split(',')
+                           if key.strip()]
+SESSION_LIFETIME = config.getint('SESSION', 'LIFETIME', fallback=30)
+SESSION_BACKEND = config.get('SESSION', 'BACKEND', fallback='cookie')
+if SESSION_BACKEND not in ('cookie', 'database', 'files'):
+    raise ValueError(f"Unsupported session backend {SESSION_BACKEND}, use cookie, database or files.")
+SESSION_DIR = config.get('SESSION', 'DIR', fallback='sessions')
+
+LOGIN_THROTTLE_PATH = config.get('LOGIN', 'THROTTLE_PATH', fallback='')
+LOGIN_USER_BURST = config.getint('LOGIN', 'USER_BURST', fallback=5)
+LOGIN_USER_PER_MINUTE = config.getfloat('LOGIN', 'USER_PER_MINUTE', fallback=1.0)
+LOGIN_IP_BURST = config.getint('LOGIN', 'IP_BURST', fallback=30)
+LOGIN_IP_PER_MINUTE = config.getfloat('LOGIN', 'IP_PER_MINUTE', fallback=10.0)
+LOGIN_PROXIES = config.getint('LOGIN', 'PROXIES', fallback=0)
+
+SLOTS_FIRST_HOUR = config.getint('SLOTS', 'FIRST_HOUR', fallback=8)
+SLOTS_LAST_HOUR = config.getint('SLOTS', 'LAST_HOUR', fallback=23)
+SLOTS_LANES = config.getint('SLOTS', 'LANES', fallback=1)
+SLOTS_CAPACITY = config.getint('SLOTS', 'CAPACITY', fallback=1)
+SLOTS_CAPACITY_OVERRIDES = config.get('SLOTS', 'CAPACITY_OVERRIDES', fallback='')
+SLOTS_BOOKING_DAYS = config.getint('SLOTS', 'BOOKING_DAYS', fallback=14)
+SLOTS_REFRESH = config.getfloat('SLOTS', 'REFRESH', fallback=10.0)
+
+IMPORT_CHUNK_SIZE = config.getint('IMPORT', 'CHUNK_SIZE', fallback=500)
+
+RETENTION_DAYS = config.getint('RETENTION', 'DAYS', fallback=30)
+RETENTION_CHUNK_SIZE = config.getint('RETENTION', 'CHUNK_SIZE', fallback=500)
+RETENTION_PAUSE = config.getfloat('RETENTION', 'PAUSE', fallback=0.1)
+
+OUTBOX_BATCH_SIZE = config.getint('OUTBOX', 'BATCH_SIZE', fallback=50)
+OUTBOX_INTERVAL = config.getfloat('OUTBOX', 'INTERVAL', fallback=2.0)
+OUTBOX_LEASE = config.getint('OUTBOX', 'LEASE', fallback=300)
+OUTBOX_MAX_ATTEMPTS = config.getint('OUTBOX', 'MAX_ATTEMPTS', fallback=8)
+OUTBOX_RETRY_DELAY = config.getint('OUTBOX', 'RETRY_DELAY', fallback=60)
+OUTBOX_RETRY_MAX_DELAY = config.getint('OUTBOX', 'RETRY_MAX_DELAY', fallback=3600)
@@ -0,0 +1,286 @@
+import asyncio
+import datetime as dt
+import json
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional
+from flask import Flask, render_template
+from sqlalchemy.exc import SQLAlchemyError
+from .config import WEBSITE_EVENTS_INTERVAL
+from .storage import db
+from .storagehandler import get_queue_events
+
+PANELS = {'staff': 'appointment_key', 'admin': 'appointment_id'}
+EVENTS_PAGE_SIZE = 500
+MAX_CATCH_UP = 500
+SUBSCRIBER_BACKLOG = 100
+HEARTBEAT_SECONDS = 15.0
+# Event IDs are assigned on insert, so an event may be committed after events with higher IDs for this long.
+EVENTS_GRACE_SECONDS = 10
+
+
+def sort_key(day: dt.date, time_of_day: dt.time, key: int) -> str:
+    """
+    Returns the position of an appointment in the staff queue as used by the data-sort attribute of queue_item.html.
+    :param day: Appointment day.
+    :param time_of_day: Appointment time.
+    :param key: Internal ID (primary key) of the appointment.
+    :return: Sort key as string.
+    """
+    return f"{day.isoformat()}_{time_of_day.strftime('%H:%M:%S')}_{key:010d}"
+
+
+def subscriber_from_args(args: dict) -> tuple[str, int, dict, Optional[str]]:
+    """
+    Reads panel, last event, filters and page cursor of a panel from the arguments of its event stream request.
+    :param args: Request arguments.
+    :return: Tuple of panel, last event ID, filters and page cursor.
+    """
+    return (args.get('panel', 'staff'), int(args.get('after_event', 0)),
+            {'day': args.get('day') or None, 'time_from': args.get('time_from') or None,
+             'time_to': args.get('time_to') or None},
+            args.get('after') or None)
+
+
+class Subscriber(ABC):
+    """
+    Open staff or admin panel receiving the changes of the staff queue that match its filters and page.
+    """
+
+    def __init__(self, panel: str, after_event: int, filters: dict, after: Optional[str] = None) -> None:
+        """
+        :param panel: staff or admin.
+        :param after_event: ID of the event up to which the panel shows all changes, advanced by the broker once the
+        events are older than the grace period.
+        :param filters: Filters of the panel with day (YYYY-MM-DD), time_from and time_to (HH:MM) or None.
+        :param after: Page cursor of the panel as string or None for the first page.
+        """
+        self.panel = panel
+        self.after_event = after_event
+        self.published: set[int] = set()
+        self.filters = filters
+        self.after = after
+        self.overflow = False
+
+    def matches(self, event: dict) -> bool:
+        """
+        Checks whether a newly verified appointment belongs on the page of the panel.
+        :param event: Event as prepared by QueueEventBroker.
+        :return: True if the panel has to show the appointment.
+        """
+        if self.filters.get('day') and event['day'] != self.filters['day']:
+            return False
+        if self.filters.get('time_from') and event['time'] < self.filters['time_from']:
+            return False
+        if self.filters.get('time_to') and event['time'] > self.filters['time_to']:
+            return False
+        return self.after is None or event['sort'] > self.after
+
+    def messages(self, events: list[dict], cursor: int) -> list[str]:
+        """
+        Formats the events that concern the panel as server-sent events. The messages carry the cursor instead of
+        the event IDs, so a reconnecting panel also receives the events that were committed late.
+        :param events: Events as prepared by QueueEventBroker.
+        :param cursor: ID of the event up to which the panel has received all changes with these events.
+        :return: List of messages.
+        """
+        messages = []
+        for event in events:
+            if event['kind'] == 'verified':
+                if not self.matches(event=event):
+                    continue
+                data = {'key': event['key'], 'sort': event['sort'], 'html': event['html'][self.panel]}
+            else:
+                data = {'key': event['key']}
+            messages.append(f"id: {cursor}\nevent: {event['kind']}\ndata: {json.dumps(data)}\n\n")
+        return messages
+
+    @abstractmethod
+    def publish(self, events: list[dict], cursor: int) -> None:
+        """
+        Hands new events to the panel without blocking the broker. Panels that fall too far behind are told to
+        reload instead.
+        :param events: Events as prepared by QueueEventBroker.
+        :param cursor: ID of the event up to which the panel has received all changes with these events.
+        :return: None.
+        """
+
+
+class ThreadSubscriber(Subscriber):
+    """
+    Subscriber served by a WSGI worker thread.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_BACKLOG)
+
+    def publish(self, events: list[dict], cursor: int) -> None:
+        try:
+            self.queue.put_nowait((events, cursor))
+        except queue.Full:
+            self.overflow = True
+
+    def stream(self) -> Iterator[str]:
+        """
+        Yields the server-sent events for the panel and a comment as heartbeat when nothing happened, so proxies keep
+        the connection open and a closed connection is noticed.
+        :return: Iterator of messages.
+        """
+        while not self.overflow:
+            try:
+                events, cursor = self.queue.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield ''.join(self.messages(events=events, cursor=cursor))
+        yield 'event: reload\ndata: {}\n\n'
+
+
+class AsyncSubscriber(Subscriber):
+    """
+    Subscriber served by the event loop of the async views.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_BACKLOG)
+
+    def _put(self, events: list[dict], cursor: int) -> None:
+        try:
+            self.queue.put_nowait((events, cursor))
+        except asyncio.QueueFull:
+            self.overflow = True
+
+    def publish(self, events: list[dict], cursor: int) -> None:
+        self.loop.call_soon_threadsafe(self._put, events, cursor)
+
+    async def stream(self):
+        """
+        Async version of ThreadSubscriber.stream.
+        :return: Async iterator of messages.
+        """
+        while not self.overflow:
+            try:
+                events, cursor = await asyncio.wait_for(self.queue.get(), timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': heartbeat\n\n'
+                continue
+            yield ''.join(self.messages(events=events, cursor=cursor))
+        yield 'event: reload\ndata: {}\n\n'
+
+
+class QueueEventBroker:
+    """
+    Per-process fan-out of the changes of the staff queue. A single thread polls the queue_event table for all open
+    panels of the worker process and renders every newly verified appointment once, so open panels neither query
+    the database nor reload the page. The thread only runs while panels are open. Events younger than the grace
+    period are read again on every poll, so events committed after events with higher IDs are not skipped; every
+    panel receives each event once.
+    """
+
+    def __init__(self, interval: float) -> None:
+        """
+        :param interval: Seconds between two polls.
+        """
+        self.interval = interval
+        self.app: Optional[Flask] = None
+        self._lock = threading.Lock()
+        self._subscribers: set[Subscriber] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Sets the application whose database the broker polls.
+        :param app: Flask application.
+        :return: None.
+        """
+        self.app = app
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        """
+        Starts delivering events to the given subscriber, beginning after its last known event.
+        :param subscriber: Subscriber.
+        :return: None.
+        """
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='queue-events', daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """
+        Stops delivering events to the given subscriber.
+        :param subscriber: Subscriber.
+        :return: None.
+        """
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run(self) -> None:
+        """
+        Polls for new events and hands them to all subscribers until the last one is gone.
+        :return: None.
+        """
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+                subscribers = list(self._subscribers)
+            try:
+                settled, events = self.poll(after=min(subscriber.after_event for subscriber in subscribers))
+            except SQLAlchemyError:
+                # The database is unavailable, the panels keep their state until the next poll succeeds.
+                continue
+            for subscriber in subscribers:
+                new_events = [event for event in events
+                              if event['id'] > subscriber.after_event and event['id'] not in subscriber.published]
+                published = subscriber.published | {event['id'] for event in new_events}
+                subscriber.after_event = max(subscriber.after_event, settled)
+                subscriber.published = {event_id for event_id in published if event_id > subscriber.after_event}
+                if new_events:
+                    subscriber.publish(events=new_events, cursor=subscriber.after_event)
+
+    def poll(self, after: int) -> tuple[int, list[dict]]:
+        """
+        Reads all events after the given one and prepares them for the panels. Events of appointments that were
+        deleted meanwhile or verified again after their result was added are skipped.
+        :param after: ID of the oldest event all subscribers already know.
+        :return: Tuple of the ID of the last event read that is older than the grace period and a list of events as
+        dictionaries with id, kind, key, day, time, sort and for verified appointments the rendered list item of every
+        panel.
+        """
+        events = []
+        settled = after
+        with self.app.app_context():
+            while True:
+                rows = get_queue_events(after=after, limit=EVENTS_PAGE_SIZE, grace=EVENTS_GRACE_SECONDS)
+                for event, appointment, has_result, is_settled in rows:
+                    after = event.id
+                    if is_settled:
+                        settled = event.id
+                    if appointment is None or (event.kind == 'verified' and has_result):
+                        continue
+                    prepared = {'id': event.id, 'kind': event.kind, 'key': appointment.id,
+                                'day': appointment.appointment_day.isoformat(),
+                                'time': appointment.appointment_time.strftime('%H:%M'),
+                                'sort': sort_key(day=appointment.appointment_day,
+                                                 time_of_day=appointment.appointment_time, key=appointment.id)}
+                    if event.kind == 'verified':
+                        prepared['html'] = {panel: render_template('queue_item.html', appointment=appointment,
+                                                                   key_field=key_field)
+                                            for panel, key_field in PANELS.items()}
+                    events.append(prepared)
+                if len(rows) < EVENTS_PAGE_SIZE:
+                    break
+            db.session.remove()
+        return settled, events
+
+
+queue_events = QueueEventBroker(interval=WEBSITE_EVENTS_INTERVAL)
@@ -0,0 +1,130 @@
+import csv
+import datetime as dt
+import io
+import json
+import zlib
+from typing import Iterable, Iterator
+from sqlalchemy import select
+from .models import Appointment, Person, Result
+from .storage import db
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_COLUMNS = [Result.result_id, Result.result, Result.test_day, Result.test_time,
+                  Appointment.appointment_id, Appointment.appointment_day, Appointment.appointment_time,
+                  Person.last_name, Person.first_name, Person.birthdate, Person.gender, Person.street, Person.number,
+                  Person.post_code, Person.city, Person.country, Person.tel, Person.email, Person.passport]
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+ROWS_PER_FETCH = 1000
+BYTES_PER_CHUNK = 64 * 1024
+
+
+def read_results(date_from: dt.date, date_to: dt.date) -> Iterator[tuple]:
+    """
+    Reads all results tested in the given period with their appointment and person from a server-side cursor, so
+    only ROWS_PER_FETCH rows are held in memory at a time.
+    :param date_from: First test day.
+    :param date_to: Last test day.
+    :return: Iterator over the rows as tuples in the order of EXPORT_FIELDS, ordered by test day and time.
+    """
+    query = select(*EXPORT_COLUMNS) \
+        .join(Appointment, Appointment.id == Result.appointment_key) \
+        .join(Person, Person.person_id == Result.person_id) \
+        .where(Result.test_day.between(date_from, date_to)) \
+        .order_by(Result.test_day, Result.test_time, Result.id) \
+        .execution_options(stream_results=True, yield_per=ROWS_PER_FETCH)
+    yield from db.session.execute(query)
+
+
+def to_text(value) -> str:
+    """
+    Converts an exported value to text, dates and times in ISO format.
+    :param value: Value of a column.
+    :return: Value as string, empty for missing values.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dt.date, dt.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def format_csv(rows: Iterable[tuple]) -> Iterator[str]:
+    """
+    Formats rows as CSV with a header line.
+    :param rows: Rows as tuples in the order of EXPORT_FIELDS.
+    :return: Iterator over the lines.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([to_text(value) for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def format_ndjson(rows: Iterable[tuple]) -> Iterator[str]:
+    """
+    Formats rows as one JSON object per line.
+    :param rows: Rows as tuples in the order of EXPORT_FIELDS.
+    :return: Iterator over the lines.
+    """
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, (to_text(value) for value in row)))) + '\n'
+
+
+def encode_chunks(lines: Iterable[str], compress: bool) -> Iterator[bytes]:
+    """
+    Joins lines into chunks of about BYTES_PER_CHUNK bytes, optionally compressed as one gzip stream.
+    :param lines: Lines as strings.
+    :param compress: True to gzip the output.
+    :return: Iterator over the encoded chunks.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    pending = []
+    size = 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= BYTES_PER_CHUNK:
+            data = ''.join(pending).encode('utf-8')
+            pending, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ''.join(pending).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def export_results(date_from: dt.date, date_to: dt.date, file_format: str, compress: bool) -> Iterator[bytes]:
+    """
+    Exports all results tested in the given period with their appointment and person as a stream of chunks.
+    :param date_from: First test day.
+    :param date_to: Last test day.
+    :param file_format: csv or ndjson.
+    :param compress: True to gzip the output.
+    :return: Iterator over the chunks of the export file.
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format {file_format}, use {' or '.join(EXPORT_FORMATS)}.")
+    rows = read_results(date_from=date_from, date_to=date_to)
+    lines = format_csv(rows=rows) if file_format == 'csv' else format_ndjson(rows=rows)
+    return encode_chunks(lines=lines, compress=compress)
+
+
+def export_filename(date_from: dt.date, date_to: dt.date, file_format: str, compress: bool) -> str:
+    """
+    Returns the file name of an export.
+    :param date_from: First test day.
+    :param date_to: Last test day.
+    :param file_format: csv or ndjson.
+    :param compress: True if the output is gzipped.
+    :return: File name as string.
+    """
+    return f"testpoint-results-{date_from.isoformat()}-{date_to.isoformat()}.{file_format}" + \
+        ('.gz' if compress else '')
@@ -0,0 +1,47 @@
+from flask import Blueprint, jsonify
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from .config import DB_POOL_SIZE, DB_MAX_OVERFLOW
+from .storage import db
+
+health = Blueprint('health', __name__)
+
+
+def get_pool_status() -> dict:
+    """
+    Returns the current usage of the database connection pool of this worker process.
+    :return: Pool usage as dictionary.
+    """
+    pool = db.engine.pool
+    return {'size': pool.size() if hasattr(pool, 'size') else None,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None}
+
+
+@health.route('/health/')
+def liveness():
+    """
+    Liveness check that answers as long as the worker process can handle requests.
+    :return: JSON status.
+    """
+    return jsonify(status='ok')
+
+
+@health.route('/ready/')
+def readiness():
+    """
+    Readiness check for load balancers. Reports the pool usage of this worker and whether the database is reachable.
+    Answers with status 503 if all pooled connections are in use or the database cannot be reached.
+    :return: JSON status with pool usage.
+    """
+    pool = get_pool_status()
+    if pool['checked_out'] is not None and pool['checked_out'] >= DB_POOL_SIZE + DB_MAX_OVERFLOW:
+        return jsonify(status='saturated', database='unknown', pool=pool), 503
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+    except SQLAlchemyError:
+        return jsonify(status='unavailable', database='unreachable', pool=pool), 503
+    return jsonify(status='ok', database='ok', pool=pool)
@@ -0,0 +1,129 @@
+import threading
+import time
+from typing import Optional
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .config import WEBSITE_IDENTITY_TTL
+from .models import User, Staff
+from .storagehandler import get_identity
+
+
+class Identity(UserMixin):
+    """
+    Logged in staff member as kept in the identity cache, holding everything a request needs to know about the user.
+    """
+
+    def __init__(self, user_id: int, username: str, admin: bool) -> None:
+        """
+        :param user_id: Internal ID of the user.
+        :param username: Email address of the user as string.
+        :param admin: True if the user is an admin, False otherwise.
+        """
+        self.id = user_id
+        self.username = username
+        self.is_admin = admin
+
+
+class IdentityCache:
+    """
+    Per-process cache of identities with a time to live. Entries are dropped as soon as this process changes a User or
+    Staff row, other processes pick up changes after the time to live.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        """
+        :param ttl: Seconds an identity is served from the cache.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._identities = {}
+
+    def get(self, user_id: str) -> Optional[Identity]:
+        """
+        Returns the cached identity for the given user ID if it has not expired.
+        :param user_id: User ID as string.
+        :return: Identity or None if not cached.
+        """
+        with self._lock:
+            cached = self._identities.get(user_id)
+        if cached and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        return None
+
+    def put(self, user_id: str, identity: Identity) -> None:
+        """
+        Caches the identity for the given user ID.
+        :param user_id: User ID as string.
+        :param identity: Identity to cache.
+        :return: None.
+        """
+        with self._lock:
+            self._identities[user_id] = (identity, time.monotonic())
+
+    def clear(self) -> None:
+        """
+        Drops all cached identities.
+        :return: None.
+        """
+        with self._lock:
+            self._identities.clear()
+
+
+identity_cache = IdentityCache(ttl=WEBSITE_IDENTITY_TTL)
+
+
+def load_identity(user_id: str) -> Optional[Identity]:
+    """
+    Returns the identity of the given user from the cache or loads user and admin flag with a single query.
+    :param user_id: User ID as string.
+    :return: Identity or None if the user does not exist.
+    """
+    user_id = str(user_id)
+    identity = identity_cache.get(user_id=user_id)
+    if identity is not None:
+        return identity
+    row = get_identity(user_id=user_id)
+    if row is None:
+        return None
+    identity = Identity(user_id=row[0], username=row[1], admin=row[2])
+    identity_cache.put(user_id=user_id, identity=identity)
+    return identity
+
+
+def remember_identity(user_id: int, username: str, admin: bool) -> Identity:
+    """
+    Returns the identity of a user who just logged in and caches it, so the following requests do not load it again.
+    :param user_id: Internal ID of the user.
+    :param username: Email address of the user as string.
+    :param admin: True if the user is an admin, False otherwise.
+    :return: Identity.
+    """
+    identity = Identity(user_id=user_id, username=username, admin=admin)
+    identity_cache.put(user_id=str(user_id), identity=identity)
+    return identity
+
+
+def invalidate_identities(*args) -> None:
+    """
+    Clears the identity cache after a User or Staff row was changed.
+    :return: None.
+    """
+    identity_cache.clear()
+
+
+for model in (User, Staff):
+    for change in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, change, invalidate_identities)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def invalidate_identities_on_bulk_change(orm_execute_state) -> None:
+    """
+    Clears the identity cache when User or Staff rows are changed with a bulk UPDATE or DELETE statement.
+    :param orm_execute_state: State of the ORM statement to execute.
+    :return: None.
+    """
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ in (User, Staff):
+        identity_cache.clear()
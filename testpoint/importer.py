@@ -0,0 +1,259 @@
+import csv
+import datetime as dt
+import json
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional, TextIO, Union
+from sqlalchemy import and_, insert
+from sqlalchemy.exc import IntegrityError
+from .metrics import BOOKINGS
+from .models import Person, Appointment
+from .slots import booking_window, ensure_slots, reserve_places
+from .stats import count_stats
+from .storage import db
+from .storagehandler import booking_confirmation_mail, new_public_id, queue_mails
+from .validation import BOOKING_SCHEMA, parse_date, parse_time, validate_many
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+OPTIONAL_FIELDS = ('gender', 'passport')
+
+
+def import_format(filename: str) -> str:
+    """
+    Derives the import format from the extension of a file name.
+    :param filename: Name of the imported file.
+    :return: csv or ndjson.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'csv':
+        return 'csv'
+    if extension in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    raise ValueError(f"Unsupported import file {filename}, use a .csv or .ndjson file.")
+
+
+class InvalidRow:
+    """
+    Row of an imported file that could not be read, reported as rejected row instead of stopping the import.
+    """
+
+    def __init__(self, error: str) -> None:
+        """
+        :param error: Reason the row could not be read.
+        """
+        self.error = error
+
+
+def read_rows(stream: TextIO, file_format: str) -> Iterator[Union[dict, InvalidRow]]:
+    """
+    Reads bookings row by row from a CSV file with a header line or from a file with one JSON object per line.
+    :param stream: File opened in text mode.
+    :param file_format: csv or ndjson.
+    :return: Iterator over the rows as dictionaries or InvalidRow objects for rows that are not valid CSV or JSON
+    objects.
+    """
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield InvalidRow(error=f"The row is not valid CSV: {e}.")
+                continue
+            yield row
+    elif file_format == 'ndjson':
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield InvalidRow(error=f"The line is not valid JSON: {e}.")
+                continue
+            yield row if isinstance(row, dict) else InvalidRow(error="The line is not a JSON object.")
+    else:
+        raise ValueError(f"Unsupported import format {file_format}, use {' or '.join(IMPORT_FORMATS)}.")
+
+
+def normalize_row(row: dict) -> dict:
+    """
+    Turns an imported row into a booking as sent by the booking form. Values are stripped and converted to strings,
+    a single email column is used for both email fields and optional fields default to empty strings.
+    :param row: Imported row as dictionary.
+    :return: Booking as dictionary.
+    """
+    booking = {key: value.strip() if isinstance(value, str) else str(value)
+               for key, value in row.items() if key is not None and value is not None}
+    if 'email1' not in booking and 'email' in booking:
+        booking['email1'] = booking['email']
+    booking.setdefault('email2', booking.get('email1'))
+    for field in OPTIONAL_FIELDS:
+        booking.setdefault(field, '')
+    return booking
+
+
+def import_bookings(rows: Iterable[Union[dict, InvalidRow]], chunk_size: int,
+                    reject: Optional[Callable[[int, dict[str, str]], None]] = None,
+                    progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Books appointments for imported rows in chunks. Rows are consumed lazily, so only one chunk is held in memory at
+    a time. Every chunk is validated in one pass and booked in one transaction with multi-row statements, and the
+    booking confirmations are queued in the same transaction instead of being sent right away.
+    :param rows: Imported rows as dictionaries or InvalidRow objects, e.g. from read_rows.
+    :param chunk_size: Number of rows per chunk and transaction.
+    :param reject: Function called with the row number (starting at 1) and a dictionary mapping fields to error
+    messages for every row that was not booked, or None.
+    :param progress: Function called with the running totals after every chunk, or None.
+    :return: Totals as dictionary with the number of rows, booked appointments and rejected rows.
+    """
+    totals = {'rows': 0, 'booked': 0, 'rejected': 0}
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            break
+        errors = {index: {'row': row.error} for index, row in enumerate(chunk) if isinstance(row, InvalidRow)}
+        valid = [index for index in range(len(chunk)) if index not in errors]
+        bookings = [normalize_row(chunk[index]) for index in valid]
+        try:
+            booked, booking_errors = import_chunk(bookings=bookings)
+        except IntegrityError:
+            # A concurrent booking added one of the persons or appointments, the retry sees them.
+            db.session.rollback()
+            try:
+                booked, booking_errors = import_chunk(bookings=bookings)
+            except IntegrityError:
+                db.session.rollback()
+                booked, booking_errors = import_rows(bookings=bookings)
+        errors.update({valid[index]: booking_errors[index] for index in booking_errors})
+        if reject:
+            for index in sorted(errors):
+                reject(totals['rows'] + index + 1, errors[index])
+        totals['rows'] += len(chunk)
+        totals['booked'] += booked
+        totals['rejected'] += len(errors)
+        BOOKINGS.labels(outcome='imported').inc(booked)
+        if progress:
+            progress(dict(totals))
+    db.session.close()
+    return totals
+
+
+def import_rows(bookings: list[dict]) -> tuple[int, dict[int, dict[str, str]]]:
+    """
+    Books the appointments of one chunk of imported bookings row by row, each in its own transaction. Used when the
+    chunk keeps conflicting with stored persons or appointments, so only the conflicting rows are rejected.
+    :param bookings: Bookings as dictionaries as returned by normalize_row.
+    :return: Tuple of the number of booked appointments and a dictionary mapping the index of every rejected booking
+    in the chunk to its errors.
+    """
+    booked = 0
+    errors = {}
+    for index, booking in enumerate(bookings):
+        try:
+            row_booked, row_errors = import_chunk(bookings=[booking])
+        except IntegrityError:
+            db.session.rollback()
+            errors[index] = {'email1': "The booking conflicts with a stored person or appointment."}
+            continue
+        booked += row_booked
+        if row_errors:
+            errors[index] = row_errors[0]
+    return booked, errors
+
+
+def email_key(email: str) -> str:
+    """
+    Returns the spelling of an email address used to detect duplicates, as addresses differing only in case belong to
+    the same person.
+    :param email: Email address as string.
+    :return: Email address in lower case.
+    """
+    return email.strip().lower()
+
+
+def import_chunk(bookings: list[dict]) -> tuple[int, dict[int, dict[str, str]]]:
+    """
+    Books the appointments of one chunk of imported bookings in a single transaction: skips appointments that exist
+    already, reserves the places per slot, adds the missing persons of the reserved bookings and inserts the
+    appointments and queued booking confirmations with one statement each. Persons are only added for bookings that
+    got a place, so rejected rows leave no personal data behind. Slot inventory is only created for days in the
+    booking window, bookings of other days need an existing inventory.
+    :param bookings: Bookings as dictionaries as returned by normalize_row.
+    :return: Tuple of the number of booked appointments and a dictionary mapping the index of every rejected booking
+    in the chunk to its errors.
+    """
+    errors = validate_many(records=bookings, schema=BOOKING_SCHEMA)
+    pending = {}
+    for index, booking in enumerate(bookings):
+        if index in errors:
+            continue
+        key = (email_key(booking['email1']), parse_date(booking['appointment_day']),
+               parse_time(booking['appointment_time']))
+        if key in pending:
+            errors[index] = {'email1': "The person is booked for this slot twice in the file."}
+            continue
+        pending[key] = index
+    if not pending:
+        return 0, errors
+    bookable = set(booking_window(today=dt.date.today()))
+    ensure_slots(days=sorted({day for _, day, _ in pending if day in bookable}))
+
+    emails = {bookings[index]['email1'] for index in pending.values()}
+    person_ids = {email_key(email): person_id for email, person_id in
+                  db.session.query(Person.email, Person.person_id).filter(Person.email.in_(emails)).all()}
+    days = {day for _, day, _ in pending}
+    existing = set(db.session.query(Appointment.person_id, Appointment.appointment_day, Appointment.appointment_time)
+                   .filter(and_(Appointment.person_id.in_(set(person_ids.values())),
+                                Appointment.appointment_day.in_(days))).all()) if person_ids else set()
+    slots = {}
+    for (email, day, time), index in pending.items():
+        if email in person_ids and (person_ids[email], day, time) in existing:
+            errors[index] = {'appointment_day': "The person already has an appointment in this slot."}
+        else:
+            slots.setdefault((day, time), []).append(index)
+
+    reserved_indices = []
+    counts = {}
+    for (day, time), indices in slots.items():
+        reserved = reserve_places(slot_day=day, slot_time=time, count=len(indices))
+        counts[(day, time)] = {'bookings': reserved}
+        for index in indices[reserved:]:
+            errors[index] = {'appointment_time': "The selected appointment slot is fully booked or does not exist."}
+        reserved_indices.extend(indices[:reserved])
+    if not reserved_indices:
+        db.session.commit()
+        return 0, errors
+
+    new_persons = {}
+    for index in reserved_indices:
+        booking = bookings[index]
+        email = email_key(booking['email1'])
+        if email not in person_ids and email not in new_persons:
+            new_persons[email] = {'last_name': booking['last_name'], 'first_name': booking['first_name'],
+                                  'email': booking['email1'], 'tel': booking['tel'],
+                                  'birthdate': booking['birthdate'], 'gender': booking['gender'],
+                                  'street': booking['street'], 'number': booking['number'],
+                                  'post_code': booking['post_code'], 'city': booking['city'],
+                                  'country': booking['country'], 'passport_number': booking['passport']}
+    if new_persons:
+        db.session.execute(insert(Person.__table__), list(new_persons.values()))
+        person_ids.update({email_key(email): person_id for email, person_id in
+                           db.session.query(Person.email, Person.person_id)
+                           .filter(Person.email.in_([person['email'] for person in new_persons.values()])).all()})
+
+    appointments = []
+    mails = []
+    for index in reserved_indices:
+        booking = bookings[index]
+        appointment_id = new_public_id()
+        appointments.append({'appointment_id': appointment_id, 'person_id': person_ids[email_key(booking['email1'])],
+                             'appointment_day': parse_date(booking['appointment_day']),
+                             'appointment_time': parse_time(booking['appointment_time'])})
+        mails.append(booking_confirmation_mail(person=booking, appointment_id=appointment_id))
+    db.session.execute(insert(Appointment.__table__), appointments)
+    queue_mails(mails=mails)
+    count_stats(counts=counts)
+    db.session.commit()
+    return len(appointments), errors
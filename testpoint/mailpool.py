@@ -0,0 +1,236 @@
+import os
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class PooledConnection:
+    """
+    Authenticated SMTP session kept open by the SMTPConnectionPool.
+    """
+
+    def __init__(self, server: smtplib.SMTP) -> None:
+        self.server = server
+        self.last_used = time.monotonic()
+        self.messages_sent = 0
+
+    def close(self) -> None:
+        """
+        Close the session, ignoring errors of connections the server already dropped.
+        :return: None.
+        """
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP sessions that are reused across messages instead of doing a TLS handshake and login
+    for every single email.
+    """
+
+    def __init__(self, host: str, port: str, user: str, password: str, size: int = 2, max_idle: float = 60.0,
+                 check_after: float = 5.0, max_messages: int = 100, security: str = 'ssl') -> None:
+        """
+        :param host: SMTP server as string.
+        :param port: SMTP port as string.
+        :param user: Login name for the SMTP server as string.
+        :param password: Password for the SMTP server as string.
+        :param security: Transport security, ssl for implicit TLS, starttls or none for plain local servers.
+        :param size: Maximum number of open sessions.
+        :param max_idle: Seconds after which an idle session is closed instead of reused.
+        :param check_after: Seconds of idleness after which a session is checked with NOOP before it is reused.
+        :param max_messages: Number of messages after which a session is replaced by a fresh one.
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.max_messages = max_messages
+        if security not in ('ssl', 'starttls', 'none'):
+            raise ValueError(f"Unsupported SMTP security {security}.")
+        self.security = security
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        """
+        Drop all sessions and statistics, e.g. after the pool was inherited by a forked worker process.
+        :return: None.
+        """
+        self._pid = os.getpid()
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._stats = {'checkouts': 0, 'reuses': 0, 'connects': 0, 'reconnects': 0, 'failures': 0,
+                       'messages': 0, 'handshake_seconds': 0.0}
+
+    def _connect(self) -> PooledConnection:
+        """
+        Open a new SMTP session including TLS handshake and login.
+        :return: New pooled connection.
+        """
+        start = time.perf_counter()
+        if self.security == 'ssl':
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(self.host, self.port)
+        try:
+            if self.security == 'starttls':
+                server.starttls(context=ssl.create_default_context())
+            server.login(self.user, self.password)
+        except BaseException:
+            server.close()
+            raise
+        with self._lock:
+            self._stats['connects'] += 1
+            self._stats['handshake_seconds'] += time.perf_counter() - start
+        return PooledConnection(server=server)
+
+    @staticmethod
+    def _is_alive(connection: PooledConnection) -> bool:
+        """
+        Check if the server still accepts commands on the given session.
+        :param connection: Pooled connection to check.
+        :return: True if the server answered the NOOP, False otherwise.
+        """
+        try:
+            return connection.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self) -> PooledConnection:
+        """
+        Take an idle session from the pool, replacing stale ones, or open a new session.
+        :return: Usable pooled connection.
+        """
+        with self._lock:
+            self._stats['checkouts'] += 1
+            connection = self._idle.pop() if self._idle else None
+        while connection is not None:
+            idle_for = time.monotonic() - connection.last_used
+            if idle_for < self.max_idle and (idle_for < self.check_after or self._is_alive(connection)):
+                with self._lock:
+                    self._stats['reuses'] += 1
+                return connection
+            connection.close()
+            with self._lock:
+                self._stats['reconnects'] += 1
+                connection = self._idle.pop() if self._idle else None
+        return self._connect()
+
+    def _checkin(self, connection: PooledConnection) -> None:
+        """
+        Return a session to the pool or close it if it has sent too many messages.
+        :param connection: Pooled connection to return.
+        :return: None.
+        """
+        connection.last_used = time.monotonic()
+        if connection.messages_sent >= self.max_messages:
+            connection.close()
+            return
+        with self._lock:
+            self._idle.append(connection)
+
+    def _discard(self, connection: PooledConnection) -> None:
+        """
+        Close a session that failed on the transport level instead of returning it to the pool.
+        :param connection: Pooled connection to discard.
+        :return: None.
+        """
+        connection.server.close()
+        with self._lock:
+            self._stats['failures'] += 1
+
+    @contextmanager
+    def connection(self) -> Iterator[PooledConnection]:
+        """
+        Borrow a session from the pool for the duration of the with block. Sessions that failed are discarded.
+        :return: Iterator yielding a pooled connection.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        with self._slots:
+            connection = self._checkout()
+            try:
+                yield connection
+            except smtplib.SMTPServerDisconnected:
+                self._discard(connection)
+                raise
+            except smtplib.SMTPException:
+                self._checkin(connection)
+                raise
+            except OSError:
+                self._discard(connection)
+                raise
+            except BaseException:
+                self._checkin(connection)
+                raise
+            self._checkin(connection)
+
+    def send(self, from_addr: str, messages: list[tuple[str, str]]) -> dict[int, smtplib.SMTPException]:
+        """
+        Send one or more messages over a single session. A session the server dropped in the meantime is replaced
+        once before giving up. Messages the server rejects do not stop the remaining messages from being sent. If
+        sending fails after some messages went out, the error carries the indexes of the delivered messages as
+        delivered and the rejected messages as rejected, so they are not sent again.
+        :param from_addr: Sender address as string.
+        :param messages: List of tuples with recipient address and the full message as string.
+        :return: Dictionary mapping the index of each rejected message to the error of the server.
+        """
+        errors = {}
+        position = 0
+        retried = False
+        try:
+            while position < len(messages):
+                try:
+                    with self.connection() as connection:
+                        while position < len(messages):
+                            send_to, message = messages[position]
+                            try:
+                                connection.server.sendmail(from_addr, send_to, message)
+                                connection.messages_sent += 1
+                                with self._lock:
+                                    self._stats['messages'] += 1
+                            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                                    smtplib.SMTPDataError) as e:
+                                errors[position] = e
+                            position += 1
+                except smtplib.SMTPServerDisconnected:
+                    if retried:
+                        raise
+                    retried = True
+        except (smtplib.SMTPException, OSError) as e:
+            e.delivered = [index for index in range(position) if index not in errors]
+            e.rejected = errors
+            raise
+        return errors
+
+    def close(self) -> None:
+        """
+        Close all idle sessions.
+        :return: None.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> dict:
+        """
+        Returns usage statistics of the pool, including the reuse rate and the average handshake time.
+        :return: Statistics as dictionary.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['reuse_rate'] = stats['reuses'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        stats['avg_handshake_seconds'] = stats['handshake_seconds'] / stats['connects'] if stats['connects'] else 0.0
+        return stats
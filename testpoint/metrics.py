@@ -0,0 +1,127 @@
+import ipaddress
+import os
+import time
+from flask import Blueprint, Flask, Response, abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .config import METRICS_DIR, METRICS_ENDPOINT, METRICS_ALLOWED_ADDRESSES, LOGIN_PROXIES
+
+if METRICS_DIR:
+    # prometheus_client picks the multiprocess mode on import, so the directory has to be set beforehand.
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS_DIR)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, \
+    generate_latest, multiprocess
+
+metrics = Blueprint('metrics', __name__)
+METRICS_NETWORKS = [ipaddress.ip_network(address, strict=False) for address in METRICS_ALLOWED_ADDRESSES]
+
+REQUEST_SECONDS = Histogram('testpoint_request_seconds', 'Request latency per endpoint.',
+                            ['endpoint', 'method', 'status'])
+SQL_STATEMENTS = Histogram('testpoint_sql_statements_per_request', 'Number of SQL statements per request.',
+                           ['endpoint'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+SQL_SECONDS = Histogram('testpoint_sql_seconds_per_request', 'Time spent in SQL statements per request.',
+                        ['endpoint'])
+MAIL_SECONDS = Histogram('testpoint_send_mail_seconds', 'Time spent sending emails.')
+MAIL_DELIVERY_SECONDS = Histogram('testpoint_mail_delivery_seconds', 'Time from queueing an email until it was sent.',
+                                  buckets=(1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600, 14400))
+MAIL_QUEUE_DEPTH = Gauge('testpoint_mail_queue_depth', 'Number of unsent emails by state.', ['state'],
+                         multiprocess_mode='livemax')
+QUEUED_MAILS = Counter('testpoint_queued_mails', 'Number of delivery attempts of queued emails.', ['outcome'])
+QR_CODE_SECONDS = Histogram('testpoint_create_qr_code_seconds', 'Time spent creating QRCodes.')
+BOOKINGS = Counter('testpoint_bookings', 'Number of booking attempts.', ['outcome'])
+RESULTS = Counter('testpoint_results', 'Number of results entered.', ['mode'])
+LOGINS = Counter('testpoint_logins', 'Number of login attempts.', ['outcome'])
+LOGIN_THROTTLED = Counter('testpoint_login_throttled', 'Number of login attempts rejected by the throttle.',
+                          ['bucket'])
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Remembers when a SQL statement was sent to the database.
+    :return: None.
+    """
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Adds a finished SQL statement and its duration to the statistics of the current request.
+    :return: None.
+    """
+    seconds = time.perf_counter() - conn.info['statement_start'].pop()
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += seconds
+
+
+def start_request_timer() -> None:
+    """
+    Starts measuring time and SQL statements of the current request.
+    :return: None.
+    """
+    g.request_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def observe_request(response: Response) -> Response:
+    """
+    Records latency and SQL statistics of the finished request.
+    :param response: Response of the request.
+    :return: Unchanged response.
+    """
+    if 'request_start' not in g or request.endpoint == 'metrics.export':
+        return response
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.labels(endpoint=endpoint, method=request.method, status=response.status_code) \
+        .observe(time.perf_counter() - g.request_start)
+    SQL_STATEMENTS.labels(endpoint=endpoint).observe(g.sql_statements)
+    SQL_SECONDS.labels(endpoint=endpoint).observe(g.sql_seconds)
+    return response
+
+
+def init_metrics(app: Flask) -> None:
+    """
+    Instruments all requests of the given application and registers the /metrics endpoint unless it is disabled.
+    :param app: Flask application.
+    :return: None.
+    """
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    if METRICS_ENDPOINT:
+        app.register_blueprint(metrics, url_prefix='/')
+
+
+def metrics_allowed() -> bool:
+    """
+    Checks whether the client of the current request may read the metrics. Requests forwarded by a proxy that is not
+    configured in PROXIES are refused, as their address is the one of the proxy.
+    :return: True if the client address is in one of the allowed networks.
+    """
+    if not LOGIN_PROXIES and 'X-Forwarded-For' in request.headers:
+        return False
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_NETWORKS)
+
+
+@metrics.route('/metrics')
+def export():
+    """
+    Exposes all metrics in Prometheus text format, aggregated over all worker processes if a metrics directory is
+    configured. Only clients from the allowed addresses may read them.
+    :return: Metrics as plain text.
+    """
+    if not metrics_allowed():
+        abort(403)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
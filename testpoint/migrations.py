@@ -0,0 +1,251 @@
+from typing import Callable, NamedTuple
+from sqlalchemy import Table, func, insert, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from .config import DB_MIGRATION_LOCK_TIMEOUT
+from .models import Result, SchemaVersion
+from .stats import rebuild_stats
+from .storage import db
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def index_exists(connection: Connection, table: str, name: str) -> bool:
+    """
+    Check if an index or unique constraint with the given name exists on a table.
+    :param connection: Database connection.
+    :param table: Name of the table.
+    :param name: Name of the index or unique constraint.
+    :return: True if the index exists, False otherwise.
+    """
+    inspector = inspect(connection)
+    names = {index['name'] for index in inspector.get_indexes(table)}
+    names.update(constraint['name'] for constraint in inspector.get_unique_constraints(table))
+    return name in names
+
+
+def add_index(connection: Connection, table: str, name: str, columns: list[str], unique: bool = False) -> None:
+    """
+    Adds an index to a table unless it exists already. MySQL builds the index in place without locking the table, so
+    bookings and result entries continue while the index is built.
+    :param connection: Database connection.
+    :param table: Name of the table.
+    :param name: Name of the index.
+    :param columns: Indexed columns in order.
+    :param unique: True to add a unique index.
+    :return: None.
+    """
+    if index_exists(connection=connection, table=table, name=name):
+        return
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    quote = connection.dialect.identifier_preparer.quote
+    table = quote(table)
+    columns = ', '.join(quote(column) for column in columns)
+    if connection.dialect.name == 'mysql':
+        connection.execute(text(f"ALTER TABLE {table} ADD {kind} {quote(name)} ({columns}), "
+                                f"ALGORITHM=INPLACE, LOCK=NONE"))
+    else:
+        connection.execute(text(f"CREATE {kind} {quote(name)} ON {table} ({columns})"))
+
+
+def column_exists(connection: Connection, table: str, column: str) -> bool:
+    """
+    Check if a table has a column with the given name.
+    :param connection: Database connection.
+    :param table: Name of the table.
+    :param column: Name of the column.
+    :return: True if the column exists, False otherwise.
+    """
+    return column in {existing['name'] for existing in inspect(connection).get_columns(table)}
+
+
+def rebuild_sqlite_table(connection: Connection, table: Table) -> None:
+    """
+    Recreates a table on SQLite with the columns and indexes declared in models, copying all rows of the columns the
+    old and new table have in common. SQLite cannot drop columns that are part of a constraint otherwise.
+    :param connection: Database connection.
+    :param table: Table as declared in models.
+    :return: None.
+    """
+    inspector = inspect(connection)
+    old_columns = {column['name'] for column in inspector.get_columns(table.name)}
+    columns = ', '.join(column.name for column in table.columns if column.name in old_columns)
+    for index in inspector.get_indexes(table.name):
+        connection.execute(text(f"DROP INDEX {index['name']}"))
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_rebuild"))
+    table.create(bind=connection)
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_rebuild"))
+    connection.execute(text(f"DROP TABLE {table.name}_rebuild"))
+
+
+def add_result_appointment_key(connection: Connection, chunk_size: int = 1000) -> None:
+    """
+    Adds the integer reference from results to the internal ID of their appointment and fills it for all existing
+    results in chunks of result IDs, committing after each chunk so no long-running transaction blocks other writers.
+    :param connection: Database connection.
+    :param chunk_size: Number of results updated per transaction.
+    :return: None.
+    """
+    mysql = connection.dialect.name == 'mysql'
+    if not column_exists(connection=connection, table='result', column='appointment_key'):
+        if mysql:
+            connection.execute(text("ALTER TABLE result ADD COLUMN appointment_key INTEGER NULL, "
+                                    "ALGORITHM=INPLACE, LOCK=NONE"))
+        else:
+            connection.execute(text("ALTER TABLE result ADD COLUMN appointment_key INTEGER "
+                                    "REFERENCES appointment (id)"))
+        connection.commit()
+    if column_exists(connection=connection, table='result', column='appointment_id'):
+        last = 0
+        while True:
+            keys = connection.execute(text("SELECT id FROM result WHERE id > :last ORDER BY id LIMIT :size"),
+                                      {'last': last, 'size': chunk_size}).scalars().all()
+            if not keys:
+                break
+            connection.execute(text("UPDATE result SET appointment_key = (SELECT appointment.id FROM appointment "
+                                    "WHERE appointment.appointment_id = result.appointment_id) "
+                                    "WHERE id BETWEEN :first AND :last AND appointment_key IS NULL"),
+                               {'first': keys[0], 'last': keys[-1]})
+            connection.commit()
+            last = keys[-1]
+    add_index(connection=connection, table='result', name='uq_result_appointment_key', columns=['appointment_key'],
+              unique=True)
+    foreign_keys = inspect(connection).get_foreign_keys('result')
+    if mysql and not any(fk['constrained_columns'] == ['appointment_key'] for fk in foreign_keys):
+        # Adding a foreign key in place requires the row check to be skipped, the backfill guarantees the references.
+        connection.execute(text("SET SESSION foreign_key_checks = 0"))
+        connection.execute(text("ALTER TABLE result ADD CONSTRAINT fk_result_appointment_key FOREIGN KEY "
+                                "(appointment_key) REFERENCES appointment (id), ALGORITHM=INPLACE, LOCK=NONE"))
+        connection.execute(text("SET SESSION foreign_key_checks = 1"))
+
+
+def drop_result_appointment_id(connection: Connection) -> None:
+    """
+    Drops the old reference from results to the public appointment ID including its foreign key and unique index.
+    :param connection: Database connection.
+    :return: None.
+    """
+    if not column_exists(connection=connection, table='result', column='appointment_id'):
+        return
+    if connection.dialect.name != 'mysql':
+        rebuild_sqlite_table(connection=connection, table=Result.__table__)
+        return
+    for fk in inspect(connection).get_foreign_keys('result'):
+        if fk['constrained_columns'] == ['appointment_id']:
+            connection.execute(text(f"ALTER TABLE result DROP FOREIGN KEY {fk['name']}, ALGORITHM=INPLACE, LOCK=NONE"))
+    connection.execute(text("ALTER TABLE result DROP COLUMN appointment_id, ALGORITHM=INPLACE, LOCK=NONE"))
+
+
+def add_mail_outbox_columns(connection: Connection) -> None:
+    """
+    Adds the retry schedule, delivery claim, last error and dead letter time to the queued emails and schedules all
+    unsent emails for delivery. The new columns are nullable, so MySQL adds them in place.
+    :param connection: Database connection.
+    :return: None.
+    """
+    columns = {'next_attempt_at': 'DATETIME NULL', 'claim': 'VARCHAR(32) NULL', 'last_error': 'VARCHAR(300) NULL',
+               'dead_at': 'DATETIME NULL'}
+    for column, definition in columns.items():
+        if column_exists(connection=connection, table='mail_queue', column=column):
+            continue
+        if connection.dialect.name == 'mysql':
+            connection.execute(text(f"ALTER TABLE mail_queue ADD COLUMN {column} {definition}, "
+                                    f"ALGORITHM=INPLACE, LOCK=NONE"))
+        else:
+            connection.execute(text(f"ALTER TABLE mail_queue ADD COLUMN {column} {definition}"))
+        connection.commit()
+    connection.execute(text("UPDATE mail_queue SET next_attempt_at = created_at "
+                            "WHERE sent_at IS NULL AND next_attempt_at IS NULL"))
+    add_index(connection=connection, table='mail_queue', name='ix_mail_queue_due',
+              columns=['sent_at', 'next_attempt_at', 'id'])
+
+
+MIGRATIONS = [
+    Migration(version=1,
+              description='Unique index on person and slot of appointments',
+              apply=lambda connection: add_index(connection=connection, table='appointment',
+                                                 name='uq_appointment_person_slot',
+                                                 columns=['person_id', 'appointment_day', 'appointment_time'],
+                                                 unique=True)),
+    Migration(version=2,
+              description='Index on verified flag and slot of appointments for the staff queue',
+              apply=lambda connection: add_index(connection=connection, table='appointment',
+                                                 name='ix_appointment_verified_slot',
+                                                 columns=['verified', 'appointment_day', 'appointment_time', 'id'])),
+    Migration(version=3,
+              description='Index on person of results',
+              apply=lambda connection: add_index(connection=connection, table='result', name='ix_result_person_id',
+                                                 columns=['person_id'])),
+    Migration(version=4,
+              description='Index on username of users',
+              apply=lambda connection: add_index(connection=connection, table='user', name='ix_user_username',
+                                                 columns=['username'])),
+    Migration(version=5,
+              description='Integer reference from results to appointments',
+              apply=add_result_appointment_key),
+    Migration(version=6,
+              description='Drop public appointment ID from results',
+              apply=drop_result_appointment_id),
+    Migration(version=7,
+              description='Index on test day of results for exports',
+              apply=lambda connection: add_index(connection=connection, table='result', name='ix_result_test_day',
+                                                 columns=['test_day', 'test_time', 'id'])),
+    Migration(version=8,
+              description='Backfill daily statistics rollups',
+              apply=rebuild_stats),
+    Migration(version=9,
+              description='Retry schedule and dead letters of queued emails',
+              apply=add_mail_outbox_columns),
+]
+
+
+def get_schema_version(connection: Connection) -> int:
+    """
+    Returns the version of the latest migration applied to the database.
+    :param connection: Database connection.
+    :return: Schema version, 0 if no migration was applied yet.
+    """
+    return connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def pending_migrations() -> list[Migration]:
+    """
+    Returns the migrations that were not applied to the database yet.
+    :return: List of migrations in the order they have to be applied.
+    """
+    with db.engine.connect() as connection:
+        if not inspect(connection).has_table(SchemaVersion.__tablename__):
+            return list(MIGRATIONS)
+        version = get_schema_version(connection=connection)
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def upgrade_schema() -> list[Migration]:
+    """
+    Creates all missing tables and applies all pending migrations in order, recording each one in the schema_version
+    table. Migrations only change what is missing and may commit in between, so a migration that was interrupted can
+    simply be applied again. On MySQL every migration waits at most DB_MIGRATION_LOCK_TIMEOUT seconds for
+    transactions holding the table, so a long-running transaction makes the migration fail instead of queueing all
+    requests behind it.
+    :return: List of the applied migrations.
+    """
+    db.create_all()
+    applied = []
+    for migration in pending_migrations():
+        try:
+            with db.engine.connect() as connection:
+                if connection.dialect.name == 'mysql':
+                    connection.execute(text(f"SET SESSION lock_wait_timeout = {DB_MIGRATION_LOCK_TIMEOUT}"))
+                migration.apply(connection)
+                connection.execute(insert(SchemaVersion).values(version=migration.version,
+                                                                description=migration.description))
+                connection.commit()
+        except IntegrityError:
+            # Another process applied the same migration concurrently.
+            continue
+        applied.append(migration)
+    return applied
@@ -1,6 +1,6 @@
 from flask_login import UserMixin
 from sqlalchemy import func
-from .storage import db
+from .storage import db, IsoDate, IsoTime
 
 
 class Person(db.Model):
@@ -9,7 +9,7 @@ class Person(db.Model):
     first_name = db.Column('first_name', db.String(100), default=None)
     email = db.Column('email', db.String(50), unique=True)
     tel = db.Column('tel', db.String(15), default=None)
-    birthdate = db.Column('birthdate', db.Date, default=None)
+    birthdate = db.Column('birthdate', IsoDate, default=None)
     gender = db.Column('gender', db.String(1), default=None)
     street = db.Column('street', db.String(100), default=None)
     number = db.Column('number', db.String(5), default=None)
@@ -18,46 +18,118 @@ class Person(db.Model):
     country = db.Column('country', db.String(50), default=None)
     passport = db.Column('passport_number', db.String(10), default=None)
     created_at = db.Column('created_at', db.DateTime, default=func.now())
-    appointments = db.relationship('Appointment')
+    appointments = db.relationship('Appointment', back_populates='person')
     results = db.relationship('Result')
 
 
 class Appointment(db.Model):
+    __table_args__ = (db.UniqueConstraint('person_id', 'appointment_day', 'appointment_time',
+                                          name='uq_appointment_person_slot'),
+                      db.Index('ix_appointment_verified_slot', 'verified', 'appointment_day', 'appointment_time',
+                               'id'))
     id = db.Column('id', db.Integer(), primary_key=True)
     appointment_id = db.Column('appointment_id', db.String(150), unique=True)
     person_id = db.Column('person_id', db.Integer(), db.ForeignKey('person.person_id'))
-    appointment_day = db.Column('appointment_day', db.Date, default=None)
-    appointment_time = db.Column('appointment_time', db.Time, default=None)
+    appointment_day = db.Column('appointment_day', IsoDate, default=None)
+    appointment_time = db.Column('appointment_time', IsoTime, default=None)
     verified = db.Column('verified', db.String(1), default='N')
     created_at = db.Column('created_at', db.DateTime, default=func.now())
+    person = db.relationship('Person', back_populates='appointments')
     result = db.relationship('Result')
 
 
 class Result(db.Model):
+    __table_args__ = (db.UniqueConstraint('appointment_key', name='uq_result_appointment_key'),
+                      db.Index('ix_result_person_id', 'person_id'),
+                      db.Index('ix_result_test_day', 'test_day', 'test_time', 'id'))
     id = db.Column('id', db.Integer(), primary_key=True)
     result_id = db.Column('result_id', db.String(150), unique=True)
-    appointment_id = db.Column('appointment_id', db.String(150), db.ForeignKey('appointment.appointment_id'), unique=True)
+    appointment_key = db.Column('appointment_key', db.Integer(),
+                                db.ForeignKey('appointment.id', name='fk_result_appointment_key'))
     person_id = db.Column('person_id', db.Integer(), db.ForeignKey('person.person_id'))
     result = db.Column('result', db.String(8), default=None)
-    test_day = db.Column('test_day', db.Date, default=None)
-    test_time = db.Column('test_time', db.Time, default=None)
+    test_day = db.Column('test_day', IsoDate, default=None)
+    test_time = db.Column('test_time', IsoTime, default=None)
     created_at = db.Column('created_at', db.DateTime, default=func.now())
 
 
+class Slot(db.Model):
+    __table_args__ = (db.UniqueConstraint('slot_day', 'slot_time', 'lane', name='uq_slot_day_time_lane'),)
+    id = db.Column('id', db.Integer(), primary_key=True)
+    slot_day = db.Column('slot_day', IsoDate, nullable=False)
+    slot_time = db.Column('slot_time', IsoTime, nullable=False)
+    lane = db.Column('lane', db.Integer(), nullable=False)
+    capacity = db.Column('capacity', db.Integer(), nullable=False)
+    booked = db.Column('booked', db.Integer(), nullable=False, default=0)
+
+
+class DailyStats(db.Model):
+    __tablename__ = 'daily_stats'
+    __table_args__ = (db.UniqueConstraint('stats_day', 'stats_time', name='uq_daily_stats_day_time'),)
+    id = db.Column('id', db.Integer(), primary_key=True)
+    stats_day = db.Column('stats_day', IsoDate, nullable=False)
+    stats_time = db.Column('stats_time', IsoTime, nullable=False)
+    bookings = db.Column('bookings', db.Integer(), nullable=False, default=0)
+    verified = db.Column('verified', db.Integer(), nullable=False, default=0)
+    positives = db.Column('positives', db.Integer(), nullable=False, default=0)
+    negatives = db.Column('negatives', db.Integer(), nullable=False, default=0)
+
+
+class MailQueue(db.Model):
+    __tablename__ = 'mail_queue'
+    __table_args__ = (db.Index('ix_mail_queue_pending', 'sent_at', 'id'),
+                      db.Index('ix_mail_queue_due', 'sent_at', 'next_attempt_at', 'id'))
+    id = db.Column('id', db.Integer(), primary_key=True)
+    kind = db.Column('kind', db.String(30), nullable=False)
+    recipient = db.Column('recipient', db.String(50), nullable=False)
+    payload = db.Column('payload', db.Text(), nullable=False)
+    attempts = db.Column('attempts', db.Integer(), nullable=False, default=0)
+    created_at = db.Column('created_at', db.DateTime, default=func.now())
+    sent_at = db.Column('sent_at', db.DateTime, default=None)
+    next_attempt_at = db.Column('next_attempt_at', db.DateTime, default=func.now())
+    claim = db.Column('claim', db.String(32), default=None)
+    last_error = db.Column('last_error', db.String(300), default=None)
+    dead_at = db.Column('dead_at', db.DateTime, default=None)
+
+
+class QueueEvent(db.Model):
+    __tablename__ = 'queue_event'
+    id = db.Column('id', db.Integer(), primary_key=True)
+    kind = db.Column('kind', db.String(10), nullable=False)
+    appointment_key = db.Column('appointment_key', db.Integer(), nullable=False)
+    created_at = db.Column('created_at', db.DateTime, default=func.now())
+
+
+class WebSession(db.Model):
+    __tablename__ = 'web_session'
+    __table_args__ = (db.Index('ix_web_session_expires_at', 'expires_at'),)
+    id = db.Column('id', db.String(64), primary_key=True)
+    data = db.Column('data', db.Text(), nullable=False)
+    expires_at = db.Column('expires_at', db.DateTime, nullable=False)
+
+
 class Staff(db.Model):
     id = db.Column('id', db.Integer(), primary_key=True)
     last_name = db.Column('last_name', db.String(100), default=None)
     first_name = db.Column('first_name', db.String(100), default=None)
     email = db.Column('email', db.String(50), unique=True)
     tel = db.Column('tel', db.String(15), default=None)
-    birthdate = db.Column('birthdate', db.Date, default=None)
+    birthdate = db.Column('birthdate', IsoDate, default=None)
     admin = db.Column('admin', db.String(1), default='N')
     created_at = db.Column('created_at', db.DateTime, default=func.now())
     users = db.relationship('User')
 
 
 class User(db.Model, UserMixin):
+    __table_args__ = (db.Index('ix_user_username', 'username'),)
     id = db.Column('id', db.Integer(), primary_key=True)
     username = db.Column('username', db.String(50), db.ForeignKey('staff.email'))
     password = db.Column('password', db.String(300), default=None)
     created_at = db.Column('created_at', db.DateTime, default=func.now())
+
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column('version', db.Integer(), primary_key=True, autoincrement=False)
+    description = db.Column('description', db.String(200), default=None)
+    applied_at = db.Column('applied_at', db.DateTime, default=func.now())
@@ -1,16 +1,34 @@
+import json
 import smtplib
 import ssl
+import time
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from typing import Optional
-from .config import EMAIL_SERVER, EMAIL_USER, EMAIL_PW, EMAIL_PORT, WEBSITE_URL
-import qrcode
-import io
-from .storagehandler import get_person_id, get_appointment_id
+from .config import EMAIL_SERVER, EMAIL_USER, EMAIL_PW, EMAIL_PORT, EMAIL_SECURITY, EMAIL_POOL_SIZE, \
+    EMAIL_POOL_MAX_IDLE, QRCODE_WORKERS, QRCODE_CACHE_SIZE, QRCODE_FORMAT, QRCODE_BOX_SIZE, QRCODE_BORDER, \
+    WEBSITE_URL, OUTBOX_LEASE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY, OUTBOX_RETRY_MAX_DELAY
+from .mailpool import SMTPConnectionPool
+from .metrics import MAIL_DELIVERY_SECONDS, MAIL_SECONDS, QR_CODE_SECONDS, QUEUED_MAILS
+from .qrrender import QRCodeRenderer
+from .storagehandler import claim_mails, mark_mails_sent, mark_mails_failed
 from datetime import datetime
 
+smtp_pool = SMTPConnectionPool(host=EMAIL_SERVER,
+                               port=EMAIL_PORT,
+                               user=EMAIL_USER,
+                               password=EMAIL_PW,
+                               size=EMAIL_POOL_SIZE,
+                               max_idle=EMAIL_POOL_MAX_IDLE,
+                               security=EMAIL_SECURITY)
+qr_renderer = QRCodeRenderer(workers=QRCODE_WORKERS,
+                             cache_size=QRCODE_CACHE_SIZE,
+                             image_format=QRCODE_FORMAT,
+                             box_size=QRCODE_BOX_SIZE,
+                             border=QRCODE_BORDER)
+
 
 def create_booking_confirmation_message(first_name: str, appointment_day: str, appointment_time: str) -> str:
     """
@@ -40,26 +58,24 @@ def create_booking_confirmation_message(first_name: str, appointment_day: str, a
     return message
 
 
+@QR_CODE_SECONDS.time()
 def create_qr_code(data: str) -> bytes:
     """
     Creates QRCode for given string.
     :param data: Data as string.
-    :return: Bytes of the QRCode png image.
+    :return: Bytes of the QRCode image.
     """
-    with io.BytesIO() as output:
-        img = qrcode.make(data=data)
-        img.save(output, format="png")
-        return output.getvalue()
+    return qr_renderer.render(data=data)
 
 
-def send_mail(send_to: str, subject: str, message: str, qr_code_url: Optional[str] = None) -> None:
+def create_mail(send_to: str, subject: str, message: str, qr_code_url: Optional[str] = None) -> MIMEMultipart:
     """
-    Send an email with given content.
+    Create an email with given content.
     :param send_to: Recipient email address as string.
     :param subject: Subject of the email as string.
     :param message: Body of the email as html string.
     :param qr_code_url: URL to create QRCode for as string, None if no URL is provided None.
-    :return: None.
+    :return: Email as MIMEMultipart object.
     """
     msg = MIMEMultipart()
     msg['From'] = EMAIL_USER
@@ -70,44 +86,45 @@ def send_mail(send_to: str, subject: str, message: str, qr_code_url: Optional[st
     msg.attach(msg_text)
 
     if qr_code_url:
-        msg_img = MIMEImage(create_qr_code(qr_code_url), name="TestPointBookingConfirmationQRCode")
+        msg_img = MIMEImage(create_qr_code(qr_code_url), _subtype=qr_renderer.subtype,
+                            name="TestPointBookingConfirmationQRCode")
         msg_img.add_header('Content-ID', '<qrcode>')
         msg.attach(msg_img)
+    return msg
 
-    context = ssl.create_default_context()
+
+@MAIL_SECONDS.time()
+def send_mails(mails: list[MIMEMultipart]) -> dict[int, Exception]:
+    """
+    Send several emails over one pooled SMTP session.
+    :param mails: List of emails as created by create_mail.
+    :return: Dictionary mapping the index of each email the server rejected to the error.
+    """
     try:
-        with smtplib.SMTP_SSL(EMAIL_SERVER, EMAIL_PORT, context=context) as server:
-            server.login(EMAIL_USER, EMAIL_PW)
-            server.sendmail(EMAIL_USER, send_to, msg.as_string())
-            server.quit()
+        return smtp_pool.send(from_addr=EMAIL_USER, messages=[(mail['To'], mail.as_string()) for mail in mails])
     except ssl.SSLCertVerificationError as e:
         print(e)
         print(f'Could not reach server due to above error.')
-        raise ssl.SSLCertVerificationError()
+        raise
 
 
-def send_booking_confirmation(email: str, first_name: str, appointment_day: str, appointment_time: str) -> None:
+def create_booking_confirmation_mail(email: str, first_name: str, appointment_day: str, appointment_time: str,
+                                     appointment_id: str) -> MIMEMultipart:
     """
-    Sends a booking confirmation for the given email, name and appointment details.
+    Creates the booking confirmation email with the QRCode for the given appointment.
     :param email: Email address of recipient as string.
     :param first_name: First name of the recipient as string.
     :param appointment_day: Date of the appointment as string.
     :param appointment_time: Time of the appointment as string.
-    :return: None.
+    :param appointment_id: ID of the booked appointment as string.
+    :return: Email as MIMEMultipart object.
     """
-    person_id = get_person_id(email=email)
-    appointment_id = get_appointment_id(person_id=person_id,
-                                        appointment_day=appointment_day,
-                                        appointment_time=appointment_time)
+    qr_code_url = f"{WEBSITE_URL}/appinfo/{appointment_id}"
     message = create_booking_confirmation_message(first_name=first_name,
                                                   appointment_day=appointment_day,
                                                   appointment_time=appointment_time)
     subject = "Your booking confirmation for your appointment at TestPoint!"
-    qr_code_url = f"{WEBSITE_URL}/appinfo/{appointment_id}"
-    try:
-        send_mail(send_to=email, subject=subject, message=message, qr_code_url=qr_code_url)
-    except ssl.SSLCertVerificationError:
-        raise ssl.SSLCertVerificationError()
+    return create_mail(send_to=email, subject=subject, message=message, qr_code_url=qr_code_url)
 
 
 def create_result_notification_message(first_name: str, appointment_id: str) -> str:
@@ -133,18 +150,103 @@ def create_result_notification_message(first_name: str, appointment_id: str) ->
     return message
 
 
-def send_test_result_notification(email: str, first_name: str, appointment_id: str) -> None:
+def create_result_notification_mail(email: str, first_name: str, appointment_id: str) -> MIMEMultipart:
     """
-    Sends a notification email containing the link to check the test result.
-    :param email: Recipient of the email.
-    :param first_name: First name of the recipient.
-    :param appointment_id: ID of the appointment tied to the result.
-    :return: None.
+    Creates the email notifying a person that their test result is available.
+    :param email: Email address of recipient as string.
+    :param first_name: First name of the recipient as string.
+    :param appointment_id: ID of the appointment tied to the result as string.
+    :return: Email as MIMEMultipart object.
     """
     subject = "Your test result is available!"
     message = create_result_notification_message(first_name=first_name, appointment_id=appointment_id)
+    return create_mail(send_to=email, subject=subject, message=message)
+
+
+MAIL_KINDS = {'booking_confirmation': create_booking_confirmation_mail,
+              'result_notification': create_result_notification_mail}
+
+
+def retry_delay(attempts: int) -> Optional[int]:
+    """
+    Returns when a queued email is sent again after a failed attempt. The delay doubles with every attempt.
+    :param attempts: Number of failed attempts including the current one.
+    :return: Seconds until the next attempt or None if the email is moved to the dead letters.
+    """
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        return None
+    return min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_DELAY)
+
+
+def record_failures(failures: dict[int, tuple[Optional[int], str]], claim: str) -> None:
+    """
+    Stores the failed delivery attempts of a batch and counts them by outcome.
+    :param failures: Dictionary mapping the IDs of failed emails to tuples of the seconds until the next attempt or
+    None for dead letters and the error.
+    :param claim: Claim of the batch as returned by claim_mails.
+    :return: None.
+    """
+    mark_mails_failed(failures=failures, claim=claim)
+    dead = sum(1 for delay, error in failures.values() if delay is None)
+    QUEUED_MAILS.labels(outcome='dead').inc(dead)
+    QUEUED_MAILS.labels(outcome='retry').inc(len(failures) - dead)
+
+
+def send_queued_mails(batch_size: int) -> tuple[int, int]:
+    """
+    Claims the queued emails that are due longest and sends them over one pooled SMTP session. The QRCodes of all
+    booking confirmations in the batch are rendered in parallel before the emails are created. Emails the server
+    rejected are scheduled for a retry, emails that cannot be created are moved to the dead letters right away.
+    :param batch_size: Maximum number of emails to send.
+    :return: Tuple of the number of sent and failed emails.
+    """
+    queued, claimed_at = claim_mails(limit=batch_size, lease=OUTBOX_LEASE)
+    if not queued:
+        return 0, 0
+    claim = queued[0].claim
+    started = time.monotonic()
+    failures = {}
+    payloads = {}
+    for mail in queued:
+        try:
+            payloads[mail.id] = json.loads(mail.payload)
+        except ValueError as e:
+            failures[mail.id] = (None, f"Invalid payload: {e}")
+    for mail in queued:
+        if mail.kind == 'booking_confirmation' and mail.id in payloads:
+            qr_renderer.submit(data=f"{WEBSITE_URL}/appinfo/{payloads[mail.id].get('appointment_id')}")
+    sending = []
+    mails = []
+    for mail in queued:
+        if mail.id not in payloads:
+            continue
+        if mail.kind not in MAIL_KINDS:
+            failures[mail.id] = (None, f"Unknown kind {mail.kind}.")
+            continue
+        try:
+            mails.append(MAIL_KINDS[mail.kind](email=mail.recipient, **payloads[mail.id]))
+        except (TypeError, ValueError) as e:
+            failures[mail.id] = (None, f"Invalid payload: {e}")
+            continue
+        sending.append(mail)
+    failed = None
     try:
-        send_mail(send_to=email, subject=subject, message=message)
-    except ssl.SSLCertVerificationError as e:
-        print(e)
-        raise ssl.SSLCertVerificationError()
\ No newline at end of file
+        errors = send_mails(mails=mails) if mails else {}
+    except (OSError, smtplib.SMTPException) as e:
+        # The emails that went out before the server failed must not be sent again.
+        failed = e
+        delivered = set(getattr(e, 'delivered', []))
+        errors = dict(getattr(e, 'rejected', {}))
+        errors.update({index: e for index in range(len(sending)) if index not in delivered and index not in errors})
+    failures.update({sending[index].id: (retry_delay(attempts=sending[index].attempts + 1), repr(error))
+                     for index, error in errors.items()})
+    sent = [mail for index, mail in enumerate(sending) if index not in errors]
+    mark_mails_sent(mail_ids=[mail.id for mail in sent], claim=claim)
+    elapsed = time.monotonic() - started
+    for mail in sent:
+        MAIL_DELIVERY_SECONDS.observe(max(0.0, (claimed_at - mail.created_at).total_seconds()) + elapsed)
+    QUEUED_MAILS.labels(outcome='sent').inc(len(sent))
+    record_failures(failures=failures, claim=claim)
+    if failed is not None:
+        raise failed
+    return len(sent), len(failures)
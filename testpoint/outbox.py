@@ -0,0 +1,91 @@
+import smtplib
+import threading
+from flask import Flask
+from sqlalchemy.exc import SQLAlchemyError
+from .metrics import MAIL_QUEUE_DEPTH
+from .notification import send_queued_mails, smtp_pool
+from .storage import db
+from .storagehandler import get_mail_queue_depth
+
+
+class MailWorker:
+    """
+    Long-running delivery of the queued emails. Every sender thread claims a batch of due emails and sends it over
+    its own pooled SMTP session, so at most concurrency sessions are open at the same time. A sender waits for the
+    interval when nothing is due or the mail server or database failed, the failed emails are retried with backoff.
+    """
+
+    def __init__(self, app: Flask, batch_size: int, concurrency: int, interval: float) -> None:
+        """
+        :param app: Flask application whose database holds the queued emails.
+        :param batch_size: Maximum number of emails sent per SMTP session.
+        :param concurrency: Number of batches sent in parallel.
+        :param interval: Seconds to wait when no email is due.
+        """
+        self.app = app
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.totals = {'sent': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def send(self) -> None:
+        """
+        Sends batches of due emails until the worker is stopped.
+        :return: None.
+        """
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    sent, failed = send_queued_mails(batch_size=self.batch_size)
+                except (OSError, smtplib.SMTPException, SQLAlchemyError):
+                    db.session.rollback()
+                    self.stopping.wait(self.interval)
+                    continue
+                finally:
+                    db.session.remove()
+                with self._lock:
+                    self.totals['sent'] += sent
+                    self.totals['failed'] += failed
+                if sent + failed < self.batch_size:
+                    self.stopping.wait(self.interval)
+
+    def observe_depth(self) -> None:
+        """
+        Updates the queue depth metrics.
+        :return: None.
+        """
+        with self.app.app_context():
+            try:
+                depth = get_mail_queue_depth()
+            except SQLAlchemyError:
+                return
+            finally:
+                db.session.remove()
+        for state, count in depth.items():
+            MAIL_QUEUE_DEPTH.labels(state=state).set(count)
+
+    def run(self) -> None:
+        """
+        Starts the sender threads and updates the queue depth metrics every interval until stop is called. Batches
+        that are being sent are finished before it returns.
+        :return: None.
+        """
+        senders = [threading.Thread(target=self.send, name=f"mail-sender-{number}")
+                   for number in range(self.concurrency)]
+        for sender in senders:
+            sender.start()
+        while not self.stopping.is_set():
+            self.observe_depth()
+            self.stopping.wait(self.interval)
+        for sender in senders:
+            sender.join()
+        smtp_pool.close()
+
+    def stop(self, *args) -> None:
+        """
+        Stops the worker, e.g. as signal handler.
+        :return: None.
+        """
+        self.stopping.set()
@@ -0,0 +1,113 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+from .config import SLOTS_REFRESH, WEBSITE_CACHE_MAX_AGE, WEBSITE_PAGE_CACHE_SIZE
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+# The booking page changes with the availability, which each worker only refreshes every SLOTS_REFRESH seconds anyway.
+APPOINTMENT_MAX_AGE = min(WEBSITE_CACHE_MAX_AGE, int(SLOTS_REFRESH))
+
+
+def templates_version() -> str:
+    """
+    Returns a fingerprint of all templates, so the entity tags of cached pages change when TestPoint is updated.
+    :return: Fingerprint as hex string.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(TEMPLATES_DIR)):
+        with open(os.path.join(TEMPLATES_DIR, name), 'rb') as template:
+            digest.update(name.encode())
+            digest.update(template.read())
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+def page_etag(*parts) -> str:
+    """
+    Returns the entity tag of a public page. It is derived from everything the page depends on, so every worker
+    process computes the same tag for the same page without rendering it.
+    :param parts: JSON serializable values the page depends on, e.g. the template name, the day and the available
+    slots.
+    :return: Entity tag as string.
+    """
+    return hashlib.sha256(json.dumps([TEMPLATES_VERSION, *parts]).encode()).hexdigest()[:32]
+
+
+class PageCache:
+    """
+    Per-process cache of rendered public pages by entity tag. The least recently used pages are dropped when the
+    cache is full.
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        :param size: Maximum number of cached pages.
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._pages: OrderedDict[str, tuple[str, dt.datetime]] = OrderedDict()
+
+    def get(self, etag: str) -> Optional[tuple[str, dt.datetime]]:
+        """
+        Returns a cached page.
+        :param etag: Entity tag of the page.
+        :return: Tuple of the rendered page and the time it was rendered or None if the page is not cached.
+        """
+        with self._lock:
+            page = self._pages.get(etag)
+            if page is not None:
+                self._pages.move_to_end(etag)
+            return page
+
+    def put(self, etag: str, body: str) -> tuple[str, dt.datetime]:
+        """
+        Caches a rendered page.
+        :param etag: Entity tag of the page.
+        :param body: Rendered page.
+        :return: Tuple of the rendered page and the time it was rendered.
+        """
+        page = (body, dt.datetime.now(dt.timezone.utc).replace(microsecond=0))
+        with self._lock:
+            self._pages[etag] = page
+            self._pages.move_to_end(etag)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+        return page
+
+
+rendered_pages = PageCache(size=WEBSITE_PAGE_CACHE_SIZE)
+
+
+def page_is_cacheable(authenticated: bool, session: dict) -> bool:
+    """
+    Checks whether the public page for the current request is the same for all visitors: nobody is logged in and
+    there are no messages to show.
+    :param authenticated: True if a staff member is logged in.
+    :param session: Session of the current request.
+    :return: True if the page may be cached.
+    """
+    return not authenticated and '_flashes' not in session
+
+
+def set_cache_headers(response, etag: str, last_modified: dt.datetime, max_age: int) -> None:
+    """
+    Lets browsers and proxies reuse a public page for max_age seconds and revalidate it afterwards with a
+    conditional request. Proxies keep separate copies per session cookie, as visitors with messages to show get
+    another page.
+    :param response: Flask or Quart response.
+    :param etag: Entity tag of the page.
+    :param last_modified: Time the page was rendered.
+    :param max_age: Seconds the page may be reused without asking again.
+    :return: None.
+    """
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.vary.add('Cookie')
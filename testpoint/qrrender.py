@@ -0,0 +1,147 @@
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import qrcode
+import qrcode.image.svg
+
+
+def render_qr_code(data: str, image_format: str, box_size: int, border: int) -> tuple[bytes, float]:
+    """
+    Renders the QRCode for the given data. Runs inside the renderer's worker processes.
+    :param data: Data as string.
+    :param image_format: Output format, either png or svg.
+    :param box_size: Number of pixels per QRCode module.
+    :param border: Width of the quiet zone around the QRCode in modules.
+    :return: Tuple of the image bytes and the time it took to render them in seconds.
+    """
+    start = time.perf_counter()
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    with io.BytesIO() as output:
+        if image_format == 'svg':
+            qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(output)
+        else:
+            qr.make_image().save(output, format="png", optimize=True)
+        return output.getvalue(), time.perf_counter() - start
+
+
+class QRCodeRenderer:
+    """
+    Renders QRCodes in a pool of worker processes and keeps the most recently rendered images in a bounded cache,
+    so neither the rendering nor repeated requests for the same payload block the request thread.
+    """
+
+    def __init__(self, workers: int = 1, cache_size: int = 256, image_format: str = 'png', box_size: int = 4,
+                 border: int = 2) -> None:
+        """
+        :param workers: Number of worker processes, 0 renders in the calling thread.
+        :param cache_size: Maximum number of rendered images kept in the cache.
+        :param image_format: Output format, either png or svg.
+        :param box_size: Number of pixels per QRCode module.
+        :param border: Width of the quiet zone around the QRCode in modules.
+        """
+        if image_format not in ('png', 'svg'):
+            raise ValueError(f"Unsupported QRCode format {image_format}.")
+        self.workers = workers
+        self.cache_size = cache_size
+        self.image_format = image_format
+        self.box_size = box_size
+        self.border = border
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._stats = {'renders': 0, 'cache_hits': 0, 'evictions': 0, 'render_seconds': 0.0, 'bytes': 0}
+
+    @property
+    def subtype(self) -> str:
+        """
+        MIME subtype of the rendered images.
+        :return: MIME subtype as string.
+        """
+        return 'svg+xml' if self.image_format == 'svg' else 'png'
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """
+        Returns the process pool, starting a new one in forked worker processes that inherited the pool.
+        :return: Process pool executor.
+        """
+        if self._executor is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._pending = {}
+        return self._executor
+
+    def submit(self, data: str) -> Future:
+        """
+        Starts rendering the QRCode for the given data unless it is cached or already being rendered.
+        :param data: Data as string.
+        :return: Future resolving to the image bytes.
+        """
+        result = Future()
+        with self._lock:
+            if data in self._cache:
+                self._cache.move_to_end(data)
+                self._stats['cache_hits'] += 1
+                result.set_result(self._cache[data])
+                return result
+            if self.workers:
+                executor = self._get_executor()
+                if data in self._pending:
+                    return self._pending[data]
+                rendered = executor.submit(render_qr_code, data, self.image_format, self.box_size, self.border)
+                self._pending[data] = result
+        if not self.workers:
+            rendered = Future()
+            rendered.set_result(render_qr_code(data, self.image_format, self.box_size, self.border))
+        rendered.add_done_callback(lambda done: self._store(data=data, rendered=done, result=result))
+        return result
+
+    def _store(self, data: str, rendered: Future, result: Future) -> None:
+        """
+        Caches a finished rendering, evicting the least recently used images beyond the cache size.
+        :param data: Data the QRCode was rendered for.
+        :param rendered: Finished future of the worker process.
+        :param result: Future handed out to the caller.
+        :return: None.
+        """
+        with self._lock:
+            self._pending.pop(data, None)
+        if rendered.exception() is not None:
+            result.set_exception(rendered.exception())
+            return
+        image, seconds = rendered.result()
+        with self._lock:
+            self._stats['renders'] += 1
+            self._stats['render_seconds'] += seconds
+            self._stats['bytes'] += len(image)
+            self._cache[data] = image
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self._stats['evictions'] += 1
+        result.set_result(image)
+
+    def render(self, data: str) -> bytes:
+        """
+        Returns the QRCode for the given data, waiting for the worker process if it is not cached.
+        :param data: Data as string.
+        :return: Bytes of the QRCode image.
+        """
+        return self.submit(data=data).result()
+
+    def stats(self) -> dict:
+        """
+        Returns rendering statistics, including average render time and size of the rendered images.
+        :return: Statistics as dictionary.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached'] = len(self._cache)
+        stats['avg_render_seconds'] = stats['render_seconds'] / stats['renders'] if stats['renders'] else 0.0
+        stats['avg_bytes'] = stats['bytes'] / stats['renders'] if stats['renders'] else 0.0
+        return stats
@@ -0,0 +1,122 @@
+import datetime as dt
+from typing import Callable, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .storage import db
+from . import storagehandler
+from .export import read_results
+from .slots import slot_exists
+from .stats import get_daily_stats
+
+SAMPLE_PERSON = {'first_name': 'Plan', 'last_name': 'Check', 'birthdate': '1990-01-01',
+                 'email1': 'plan-check@testpoint.local'}
+
+QUERY_CHECKS: dict[str, Callable] = {
+    'email_exists': lambda: storagehandler.email_exists(email=SAMPLE_PERSON['email1']),
+    'person_exists': lambda: storagehandler.person_exists(person=SAMPLE_PERSON),
+    'get_person_id': lambda: storagehandler.get_person_id(email=SAMPLE_PERSON['email1']),
+    'get_person': lambda: storagehandler.get_person(person_id='1'),
+    'appointment_exists': lambda: storagehandler.appointment_exists(person_id='1', appointment_day='2021-01-01',
+                                                                    appointment_time='08:00'),
+    'get_appointment_id': lambda: storagehandler.get_appointment_id(person_id='1', appointment_day='2021-01-01',
+                                                                    appointment_time='08:00'),
+    'booked_appointment_query': lambda: db.session.execute(storagehandler.booked_appointment_query(
+        person={**SAMPLE_PERSON, 'appointment_day': '2021-01-01', 'appointment_time': '08:00'})).first(),
+    'get_appointment': lambda: storagehandler.get_appointment(appointment_id='plan-check'),
+    'get_appointment_by_key': lambda: storagehandler.get_appointment_by_key(key='1'),
+    'get_verified_appointments': lambda: storagehandler.get_verified_appointments(),
+    'get_verified_appointments (filtered page)': lambda: storagehandler.get_verified_appointments(
+        day='2021-01-01', time_from='08:00', time_to='12:00', after='2021-01-01_08:00:00_1'),
+    'result_exists': lambda: storagehandler.result_exists(appointment_id='plan-check'),
+    'get_result_by_app_id': lambda: storagehandler.get_result_by_app_id(appointment_id='plan-check'),
+    'get_user': lambda: storagehandler.get_user(username=SAMPLE_PERSON['email1']),
+    'get_login': lambda: storagehandler.get_login(username=SAMPLE_PERSON['email1']),
+    'get_identity': lambda: storagehandler.get_identity(user_id='1'),
+    'is_admin': lambda: storagehandler.is_admin(username=SAMPLE_PERSON['email1']),
+    'get_queue_events': lambda: storagehandler.get_queue_events(after=0, limit=500, grace=10),
+    'slot_exists': lambda: slot_exists(slot_day=dt.date(2021, 1, 1)),
+    'get_daily_stats': lambda: get_daily_stats(date_from=dt.date(2021, 1, 1), date_to=dt.date(2021, 1, 31)),
+    'read_results': lambda: list(read_results(date_from=dt.date(2021, 1, 1), date_to=dt.date(2021, 1, 31))),
+}
+
+
+def capture_queries(check: Callable) -> list[tuple[Engine, str, object]]:
+    """
+    Runs a storagehandler function and records the SELECT statements it sends to the database, including those
+    routed to read replicas. Everything the function changes is rolled back.
+    :param check: Function calling storagehandler.
+    :return: List of tuples of the engine that ran the statement, the statement and its parameters as passed to the
+    database driver.
+    """
+    queries = []
+    engines = list(db.engines.values())
+
+    def remember(conn, cursor, statement, parameters, context, executemany) -> None:
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append((conn.engine, statement, parameters))
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', remember)
+    try:
+        check()
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', remember)
+        db.session.rollback()
+    return queries
+
+
+def scanned_table(step: str) -> Optional[str]:
+    """
+    Returns the table a step of SQLite's EXPLAIN QUERY PLAN reads completely. SQLite prints such steps as
+    SCAN <table>, versions before 3.36 as SCAN TABLE <table>.
+    :param step: Detail of a plan step.
+    :return: Name of the scanned table or None if the step is not a scan without an index.
+    """
+    words = step.split()
+    if len(words) < 2 or words[0] != 'SCAN' or ' USING ' in step:
+        return None
+    if words[1] == 'TABLE' and len(words) > 2:
+        return words[2]
+    return words[1]
+
+
+def find_full_scans(engine: Engine, statement: str, parameters: object) -> list[str]:
+    """
+    Explains a statement and returns the tables it reads completely. A full scan is a plan step of type ALL on
+    MySQL and a SCAN of a table without an index on SQLite.
+    :param engine: Engine the statement was sent to.
+    :param statement: SQL statement as sent to the database driver.
+    :param parameters: Parameters of the statement.
+    :return: List of the plan steps scanning whole tables, empty if all tables are read through indexes.
+    """
+    dialect = engine.dialect.name
+    tables = set(db.metadata.tables)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if dialect == 'sqlite':
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            steps = [row[3] for row in cursor.fetchall()]
+            return [step for step in steps if scanned_table(step=step) in tables]
+        cursor.execute(f"EXPLAIN {statement}", parameters)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [f"ALL {row['table']}" for row in rows if row['type'] == 'ALL']
+    finally:
+        connection.close()
+
+
+def check_query_plans() -> dict[str, list[str]]:
+    """
+    Explains the queries of all read functions in storagehandler and reports those scanning whole tables. The plans
+    depend on the statistics of the database, so run the check against a database of production size.
+    :return: Dictionary mapping the name of each function with full table scans to the offending plan steps.
+    """
+    findings = {}
+    for name, check in QUERY_CHECKS.items():
+        for engine, statement, parameters in capture_queries(check=check):
+            scans = find_full_scans(engine=engine, statement=statement, parameters=parameters)
+            if scans:
+                findings.setdefault(name, []).extend(scans)
+    return findings
@@ -0,0 +1,183 @@
+import itertools
+import threading
+import time
+from functools import wraps
+from typing import Callable, Mapping, Optional
+from flask import Flask, Response, g, has_app_context, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+from .config import DB_REPLICAS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL
+
+REPLICA_BIND_PREFIX = 'replica'
+PRIMARY_UNTIL = '_primary_until'
+
+
+def replica_lag(engine: Engine) -> Optional[float]:
+    """
+    Returns how far the given mysql replica lags behind the primary.
+    :param engine: Engine of the replica.
+    :return: Lag in seconds or None if the replica cannot be reached or does not replicate.
+    """
+    try:
+        with engine.connect() as connection:
+            try:
+                status = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+            except SQLAlchemyError:
+                # Servers before mysql 8.0.22 and mariadb 10.5.1 only know the old syntax.
+                connection.rollback()
+                status = connection.execute(text('SHOW SLAVE STATUS')).mappings().first()
+    except SQLAlchemyError:
+        return None
+    if status is None:
+        return None
+    lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+    return float(lag) if lag is not None else None
+
+
+class ReplicaMonitor:
+    """
+    Per-process list of the replicas that are close enough to the primary to serve reads. Once the check interval
+    has passed, the first request that needs a replica starts a new lag check on a background thread; all requests
+    use the previous list meanwhile, so no request waits for the replicas to answer. Until the first check finished,
+    everything is read from the primary.
+    """
+
+    def __init__(self, max_lag: float, interval: float) -> None:
+        """
+        :param max_lag: Seconds a replica may lag behind before it is bypassed.
+        :param interval: Seconds after which the lag is checked again.
+        """
+        self.max_lag = max_lag
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._checked = None
+        self._current: list[str] = []
+        self._turn = itertools.count()
+
+    def check(self, engines: Mapping[Optional[str], Engine]) -> None:
+        """
+        Checks the lag of all replicas and keeps the ones within the maximum lag.
+        :param engines: Engines of the application by bind key.
+        :return: None.
+        """
+        current = []
+        for key, engine in engines.items():
+            if key is not None and key.startswith(REPLICA_BIND_PREFIX):
+                lag = replica_lag(engine=engine)
+                if lag is not None and lag <= self.max_lag:
+                    current.append(key)
+        self._current = current
+        self._checked = time.monotonic()
+
+    def check_in_background(self, engines: Mapping[Optional[str], Engine]) -> None:
+        """
+        Runs check on a background thread that holds the lock, so only one check runs at a time.
+        :param engines: Engines of the application by bind key.
+        :return: None.
+        """
+        try:
+            self.check(engines=engines)
+        finally:
+            self._lock.release()
+
+    def choose(self, engines: Mapping[Optional[str], Engine]) -> Optional[Engine]:
+        """
+        Returns the engine of the next current replica in turn.
+        :param engines: Engines of the application by bind key.
+        :return: Engine or None if no replica is current.
+        """
+        if (self._checked is None or time.monotonic() - self._checked >= self.interval) and \
+                self._lock.acquire(blocking=False):
+            threading.Thread(target=self.check_in_background, kwargs={'engines': engines}, daemon=True).start()
+        current = self._current
+        if not current:
+            return None
+        return engines[current[next(self._turn) % len(current)]]
+
+
+replica_monitor = ReplicaMonitor(max_lag=DB_REPLICA_MAX_LAG, interval=DB_REPLICA_CHECK_INTERVAL)
+
+
+def primary_pinned() -> bool:
+    """
+    Checks whether reads have to go to the primary to see the writes made before: the current request wrote already
+    or the session of the user wrote recently, e.g. before being redirected.
+    :return: True if reads have to go to the primary.
+    """
+    if g.get('primary_pinned'):
+        return True
+    return has_request_context() and session.get(PRIMARY_UNTIL, 0) > time.time()
+
+
+class RoutingSession(Session):
+    """
+    Database session that sends the queries of functions decorated with reads_from_replica to a current read
+    replica and everything else to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.primary_pinned = True
+            elif DB_REPLICAS and g.get('read_replica') and not primary_pinned():
+                engine = replica_monitor.choose(engines=self._db.engines)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def reads_from_replica(function: Callable) -> Callable:
+    """
+    Decorator for read-only functions whose queries may be answered by a read replica.
+    :param function: Function to decorate.
+    :return: Decorated function.
+    """
+    @wraps(function)
+    def read(*args, **kwargs):
+        if not has_app_context() or g.get('read_replica'):
+            return function(*args, **kwargs)
+        g.read_replica = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            g.read_replica = False
+    return read
+
+
+def writes_to_primary(function: Callable) -> Callable:
+    """
+    Decorator for functions that read before they write, so their reads see the latest data of the primary.
+    :param function: Function to decorate.
+    :return: Decorated function.
+    """
+    @wraps(function)
+    def write(*args, **kwargs):
+        if has_app_context():
+            g.primary_pinned = True
+        return function(*args, **kwargs)
+    return write
+
+
+def pin_session(response: Response) -> Response:
+    """
+    Keeps the following requests of a user who wrote in this request on the primary until every replica that is
+    still used has caught up, so e.g. the page a form redirects to shows the new data.
+    :param response: Response of the request.
+    :return: Unchanged response.
+    """
+    if g.get('primary_pinned'):
+        session[PRIMARY_UNTIL] = time.time() + DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL
+    return response
+
+
+def init_replicas(app: Flask) -> None:
+    """
+    Enables read-your-writes across the requests of a user if read replicas are configured.
+    :param app: Flask application.
+    :return: None.
+    """
+    if DB_REPLICAS:
+        app.after_request(pin_session)
@@ -0,0 +1,76 @@
+import datetime as dt
+import time
+from typing import Callable, Optional
+from sqlalchemy import and_, delete, exists, func, or_, select
+from sqlalchemy.sql import ColumnElement
+from .models import Appointment, MailQueue, Person, QueueEvent, Result, Slot
+from .storage import db
+
+
+def expiry_conditions(cutoff: dt.date) -> list[tuple[type, ColumnElement]]:
+    """
+    Returns the conditions for expired rows of every purged table in the order the tables have to be purged, so no
+    row is deleted while another row still references it. Appointments with a result and persons with an appointment
+    or result are kept until those are purged.
+    :param cutoff: Rows of appointments before this day are expired.
+    :return: List of tuples of the model and the condition its expired rows fulfill.
+    """
+    created_before = dt.datetime.combine(cutoff, dt.time())
+    return [
+        (Result, Result.test_day < cutoff),
+        (Appointment, and_(Appointment.appointment_day < cutoff,
+                           ~exists().where(Result.appointment_key == Appointment.id))),
+        (Person, and_(or_(Person.created_at.is_(None), Person.created_at < created_before),
+                      ~exists().where(Appointment.person_id == Person.person_id),
+                      ~exists().where(Result.person_id == Person.person_id))),
+        (MailQueue, MailQueue.created_at < created_before),
+        (QueueEvent, QueueEvent.created_at < created_before),
+        (Slot, Slot.slot_day < cutoff),
+    ]
+
+
+def purge_expired(retention_days: int, chunk_size: int, pause: float, today: Optional[dt.date] = None,
+                  progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Deletes personal data and slot inventory of appointments more than retention_days in the past. Every table is
+    purged in chunks of at most chunk_size rows in primary key order, each in its own short transaction, and the job
+    waits for pause seconds plus the time the chunk took before deleting the next one, so bookings are not blocked.
+    The conditions select only expired rows, so an interrupted purge simply continues where it stopped when run
+    again. The daily statistics are kept.
+    :param retention_days: Number of days after the appointment day the data is kept.
+    :param chunk_size: Maximum number of rows deleted per transaction.
+    :param pause: Seconds to wait between two chunks in addition to the time a chunk took.
+    :param today: Current date, defaults to today.
+    :param progress: Function called with the running totals after every chunk, or None.
+    :return: Dictionary mapping the names of the purged tables to the number of deleted rows.
+    """
+    cutoff = (today or dt.date.today()) - dt.timedelta(days=retention_days)
+    totals = {}
+    for model, condition in expiry_conditions(cutoff=cutoff):
+        name = model.__tablename__
+        totals[name] = 0
+        key = model.__mapper__.primary_key[0]
+        # Rows that expire while the purge runs are left for the next run, so the purge always ends.
+        last = db.session.execute(select(func.max(key)).where(condition)).scalar()
+        db.session.commit()
+        after = None
+        while last is not None:
+            started = time.monotonic()
+            query = select(key).where(and_(key <= last, condition)).order_by(key).limit(chunk_size)
+            if after is not None:
+                query = query.where(key > after)
+            keys = db.session.execute(query).scalars().all()
+            if not keys:
+                break
+            # The condition is checked again, so rows that got referenced in the meantime are kept.
+            deleted = db.session.execute(delete(model.__table__).where(and_(key.in_(keys), condition))).rowcount
+            db.session.commit()
+            totals[name] += deleted
+            after = keys[-1]
+            if progress:
+                progress(dict(totals))
+            if len(keys) < chunk_size:
+                break
+            time.sleep(pause + time.monotonic() - started)
+    db.session.close()
+    return totals
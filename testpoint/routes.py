@@ -1,15 +1,84 @@
-from flask import Blueprint, url_for, render_template, request, flash
+import datetime as dt
+import io
+from typing import Optional
+
+from flask import Blueprint, Response, url_for, render_template, request, flash, stream_with_context
 from flask_login import login_required, current_user
 from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import redirect
+from testpoint.config import WEBSITE_PAGE_SIZE, WEBSITE_STATS_DAYS, IMPORT_CHUNK_SIZE, SLOTS_BOOKING_DAYS
+from testpoint.events import EVENTS_GRACE_SECONDS, MAX_CATCH_UP, PANELS, ThreadSubscriber, queue_events, sort_key, \
+    subscriber_from_args
+from testpoint.export import export_filename, export_results
+from testpoint.importer import import_bookings, import_format, read_rows
+from testpoint.metrics import RESULTS
 from testpoint.models import Appointment, Person
-from testpoint.notification import send_test_result_notification
-from testpoint.storagehandler import is_admin, update_person, verify_appointment, get_verified_appointments, add_result, \
-    get_appointment_by_key, get_person
+from testpoint.stats import STATS_COUNTERS, get_daily_stats
+from testpoint.storage import db
+from testpoint.validation import public_id_is_valid
+from testpoint.storagehandler import update_person, verify_appointment, get_verified_appointments, add_result, \
+    get_appointment_by_key, add_results, get_last_queue_event_id, parse_appointment_cursor
 
 routes = Blueprint('routes', __name__)
 
 
+def render_queue(template: str) -> str:
+    """
+    Renders the staff or admin panel with the page of verified appointments selected by the request arguments.
+    :param template: Name of the panel template as string.
+    :return: Rendered panel template.
+    """
+    filters = {'day': request.args.get('day') or None,
+               'time_from': request.args.get('time_from') or None,
+               'time_to': request.args.get('time_to') or None}
+    after = request.args.get('after') or None
+    last_event = get_last_queue_event_id(grace=EVENTS_GRACE_SECONDS)
+    try:
+        appointments, next_page = get_verified_appointments(**filters, after=after, limit=WEBSITE_PAGE_SIZE)
+    except ValueError:
+        flash('Invalid filter or page. Showing the first page of all appointments instead.', category='error')
+        filters = {'day': None, 'time_from': None, 'time_to': None}
+        after = None
+        appointments, next_page = get_verified_appointments(limit=WEBSITE_PAGE_SIZE)
+    events_url = url_for('routes.events', panel=template.split('.')[0], after_event=last_event, **filters,
+                         after=page_sort_key(cursor=after))
+    return render_template(template, appointments=appointments, next_page=next_page, filters=filters,
+                           events_url=events_url)
+
+
+def page_sort_key(cursor: Optional[str]) -> Optional[str]:
+    """
+    Converts a page cursor as returned by get_verified_appointments into the sort key of the live panel updates.
+    :param cursor: Page cursor as string or None.
+    :return: Sort key as string or None for the first page.
+    """
+    if cursor is None:
+        return None
+    day, time_of_day, key = parse_appointment_cursor(cursor=cursor)
+    return sort_key(day=day, time_of_day=time_of_day, key=key)
+
+
+def add_bulk_results() -> None:
+    """
+    Adds all results selected in the staff or admin panel in one go and queues their notifications.
+    Reports the outcome for every rejected entry as flash message.
+    :return: None.
+    """
+    results = {field[len('result_'):]: value for field, value in request.form.items()
+               if field.startswith('result_') and value}
+    if not results:
+        flash('Please select at least one result.', category='error')
+        return
+
+    added, errors = add_results(results=results)
+    for key in errors:
+        flash(errors[key], category='error')
+    if not added:
+        return
+    RESULTS.labels(mode='bulk').inc(len(added))
+    flash(f'Added {len(added)} results and queued their notifications!', category='success')
+
+
 @routes.route("/appinfo/<app_id>", methods=['GET', 'POST'])
 @login_required
 def appinfo(app_id: str):
@@ -18,7 +87,10 @@ def appinfo(app_id: str):
     :param app_id: Appointment ID as string.
     :return: User information template or redirect to login page.
     """
-    appointment = Appointment.query.filter_by(appointment_id=app_id).first()
+    appointment = Appointment.query.filter_by(appointment_id=app_id).first() if public_id_is_valid(app_id) else None
+    if appointment is None:
+        flash('Appointment not found.', category='error')
+        return redirect(url_for('routes.staff'))
     person = Person.query.filter_by(person_id=appointment.person_id).first()
     if request.method == 'POST':
         user_input = request.form.to_dict()
@@ -50,10 +122,13 @@ def admin():
     Route for admin panel. Redirects to staff page if user is not admin.
     :return: Admin panel template if admin, otherwise staff page template.
     """
-    if not is_admin(current_user.username):
+    if not current_user.is_admin:
         return redirect(url_for('routes.staff'))
 
-    appointments = get_verified_appointments()
+    if request.method == 'POST' and request.form.get('bulk'):
+        add_bulk_results()
+        return render_queue(template='admin.html')
+
     if request.method == 'POST':
         appointment_id = request.form.get('appointment_id')
         test_result = request.form.get('test_result')
@@ -67,15 +142,140 @@ def admin():
         except RuntimeError as e:
             flash(f"{e}", category='error')
             return redirect(url_for('routes.staff'))
+        RESULTS.labels(mode='single').inc()
+        flash('Added result and queued the notification!', category='success')
+
+    return render_queue(template='admin.html')
+
+
+@routes.route("/admin/import/", methods=['POST'])
+@login_required
+def import_file():
+    """
+    Books appointments for all rows of an uploaded CSV or NDJSON file and queues their booking confirmations.
+    Reports the totals and the first rejected rows as flash messages. A file that is not UTF-8 encoded stops the
+    import, the chunks booked before are kept and reported.
+    :return: Redirect to the admin panel or to the staff page if user is not admin.
+    """
+    if not current_user.is_admin:
+        return redirect(url_for('routes.staff'))
+    upload = request.files.get('bookings')
+    if not upload or not upload.filename:
+        flash('Please select a file to import.', category='error')
+        return redirect(url_for('routes.admin'))
+    try:
+        file_format = import_format(filename=upload.filename)
+    except ValueError as e:
+        flash(f"{e}", category='error')
+        return redirect(url_for('routes.admin'))
+
+    rejected = []
+    totals = {'rows': 0, 'booked': 0, 'rejected': 0}
 
-        person = get_person(person_id=person_id)
-        send_test_result_notification(email=person.email,
-                                      first_name=person.first_name,
-                                      appointment_id=appointment_id)
-        flash('Added result and sent notification!', category='success')
-        return render_template('admin.html', appointments=get_verified_appointments())
+    def reject(row: int, errors: dict[str, str]) -> None:
+        if len(rejected) < 20:
+            rejected.append(f"Row {row} rejected: {' '.join(dict.fromkeys(errors.values()))}")
 
-    return render_template('admin.html', appointments=appointments)
+    def progress(chunk_totals: dict) -> None:
+        totals.update(chunk_totals)
+
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        import_bookings(rows=read_rows(stream=stream, file_format=file_format), chunk_size=IMPORT_CHUNK_SIZE,
+                        reject=reject, progress=progress)
+    except UnicodeDecodeError:
+        db.session.rollback()
+        rejected.append(f"The file is not UTF-8 encoded, the import stopped after row {totals['rows']}.")
+    for message in rejected:
+        flash(message, category='error')
+    flash(f"Imported {totals['rows']} rows: {totals['booked']} appointments booked, {totals['rejected']} rows "
+          f"rejected. The booking confirmations are queued.", category='success')
+    return redirect(url_for('routes.admin'))
+
+
+@routes.route("/admin/export/", methods=['GET'])
+@login_required
+def export_file():
+    """
+    Streams all results tested between the days given as date_from and date_to (YYYY-MM-DD) as CSV or NDJSON file,
+    gzipped if gzip is set.
+    :return: Streamed export file or redirect to the admin panel if the request is invalid or user is not admin.
+    """
+    if not current_user.is_admin:
+        return redirect(url_for('routes.staff'))
+    file_format = request.args.get('format', 'csv')
+    compress = bool(request.args.get('gzip'))
+    try:
+        date_from = dt.date.fromisoformat(request.args.get('date_from', ''))
+        date_to = dt.date.fromisoformat(request.args.get('date_to', ''))
+        chunks = export_results(date_from=date_from, date_to=date_to, file_format=file_format, compress=compress)
+    except ValueError as e:
+        flash(f"Could not export results. {e}", category='error')
+        return redirect(url_for('routes.admin'))
+    filename = export_filename(date_from=date_from, date_to=date_to, file_format=file_format, compress=compress)
+    mimetype = 'application/gzip' if compress else ('text/csv' if file_format == 'csv' else 'application/x-ndjson')
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@routes.route("/admin/stats/", methods=['GET'])
+@login_required
+def stats():
+    """
+    Shows bookings, verified appointments, positive and negative results per day. Defaults to the last
+    WEBSITE_STATS_DAYS days and the booking window, other periods can be selected with date_from and date_to.
+    :return: Statistics template or redirect to staff page if user is not admin.
+    """
+    if not current_user.is_admin:
+        return redirect(url_for('routes.staff'))
+    today = dt.date.today()
+    try:
+        date_from = dt.date.fromisoformat(request.args.get('date_from') or
+                                          (today - dt.timedelta(days=WEBSITE_STATS_DAYS)).isoformat())
+        date_to = dt.date.fromisoformat(request.args.get('date_to') or
+                                        (today + dt.timedelta(days=SLOTS_BOOKING_DAYS)).isoformat())
+    except ValueError:
+        flash('Invalid period. Showing the default period instead.', category='error')
+        return redirect(url_for('routes.stats'))
+    if date_to < date_from or (date_to - date_from).days > 366:
+        flash('Please select a period of at most one year.', category='error')
+        return redirect(url_for('routes.stats'))
+    days = get_daily_stats(date_from=date_from, date_to=date_to)
+    totals = {counter: sum(day[counter] for day in days) for counter in STATS_COUNTERS}
+    return render_template('stats.html', days=days, totals=totals, date_from=date_from, date_to=date_to)
+
+
+@routes.route("/staff/events", methods=['GET'])
+@login_required
+def events():
+    """
+    Streams the changes of the staff queue to an open staff or admin panel as server-sent events: newly verified
+    appointments on the page of the panel and appointments that got a result. Reconnecting browsers continue after
+    the last event they received.
+    :return: Event stream.
+    """
+    args = request.args.to_dict()
+    if 'Last-Event-ID' in request.headers:
+        args['after_event'] = request.headers['Last-Event-ID']
+    try:
+        subscriber = ThreadSubscriber(*subscriber_from_args(args=args))
+    except ValueError:
+        return Response('Invalid last event.', status=400)
+    if subscriber.panel not in PANELS or (subscriber.panel == 'admin' and not current_user.is_admin):
+        return Response('Unknown panel.', status=400)
+    if get_last_queue_event_id(grace=EVENTS_GRACE_SECONDS) - subscriber.after_event > MAX_CATCH_UP:
+        subscriber.overflow = True
+    else:
+        queue_events.subscribe(subscriber=subscriber)
+
+    def stream():
+        try:
+            yield from subscriber.stream()
+        finally:
+            queue_events.unsubscribe(subscriber=subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @routes.route("/staff/", methods=['GET', 'POST'])
@@ -85,7 +285,10 @@ def staff():
     Route for user center of staff.
     :return: HTML template for staff user center.
     """
-    appointments = get_verified_appointments()
+    if request.method == 'POST' and request.form.get('bulk'):
+        add_bulk_results()
+        return render_queue(template='staff.html')
+
     if request.method == 'POST':
         appointment_key = request.form.get('appointment_key')
         test_result = request.form.get('test_result')
@@ -99,12 +302,7 @@ def staff():
         except RuntimeError as e:
             flash(f"{e}", category='error')
             return redirect(url_for('routes.staff'))
+        RESULTS.labels(mode='single').inc()
+        flash('Added result and queued the notification!', category='success')
 
-        person = get_person(person_id=person_id)
-        send_test_result_notification(email=person.email,
-                                      first_name=person.first_name,
-                                      appointment_id=appointment_id)
-        flash('Added result and sent notification!', category='success')
-        return render_template('staff.html', appointments=get_verified_appointments())
-
-    return render_template('staff.html', appointments=appointments)
+    return render_queue(template='staff.html')
@@ -0,0 +1,349 @@
+import datetime as dt
+import hashlib
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from secrets import token_urlsafe
+from typing import Optional
+from flask import Flask
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from .config import SESSION_BACKEND, SESSION_DIR
+from .models import WebSession
+from .storage import db
+
+SESSION_SALT = 'testpoint-session-id'
+serializer = TaggedJSONSerializer()
+
+
+def utcnow() -> dt.datetime:
+    """
+    Returns the current time in UTC as naive datetime, as stored in the web_session table.
+    :return: Current time.
+    """
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def record_key(session_id: str) -> str:
+    """
+    Returns the key a session is stored under. Only a hash of the session ID is stored, so the stored sessions
+    cannot be taken over by someone who can read the table or directory.
+    :param session_id: Session ID as sent in the session cookie.
+    :return: Key as hex string.
+    """
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+def session_signer(app: Flask) -> Optional[Signer]:
+    """
+    Returns the signer of session IDs. IDs signed with one of the SECRET_KEY_FALLBACKS are accepted as well, so the
+    secret key can be rotated without logging everyone out.
+    :param app: Flask or Quart application.
+    :return: Signer or None if the application has no secret key.
+    """
+    if not app.secret_key:
+        return None
+    keys = [*(app.config.get('SECRET_KEY_FALLBACKS') or []), app.secret_key]
+    return Signer(keys, salt=SESSION_SALT, key_derivation='hmac', digest_method=hashlib.sha256)
+
+
+class ServerSideSession(SecureCookieSession):
+    """
+    Session whose data is kept by a SessionStore while the cookie only carries its signed ID.
+    """
+
+    def __init__(self, initial: Optional[dict] = None, session_id: Optional[str] = None,
+                 expires_at: Optional[dt.datetime] = None) -> None:
+        """
+        :param initial: Stored data of the session or None for a new session.
+        :param session_id: ID of the stored session or None for a new session.
+        :param expires_at: Time the stored session expires or None for a new session.
+        """
+        super().__init__(initial)
+        self.session_id = session_id
+        self.expires_at = expires_at
+        self.user_id = self.get('_user_id')
+
+
+class SessionStore(ABC):
+    """
+    Server-side storage of sessions. Records only contain the compact JSON of the session data and its expiry time.
+    """
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[tuple[str, dt.datetime]]:
+        """
+        Returns a stored session unless it expired.
+        :param key: Record key of the session.
+        :return: Tuple of the session data as JSON and the time the session expires or None.
+        """
+
+    @abstractmethod
+    def save(self, key: str, data: str, expires_at: dt.datetime) -> None:
+        """
+        Stores a session, replacing the stored session with the same key.
+        :param key: Record key of the session.
+        :param data: Session data as JSON.
+        :param expires_at: Time the session expires.
+        :return: None.
+        """
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """
+        Deletes a stored session.
+        :param key: Record key of the session.
+        :return: None.
+        """
+
+    @abstractmethod
+    def sweep(self, now: dt.datetime, chunk_size: int) -> int:
+        """
+        Deletes all sessions that expired.
+        :param now: Current time in UTC.
+        :param chunk_size: Sessions deleted per transaction where the store uses transactions.
+        :return: Number of deleted sessions.
+        """
+
+
+class DatabaseSessionStore(SessionStore):
+    """
+    Sessions in the web_session table of the primary database, shared by all TestPoint servers.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        """
+        :param engine: Engine of the primary database.
+        """
+        self.engine = engine
+
+    def load(self, key: str) -> Optional[tuple[str, dt.datetime]]:
+        with self.engine.connect() as connection:
+            row = connection.execute(select(WebSession.data, WebSession.expires_at)
+                                     .where(WebSession.id == key, WebSession.expires_at > utcnow())).first()
+        return (row[0], row[1]) if row else None
+
+    def save(self, key: str, data: str, expires_at: dt.datetime) -> None:
+        statement = update(WebSession.__table__).where(WebSession.id == key).values(data=data, expires_at=expires_at)
+        with self.engine.begin() as connection:
+            if connection.execute(statement).rowcount:
+                return
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(insert(WebSession.__table__).values(id=key, data=data, expires_at=expires_at))
+        except IntegrityError:
+            # A concurrent request of the same new session stored it first.
+            with self.engine.begin() as connection:
+                connection.execute(statement)
+
+    def delete(self, key: str) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(delete(WebSession.__table__).where(WebSession.id == key))
+
+    def sweep(self, now: dt.datetime, chunk_size: int) -> int:
+        deleted = 0
+        while True:
+            with self.engine.begin() as connection:
+                keys = connection.execute(select(WebSession.id).where(WebSession.expires_at <= now)
+                                          .limit(chunk_size)).scalars().all()
+                if keys:
+                    deleted += connection.execute(delete(WebSession.__table__)
+                                                  .where(WebSession.id.in_(keys),
+                                                         WebSession.expires_at <= now)).rowcount
+            if len(keys) < chunk_size:
+                return deleted
+
+
+class FileSessionStore(SessionStore):
+    """
+    Sessions as one file per session in a local directory, for single servers that should not write to the
+    database on logins. The modification time of a file is the time its session expires.
+    """
+
+    def __init__(self, directory: str) -> None:
+        """
+        :param directory: Directory of the session files, created if it does not exist.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, key: str) -> Optional[tuple[str, dt.datetime]]:
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, encoding='utf-8') as file:
+                data = file.read()
+            expires_at = dt.datetime.fromtimestamp(os.stat(path).st_mtime, dt.timezone.utc).replace(tzinfo=None)
+        except FileNotFoundError:
+            return None
+        return (data, expires_at) if expires_at > utcnow() else None
+
+    def save(self, key: str, data: str, expires_at: dt.datetime) -> None:
+        # Written to a temporary file first, so concurrent requests never read a partially written session.
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+                file.write(data)
+            expires = expires_at.replace(tzinfo=dt.timezone.utc).timestamp()
+            os.utime(temporary, (expires, expires))
+            os.replace(temporary, os.path.join(self.directory, key))
+        except OSError:
+            os.unlink(temporary)
+            raise
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(os.path.join(self.directory, key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, now: dt.datetime, chunk_size: int) -> int:
+        deleted = 0
+        expired = now.replace(tzinfo=dt.timezone.utc).timestamp()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime <= expired:
+                        os.unlink(entry.path)
+                        deleted += 1
+                except FileNotFoundError:
+                    continue
+        return deleted
+
+
+class ServerSideSessions:
+    """
+    Loading and storing of server-side sessions, shared by the session interfaces of the Flask and the Quart
+    application.
+    """
+
+    def __init__(self, store: SessionStore) -> None:
+        """
+        :param store: Store of the sessions.
+        """
+        self.store = store
+
+    def open(self, signer: Optional[Signer], cookie: Optional[str]) -> Optional[ServerSideSession]:
+        """
+        Loads the session of the given session cookie.
+        :param signer: Signer of session IDs or None if the application has no secret key.
+        :param cookie: Value of the session cookie or None.
+        :return: Stored session, a new session if the cookie is missing, invalid or expired or None without signer.
+        """
+        if signer is None:
+            return None
+        if not cookie:
+            return ServerSideSession()
+        try:
+            session_id = signer.unsign(cookie).decode()
+        except BadSignature:
+            return ServerSideSession()
+        record = self.store.load(key=record_key(session_id=session_id))
+        if record is None:
+            return ServerSideSession()
+        try:
+            data = serializer.loads(record[0])
+        except ValueError:
+            return ServerSideSession()
+        return ServerSideSession(data, session_id=session_id, expires_at=record[1])
+
+    def persist(self, signer: Signer, session: ServerSideSession, lifetime: dt.timedelta) -> Optional[str]:
+        """
+        Stores the session after a request if it changed or half of its lifetime passed. Sessions get a new ID when
+        the logged in user changes, so a session ID planted before the login is worthless afterwards.
+        :param signer: Signer of session IDs.
+        :param session: Session of the request.
+        :param lifetime: Time after the last store the session expires.
+        :return: New value of the session cookie, an empty string to delete the cookie or None to keep it.
+        """
+        if not session:
+            if session.session_id is not None:
+                self.store.delete(key=record_key(session_id=session.session_id))
+                return ''
+            return None
+        now = utcnow()
+        renewed = session.session_id is None or session.get('_user_id') != session.user_id
+        if not renewed and not session.modified and session.expires_at - now > lifetime / 2:
+            return None
+        if renewed:
+            if session.session_id is not None:
+                self.store.delete(key=record_key(session_id=session.session_id))
+            session.session_id = token_urlsafe(32)
+            session.user_id = session.get('_user_id')
+        session.expires_at = now + lifetime
+        self.store.save(key=record_key(session_id=session.session_id), data=serializer.dumps(dict(session)),
+                        expires_at=session.expires_at)
+        return signer.sign(session.session_id).decode()
+
+
+def save_session_cookie(interface, app, session: ServerSideSession, response, value: Optional[str]) -> None:
+    """
+    Sets or deletes the session cookie as decided by ServerSideSessions.persist.
+    :param interface: Flask or Quart session interface.
+    :param app: Flask or Quart application.
+    :param session: Session of the request.
+    :param response: Flask or Quart response.
+    :param value: New value of the session cookie, an empty string to delete the cookie or None to keep it.
+    :return: None.
+    """
+    if session.accessed:
+        response.vary.add('Cookie')
+    if value is None:
+        return
+    options = {'domain': interface.get_cookie_domain(app), 'path': interface.get_cookie_path(app),
+               'secure': interface.get_cookie_secure(app), 'samesite': interface.get_cookie_samesite(app),
+               'httponly': interface.get_cookie_httponly(app)}
+    if value:
+        response.set_cookie(interface.get_cookie_name(app), value, expires=interface.get_expiration_time(app, session),
+                            **options)
+    else:
+        response.delete_cookie(interface.get_cookie_name(app), **options)
+    response.vary.add('Cookie')
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface keeping the session data in a SessionStore.
+    """
+
+    def __init__(self, store: SessionStore) -> None:
+        """
+        :param store: Store of the sessions.
+        """
+        self.sessions = ServerSideSessions(store=store)
+
+    def open_session(self, app: Flask, request) -> Optional[ServerSideSession]:
+        return self.sessions.open(signer=session_signer(app=app), cookie=request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app: Flask, session: ServerSideSession, response) -> None:
+        value = self.sessions.persist(signer=session_signer(app=app), session=session,
+                                      lifetime=app.permanent_session_lifetime)
+        save_session_cookie(interface=self, app=app, session=session, response=response, value=value)
+
+
+def session_store(app: Flask) -> Optional[SessionStore]:
+    """
+    Returns the store of the configured session backend.
+    :param app: Flask application.
+    :return: Session store or None if the sessions are kept in the signed cookie.
+    """
+    if SESSION_BACKEND == 'database':
+        with app.app_context():
+            return DatabaseSessionStore(engine=db.engine)
+    if SESSION_BACKEND == 'files':
+        return FileSessionStore(directory=SESSION_DIR)
+    return None
+
+
+def init_sessions(app: Flask) -> None:
+    """
+    Keeps the sessions of the application in the configured server-side store instead of the signed cookie.
+    :param app: Flask application.
+    :return: None.
+    """
+    store = session_store(app=app)
+    if store is not None:
+        app.session_interface = ServerSideSessionInterface(store=store)
@@ -0,0 +1,277 @@
+import datetime as dt
+import threading
+import time
+from typing import Optional
+from sqlalchemy import Select, Update, and_, func, select, update
+from sqlalchemy.exc import IntegrityError
+from .config import SLOTS_FIRST_HOUR, SLOTS_LAST_HOUR, SLOTS_LANES, SLOTS_CAPACITY, SLOTS_CAPACITY_OVERRIDES, \
+    SLOTS_BOOKING_DAYS, SLOTS_REFRESH
+from .models import Slot
+from .storage import db
+
+SLOT_TIMES = [dt.time(hour=h, minute=m) for h in range(SLOTS_FIRST_HOUR, SLOTS_LAST_HOUR) for m in [0, 15, 30, 45]]
+
+
+def parse_capacity_overrides(overrides: str) -> dict[dt.time, int]:
+    """
+    Parses capacity overrides of the form "HH:MM=capacity, HH:MM=capacity" from the config.
+    :param overrides: Overrides as string.
+    :return: Dictionary mapping slot times to the capacity of each lane at that time.
+    """
+    capacities = {}
+    for override in filter(None, (part.strip() for part in overrides.split(','))):
+        slot_time, capacity = override.split('=')
+        capacities[dt.datetime.strptime(slot_time.strip(), "%H:%M").time()] = int(capacity)
+    return capacities
+
+
+LANE_CAPACITY = {slot_time: SLOTS_CAPACITY for slot_time in SLOT_TIMES}
+LANE_CAPACITY.update(parse_capacity_overrides(SLOTS_CAPACITY_OVERRIDES))
+
+
+def booking_window(today: dt.date) -> list[dt.date]:
+    """
+    Returns all days that can be booked starting from the given day.
+    :param today: First bookable day.
+    :return: List of bookable days.
+    """
+    return [today + dt.timedelta(days=offset) for offset in range(SLOTS_BOOKING_DAYS + 1)]
+
+
+def missing_slots(days: list[dt.date], existing: set[dt.date]) -> list[dict]:
+    """
+    Returns the slot inventory for all lanes of the given days that do not have an inventory yet.
+    :param days: Days to create the slot inventory for.
+    :param existing: Days that have an inventory already.
+    :return: List of slot rows as dictionaries.
+    """
+    return [{'slot_day': day, 'slot_time': slot_time, 'lane': lane, 'capacity': LANE_CAPACITY[slot_time],
+             'booked': 0}
+            for day in days if day not in existing
+            for slot_time in SLOT_TIMES
+            for lane in range(1, SLOTS_LANES + 1)]
+
+
+def ensure_slots(days: list[dt.date]) -> None:
+    """
+    Creates the slot inventory for all lanes of the given days unless it exists already.
+    :param days: Days to create the slot inventory for.
+    :return: None.
+    """
+    existing = {day for (day,) in db.session.query(Slot.slot_day).filter(Slot.slot_day.in_(days)).distinct()}
+    missing = missing_slots(days=days, existing=existing)
+    if not missing:
+        return
+    try:
+        db.session.execute(Slot.__table__.insert(), missing)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def reserve_slot(appointment_day: str, appointment_time: str) -> Optional[int]:
+    """
+    Reserves one place in the given slot on the first lane that still has room. The conditional update makes the
+    reservation atomic, so concurrent requests can never book a slot beyond its capacity. The reservation is not
+    committed, it becomes effective with the commit of the surrounding transaction.
+    :param appointment_day: Date of the appointment as string (YYYY-MM-DD).
+    :param appointment_time: Time of the appointment as string (HH:MM).
+    :return: Lane the place was reserved on or None if the slot is fully booked or does not exist.
+    """
+    slot_day = dt.date.fromisoformat(appointment_day)
+    slot_time = dt.datetime.strptime(appointment_time, "%H:%M").time()
+    lane = reserve_lane(slot_day=slot_day, slot_time=slot_time)
+    if lane is None and slot_day in booking_window(today=dt.date.today()) and not slot_exists(slot_day=slot_day):
+        ensure_slots(days=[slot_day])
+        lane = reserve_lane(slot_day=slot_day, slot_time=slot_time)
+    if lane is not None:
+        availability_index.invalidate()
+    return lane
+
+
+def reserve_lane(slot_day: dt.date, slot_time: dt.time) -> Optional[int]:
+    """
+    Reserves one place in the given slot on the first lane with room using a conditional update per lane.
+    :param slot_day: Date of the slot.
+    :param slot_time: Time of the slot.
+    :return: Lane the place was reserved on or None if no lane has room.
+    """
+    for lane in range(1, SLOTS_LANES + 1):
+        if db.session.execute(reserve_lane_statement(slot_day=slot_day, slot_time=slot_time, lane=lane)).rowcount:
+            return lane
+    return None
+
+
+def reserve_lane_statement(slot_day: dt.date, slot_time: dt.time, lane: int) -> Update:
+    """
+    Returns the conditional update that reserves one place on a lane of a slot if the lane still has room.
+    :param slot_day: Date of the slot.
+    :param slot_time: Time of the slot.
+    :param lane: Lane to reserve the place on.
+    :return: Update statement, it changes one row if the place was reserved.
+    """
+    return update(Slot) \
+        .where(and_(Slot.slot_day == slot_day, Slot.slot_time == slot_time, Slot.lane == lane,
+                    Slot.booked < Slot.capacity)) \
+        .values(booked=Slot.booked + 1)
+
+
+def reserve_places(slot_day: dt.date, slot_time: dt.time, count: int) -> int:
+    """
+    Reserves up to the given number of places in a slot, filling the lanes in order. Each lane is updated with a
+    conditional update, so concurrent bookings can never exceed its capacity. Does not commit.
+    :param slot_day: Date of the slot.
+    :param slot_time: Time of the slot.
+    :param count: Number of places to reserve.
+    :return: Number of places reserved, less than requested if the slot is (nearly) full or does not exist.
+    """
+    reserved = 0
+    lanes = db.session.query(Slot.lane, Slot.capacity - Slot.booked) \
+        .filter(and_(Slot.slot_day == slot_day, Slot.slot_time == slot_time, Slot.booked < Slot.capacity)) \
+        .order_by(Slot.lane).all()
+    for lane, room in lanes:
+        places = min(count - reserved, room)
+        if places <= 0:
+            break
+        updated = db.session.execute(update(Slot)
+                                     .where(and_(Slot.slot_day == slot_day,
+                                                 Slot.slot_time == slot_time,
+                                                 Slot.lane == lane,
+                                                 Slot.booked + places <= Slot.capacity))
+                                     .values(booked=Slot.booked + places))
+        if updated.rowcount == 1:
+            reserved += places
+    if reserved:
+        availability_index.invalidate()
+    return reserved
+
+
+def slot_exists(slot_day: dt.date) -> bool:
+    """
+    Check if the slot inventory for the given day was created already.
+    :param slot_day: Date to check.
+    :return: True if there is at least one slot on that day, False otherwise.
+    """
+    return db.session.query(Slot.id).filter(Slot.slot_day == slot_day).first() is not None
+
+
+class AvailabilityIndex:
+    """
+    Per-process index of the slots in the booking window that still have room. The index is rebuilt with a single
+    aggregate query at most every SLOTS_REFRESH seconds, when the day changes or after a reservation of this process.
+    """
+
+    def __init__(self, refresh: float) -> None:
+        """
+        :param refresh: Seconds after which the index is rebuilt.
+        """
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._built_for = None
+        self._built_at = 0.0
+        self._available = {}
+
+    def invalidate(self) -> None:
+        """
+        Forces a rebuild of the index on next access.
+        :return: None.
+        """
+        self._built_at = 0.0
+
+    def cached(self, today: dt.date) -> Optional[dict[dt.date, list[dt.time]]]:
+        """
+        Returns the index without rebuilding it.
+        :param today: First bookable day.
+        :return: Dictionary mapping each day to a list of slot times that can still be booked or None if the index
+        was built for another day, too long ago or invalidated and has to be rebuilt.
+        """
+        if self._built_for != today or time.monotonic() - self._built_at > self.refresh:
+            return None
+        return self._available
+
+    def store(self, today: dt.date, available: dict[dt.date, list[dt.time]]) -> None:
+        """
+        Replaces the index with slots that were queried elsewhere, e.g. by the async views.
+        :param today: First bookable day the slots were queried for.
+        :param available: Dictionary mapping each day to a list of slot times that can still be booked.
+        :return: None.
+        """
+        with self._lock:
+            self._available = available
+            self._built_for = today
+            self._built_at = time.monotonic()
+
+    def get(self, today: dt.date) -> dict[dt.date, list[dt.time]]:
+        """
+        Returns the slots with room for every day of the booking window starting today.
+        :param today: First bookable day.
+        :return: Dictionary mapping each day to a list of slot times that can still be booked.
+        """
+        with self._lock:
+            if self.cached(today=today) is None:
+                self._available = self._build(today=today)
+                self._built_for = today
+                self._built_at = time.monotonic()
+            return self._available
+
+    @staticmethod
+    def _build(today: dt.date) -> dict[dt.date, list[dt.time]]:
+        """
+        Queries the slots with room in the booking window, creating missing inventory on the way.
+        :param today: First bookable day.
+        :return: Dictionary mapping each day to a list of slot times that can still be booked.
+        """
+        days = booking_window(today=today)
+        ensure_slots(days=days)
+        return group_available_slots(days=days, rows=db.session.execute(available_slots_query(days=days)).all())
+
+
+def available_slots_query(days: list[dt.date]) -> Select:
+    """
+    Returns the aggregate query for the slot times of the given days that still have room on any lane.
+    :param days: Consecutive days to query.
+    :return: Select statement for rows of slot day and slot time.
+    """
+    return select(Slot.slot_day, Slot.slot_time) \
+        .where(Slot.slot_day.between(days[0], days[-1])) \
+        .group_by(Slot.slot_day, Slot.slot_time) \
+        .having(func.sum(Slot.capacity - Slot.booked) > 0) \
+        .order_by(Slot.slot_day, Slot.slot_time)
+
+
+def group_available_slots(days: list[dt.date], rows: list[tuple[dt.date, dt.time]]) -> dict[dt.date, list[dt.time]]:
+    """
+    Groups the rows of available_slots_query by day.
+    :param days: Days that were queried.
+    :param rows: Rows of slot day and slot time.
+    :return: Dictionary mapping each day to a list of slot times that can still be booked.
+    """
+    available = {day: [] for day in days}
+    for slot_day, slot_time in rows:
+        available[slot_day].append(slot_time)
+    return available
+
+
+availability_index = AvailabilityIndex(refresh=SLOTS_REFRESH)
+
+
+def get_available_slots(now: Optional[dt.datetime] = None) -> dict[str, list[str]]:
+    """
+    Returns the bookable slots of the booking window that still have room and are not in the past.
+    :param now: Current date and time, defaults to now.
+    :return: Dictionary mapping each day (YYYY-MM-DD) to a list of bookable slot times (H:MM) as used by the form.
+    """
+    now = now or dt.datetime.now()
+    return format_available_slots(available=availability_index.get(today=now.date()), now=now)
+
+
+def format_available_slots(available: dict[dt.date, list[dt.time]], now: dt.datetime) -> dict[str, list[str]]:
+    """
+    Formats the slots of the availability index for the booking form, dropping slots that are in the past.
+    :param available: Dictionary mapping each day to a list of slot times that can still be booked.
+    :param now: Current date and time.
+    :return: Dictionary mapping each day (YYYY-MM-DD) to a list of bookable slot times (H:MM).
+    """
+    return {day.isoformat(): [f"{slot_time.hour}:{slot_time.minute:02d}" for slot_time in slot_times
+                              if dt.datetime.combine(day, slot_time) > now]
+            for day, slot_times in available.items()}
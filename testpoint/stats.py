@@ -0,0 +1,113 @@
+import datetime as dt
+from typing import Optional, Union
+from sqlalchemy import Insert, and_, case, delete, func, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from .models import Appointment, DailyStats, Result
+from .storage import db
+
+STATS_COUNTERS = ('bookings', 'verified', 'positives', 'negatives')
+RESULT_COUNTERS = {'POSITIVE': 'positives', 'NEGATIVE': 'negatives'}
+
+SlotKey = tuple[Union[dt.date, str], Union[dt.time, str]]
+
+
+def count_stats(counts: dict[SlotKey, dict[str, int]]) -> None:
+    """
+    Adds to the statistics rollups of the given slots. Missing rollup rows are created with an upsert, so concurrent
+    transactions never lose increments. Does not commit, so the rollups change together with the counted rows.
+    :param counts: Dictionary mapping (day, time) of each slot to a dictionary mapping counters (see STATS_COUNTERS)
+    to the amount to add.
+    :return: None.
+    """
+    rows = stats_rows(counts=counts)
+    if not rows:
+        return
+    table = DailyStats.__table__
+    statement = count_stats_statement(dialect=db.session.get_bind().dialect.name)
+    if statement is not None:
+        db.session.execute(statement, rows)
+        return
+    for row in rows:
+        increment = update(table) \
+            .where(and_(table.c.stats_day == row['stats_day'], table.c.stats_time == row['stats_time'])) \
+            .values({counter: table.c[counter] + row[counter] for counter in STATS_COUNTERS})
+        if db.session.execute(increment).rowcount:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(table).values(**row))
+        except IntegrityError:
+            db.session.execute(increment)
+
+
+def stats_rows(counts: dict[SlotKey, dict[str, int]]) -> list[dict]:
+    """
+    Turns the amounts to add per slot into parameter rows for count_stats_statement.
+    :param counts: Dictionary mapping (day, time) of each slot to a dictionary mapping counters to the amount to add.
+    :return: List of dictionaries with day, time and the amount of every counter, without slots that do not change.
+    """
+    return [{'stats_day': day, 'stats_time': time, **{counter: amounts.get(counter, 0) for counter in STATS_COUNTERS}}
+            for (day, time), amounts in counts.items() if any(amounts.values())]
+
+
+def count_stats_statement(dialect: str) -> Optional[Insert]:
+    """
+    Returns the upsert that adds the amounts of a row of stats_rows to the rollup of its slot.
+    :param dialect: Name of the database dialect.
+    :return: Insert statement or None if the dialect has no upsert.
+    """
+    table = DailyStats.__table__
+    if dialect == 'mysql':
+        statement = mysql_insert(table)
+        return statement.on_duplicate_key_update({counter: table.c[counter] + statement.inserted[counter]
+                                                  for counter in STATS_COUNTERS})
+    if dialect == 'sqlite':
+        statement = sqlite_insert(table)
+        return statement.on_conflict_do_update(index_elements=['stats_day', 'stats_time'],
+                                               set_={counter: table.c[counter] + statement.excluded[counter]
+                                                     for counter in STATS_COUNTERS})
+    return None
+
+
+def rebuild_stats(connection: Connection) -> int:
+    """
+    Recomputes the statistics rollups from the appointments and results, e.g. after restoring a backup or importing
+    data with other tools. Only days from the earliest appointment that still exists on are recomputed, so the
+    rollups of purged days are kept. Runs as one aggregate query in the transaction of the connection.
+    :param connection: Database connection.
+    :return: Number of slots with recomputed statistics.
+    """
+    first_day = connection.execute(select(func.min(Appointment.appointment_day))).scalar()
+    if first_day is None:
+        return 0
+    query = select(Appointment.appointment_day,
+                   Appointment.appointment_time,
+                   func.count(Appointment.id),
+                   func.sum(case((Appointment.verified == 'Y', 1), else_=0)),
+                   func.sum(case((Result.result == 'POSITIVE', 1), else_=0)),
+                   func.sum(case((Result.result == 'NEGATIVE', 1), else_=0))) \
+        .join(Result, Result.appointment_key == Appointment.id, isouter=True) \
+        .group_by(Appointment.appointment_day, Appointment.appointment_time)
+    connection.execute(delete(DailyStats.__table__).where(DailyStats.stats_day >= first_day))
+    return connection.execute(insert(DailyStats.__table__)
+                              .from_select(['stats_day', 'stats_time', *STATS_COUNTERS], query)).rowcount
+
+
+def get_daily_stats(date_from: dt.date, date_to: dt.date) -> list[dict]:
+    """
+    Returns the statistics of every day in the given period from the rollups, without touching appointments or
+    results, so the time taken does not grow with the history.
+    :param date_from: First day.
+    :param date_to: Last day.
+    :return: List of dictionaries with the day and the counters (see STATS_COUNTERS) for every day of the period.
+    """
+    rows = db.session.query(DailyStats.stats_day,
+                            *(func.sum(DailyStats.__table__.c[counter]) for counter in STATS_COUNTERS)) \
+        .filter(DailyStats.stats_day.between(date_from, date_to)) \
+        .group_by(DailyStats.stats_day).all()
+    totals = {day: dict(zip(STATS_COUNTERS, (int(value or 0) for value in values))) for day, *values in rows}
+    days = [date_from + dt.timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+    return [{'day': day, **totals.get(day, dict.fromkeys(STATS_COUNTERS, 0))} for day in days]
@@ -1,3 +1,135 @@
+import datetime as dt
+import os
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.types import Date, Time, TypeDecorator
+from .config import DB_BACKEND, DB_USER, DB_PW, DB_ADDRESS, DB_PORT, DB_NAME, DB_PATH, DB_POOL_SIZE, \
+    DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_SQLITE_SYNCHRONOUS, DB_SQLITE_CACHE_SIZE, \
+    DB_SQLITE_MMAP_SIZE, DB_SQLITE_BUSY_TIMEOUT, DB_REPLICAS, DB_REPLICA_CONNECT_TIMEOUT
+from .replicas import REPLICA_BIND_PREFIX, RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def get_database_uri() -> str:
+    """
+    Returns the SQLAlchemy database URI for the backend configured in config.ini.
+    :return: Database URI as string.
+    """
+    if DB_BACKEND == 'sqlite':
+        return f'sqlite:///{os.path.abspath(DB_PATH)}'
+    return f'mysql+pymysql://{DB_USER}:{DB_PW}@{DB_ADDRESS}:{DB_PORT}/{DB_NAME}'
+
+
+def get_replica_binds() -> dict[str, str]:
+    """
+    Returns the SQLAlchemy binds of the mysql read replicas configured in config.ini. The replicas use the same
+    credentials and database name as the primary. A short connect timeout keeps an unreachable replica from holding
+    up the lag check and the reads for long.
+    :return: Dictionary mapping bind keys to database URIs, empty if no replicas are configured.
+    """
+    if DB_BACKEND != 'mysql':
+        return {}
+    return {f'{REPLICA_BIND_PREFIX}{number}': f'mysql+pymysql://{DB_USER}:{DB_PW}@{address}/{DB_NAME}'
+                                                  f'?connect_timeout={DB_REPLICA_CONNECT_TIMEOUT}'
+            for number, address in enumerate(DB_REPLICAS, start=1)}
+
+
+def get_async_database_uri() -> str:
+    """
+    Returns the SQLAlchemy database URI with the async driver for the backend configured in config.ini.
+    :return: Database URI as string.
+    """
+    if DB_BACKEND == 'sqlite':
+        return f'sqlite+aiosqlite:///{os.path.abspath(DB_PATH)}'
+    return f'mysql+aiomysql://{DB_USER}:{DB_PW}@{DB_ADDRESS}:{DB_PORT}/{DB_NAME}'
+
+
+def get_engine_options() -> dict:
+    """
+    Returns the engine options for the backend configured in config.ini.
+    :return: Engine options as dictionary.
+    """
+    options = {'pool_size': DB_POOL_SIZE,
+               'max_overflow': DB_MAX_OVERFLOW,
+               'pool_timeout': DB_POOL_TIMEOUT,
+               'pool_recycle': DB_POOL_RECYCLE,
+               'pool_pre_ping': DB_POOL_PRE_PING}
+    if DB_BACKEND == 'sqlite':
+        options.update({'poolclass': QueuePool,
+                        'pool_pre_ping': False,
+                        'connect_args': {'timeout': DB_SQLITE_BUSY_TIMEOUT / 1000, 'check_same_thread': False}})
+    return options
+
+
+def get_async_engine_options() -> dict:
+    """
+    Returns the engine options of get_engine_options for an async engine.
+    :return: Engine options as dictionary.
+    """
+    options = get_engine_options()
+    if DB_BACKEND == 'sqlite':
+        options['poolclass'] = AsyncAdaptedQueuePool
+    return options
+
+
+def sqlite_pragmas() -> list[str]:
+    """
+    Returns the PRAGMA statements every SQLite connection is tuned with, see configure_sqlite.
+    :return: List of statements.
+    """
+    return ['PRAGMA journal_mode=WAL',
+            f'PRAGMA synchronous={DB_SQLITE_SYNCHRONOUS}',
+            f'PRAGMA cache_size=-{DB_SQLITE_CACHE_SIZE}',
+            f'PRAGMA mmap_size={DB_SQLITE_MMAP_SIZE}',
+            f'PRAGMA busy_timeout={DB_SQLITE_BUSY_TIMEOUT}',
+            'PRAGMA temp_store=MEMORY',
+            'PRAGMA foreign_keys=ON']
+
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record) -> None:
+    """
+    Tunes every new SQLite connection: write-ahead logging lets readers of all worker processes continue while one
+    process writes, NORMAL synchronous mode only syncs at checkpoints and the busy timeout makes concurrent writers
+    wait for each other instead of failing.
+    :param dbapi_connection: New DBAPI connection.
+    :param connection_record: Pool record of the connection.
+    :return: None.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas():
+        cursor.execute(pragma)
+    cursor.close()
+
+
+class IsoDate(TypeDecorator):
+    """
+    Date column that also accepts dates given as YYYY-MM-DD strings, as they come from the forms, on every backend.
+    """
+    impl = Date
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return dt.date.fromisoformat(value)
+        return value
+
+
+class IsoTime(TypeDecorator):
+    """
+    Time column that also accepts times given as HH:MM or HH:MM:SS strings, as they come from the forms, on every
+    backend.
+    """
+    impl = Time
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return dt.datetime.strptime(value, "%H:%M:%S" if value.count(':') == 2 else "%H:%M").time()
+        return value
@@ -1,10 +1,32 @@
-from sqlalchemy import and_
+import datetime as dt
+import json
+from sqlalchemy import Insert, Select, and_, case, or_, func, insert, literal_column, select, update
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
+from .config import DB_BACKEND
 from .storage import db
-from .models import Person, Appointment, Result, User, Staff
+from .replicas import reads_from_replica, writes_to_primary
+from .models import Person, Appointment, Result, User, Staff, MailQueue, QueueEvent
 from typing import Optional
+from .slots import reserve_slot
+from .stats import RESULT_COUNTERS, SlotKey, count_stats
+from .validation import test_result_is_valid
 from secrets import token_urlsafe
 
+PUBLIC_ID_BYTES = 16
+
+
+def new_public_id() -> str:
+    """
+    Returns a new random identifier for appointments and results as used in links and QRCodes. 16 random bytes
+    encode to 22 URL-safe characters.
+    :return: Identifier as string.
+    """
+    return token_urlsafe(nbytes=PUBLIC_ID_BYTES)
+
 
 def email_exists(email: str) -> bool:
     """
@@ -67,6 +89,7 @@ def add_person(person: dict) -> bool:
     return True
 
 
+@writes_to_primary
 def update_person(person_id: str, updates: dict) -> bool:
     """
     Updates a person information on the person table in the database if the person exists.
@@ -98,6 +121,7 @@ def get_person_id(email: str) -> Optional[str]:
     return person.person_id if person else None
 
 
+@reads_from_replica
 def get_person(person_id: str) -> Optional[Person]:
     """
     Returns the person for the given person ID as a Person object as defined in models.
@@ -122,41 +146,136 @@ def appointment_exists(person_id: str, appointment_day: str, appointment_time: s
     return True if appointment else False
 
 
-def add_appointment(email: str, appointment_day: str, appointment_time: str) -> bool:
+def person_values(person: dict) -> dict:
     """
-    Adds an appointment to the appointment table if the appointment does not already exist.
-    :param email: Email address of user that requests an appointment.
-    :param appointment_day: Date of appointment as string.
-    :param appointment_time: Time of appointment as string.
-    :return: True if a new appointment was added, False if appointment already exists.
+    Maps a person as sent by the booking form to the columns of the person table.
+    :param person: Person as a dictionary.
+    :return: Dictionary mapping column names to values.
     """
-    person_id = get_person_id(email=email)
-    if person_id is None:
-        raise TypeError(f"User {email} not found when trying to add appointment")
-    if appointment_exists(person_id=person_id, appointment_day=appointment_day, appointment_time=appointment_time):
-        return False
+    return {'last_name': person['last_name'],
+            'first_name': person['first_name'],
+            'email': person['email1'],
+            'tel': person['tel'],
+            'birthdate': person['birthdate'],
+            'gender': person['gender'],
+            'street': person['street'],
+            'number': person['number'],
+            'post_code': person['post_code'],
+            'city': person['city'],
+            'country': person['country'],
+            'passport_number': person['passport']}
 
-    appointment_id = token_urlsafe(nbytes=128)
-    new_appointment = Appointment(appointment_id=appointment_id,
-                                  person_id=person_id,
-                                  appointment_day=appointment_day,
-                                  appointment_time=appointment_time)
-    db.session.add(new_appointment)
-    db.session.commit()
-    db.session.close()
-    return True
 
+def upsert_person_statement(values: dict, dialect: str) -> Optional[Insert]:
+    """
+    Returns the insert that adds a person and yields the person ID of the new or the existing person with the same
+    email address, see upserted_person_id.
+    :param values: Person as returned by person_values.
+    :param dialect: Name of the database dialect.
+    :return: Insert statement or None if the dialect has no upsert.
+    """
+    if dialect == 'mysql':
+        return mysql_insert(Person.__table__).values(**values) \
+            .on_duplicate_key_update(person_id=func.last_insert_id(Person.__table__.c.person_id))
+    if dialect == 'sqlite':
+        statement = sqlite_insert(Person.__table__).values(**values)
+        return statement.on_conflict_do_update(index_elements=['email'], set_={'email': statement.excluded.email}) \
+            .returning(Person.__table__.c.person_id)
+    return None
+
+
+def upserted_person_id(result: CursorResult, dialect: str) -> int:
+    """
+    Returns the person ID from the result of upsert_person_statement.
+    :param result: Result of the executed statement.
+    :param dialect: Name of the database dialect.
+    :return: Person ID of the new or existing person.
+    """
+    return result.lastrowid if dialect == 'mysql' else result.scalar()
 
+
+def upsert_person(person: dict) -> int:
+    """
+    Inserts a person unless a person with the same email address exists already. Duplicates are detected by the
+    unique constraint on the email address instead of reading before writing. Does not commit.
+    :param person: Person as a dictionary.
+    :return: Person ID of the new or existing person.
+    """
+    values = person_values(person=person)
+    dialect = db.session.get_bind().dialect.name
+    statement = upsert_person_statement(values=values, dialect=dialect)
+    if statement is not None:
+        return upserted_person_id(result=db.session.execute(statement), dialect=dialect)
+    try:
+        with db.session.begin_nested():
+            return db.session.execute(insert(Person.__table__).values(**values)).inserted_primary_key[0]
+    except IntegrityError:
+        return db.session.query(Person.person_id).filter(Person.email == values['email']).scalar()
+
+
+def booked_appointment_query(person: dict) -> Select:
+    """
+    Returns the query for the appointment the person of a booking already has in the booked slot.
+    :param person: Person and appointment details as a dictionary as sent by the booking form.
+    :return: Select statement for the appointment ID.
+    """
+    return select(Appointment.appointment_id) \
+        .join(Person, Person.person_id == Appointment.person_id) \
+        .where(and_(Person.email == person['email1'],
+                    Appointment.appointment_day == person['appointment_day'],
+                    Appointment.appointment_time == person['appointment_time']))
+
+
+def book_appointment(person: dict) -> Optional[str]:
+    """
+    Books an appointment in a single transaction: reserves a place in the slot, adds the person if it does not exist
+    yet, inserts the appointment and queues the booking confirmation. Duplicate appointments are rejected by the
+    unique constraint on person and slot. If the slot is full, an existing appointment of the person in it is
+    reported as duplicate instead.
+    :param person: Person and appointment details as a dictionary as sent by the booking form.
+    :return: Appointment ID of the new appointment or None if the person already booked this slot.
+    """
+    if reserve_slot(appointment_day=person['appointment_day'], appointment_time=person['appointment_time']) is None:
+        db.session.rollback()
+        booked = db.session.execute(booked_appointment_query(person=person)).first()
+        db.session.close()
+        if booked is not None:
+            return None
+        raise RuntimeError("The selected appointment slot is fully booked. Please choose another slot.")
+    person_id = upsert_person(person=person)
+    appointment_id = new_public_id()
+    try:
+        db.session.execute(insert(Appointment.__table__).values(appointment_id=appointment_id,
+                                                                person_id=person_id,
+                                                                appointment_day=person['appointment_day'],
+                                                                appointment_time=person['appointment_time']))
+        count_stats(counts={(person['appointment_day'], person['appointment_time']): {'bookings': 1}})
+        queue_mails(mails=[booking_confirmation_mail(person=person, appointment_id=appointment_id)])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    finally:
+        db.session.close()
+    return appointment_id
+
+
+@writes_to_primary
 def verify_appointment(appointment_id: str) -> bool:
     """
-    Verifies an appointment by updating the verified column on the database table if appointment exists.
+    Verifies an appointment by updating the verified column on the database table if appointment exists. Only the
+    first verification is counted in the statistics.
     :param appointment_id: Appointment ID as string.
     :return: True if appointment was updated, False if appointment does not exist.
     """
     appointment = get_appointment(appointment_id=appointment_id)
     if appointment is None:
         return False
-    db.session.query(Appointment).filter(Appointment.appointment_id == appointment_id).update({'verified': 'Y'})
+    if db.session.query(Appointment) \
+            .filter(and_(Appointment.appointment_id == appointment_id, Appointment.verified != 'Y')) \
+            .update({'verified': 'Y'}):
+        count_stats(counts={(appointment.appointment_day, appointment.appointment_time): {'verified': 1}})
+        record_queue_events(kind='verified', appointment_keys=[appointment.id])
     db.session.commit()
     db.session.close()
     return True
@@ -176,6 +295,7 @@ def get_appointment_id(person_id: str, appointment_day: str, appointment_time: s
     return appointment.appointment_id if appointment else None
 
 
+@reads_from_replica
 def get_appointment(appointment_id: str) -> Optional[Appointment]:
     """
     Returns the Appointment object for the given appointment ID.
@@ -196,13 +316,59 @@ def get_appointment_by_key(key: str) -> Optional[Appointment]:
     return appointment if appointment else None
 
 
-def get_verified_appointments() -> list[Appointment]:
-    """
-    Returns a list of all verified appointments that have no corresponding result.
-    :return: List of verified appointments without result.
+@reads_from_replica
+def get_verified_appointments(day: Optional[str] = None, time_from: Optional[str] = None,
+                              time_to: Optional[str] = None, after: Optional[str] = None,
+                              limit: int = 50) -> tuple[list[Appointment], Optional[str]]:
+    """
+    Returns one page of verified appointments that have no corresponding result, ordered by appointment day and
+    time. Pages are addressed by the cursor of the previous page (keyset pagination) and the person of each
+    appointment is loaded in the same query.
+    :param day: Only return appointments on this date (YYYY-MM-DD) if given.
+    :param time_from: Only return appointments at or after this time (HH:MM) if given.
+    :param time_to: Only return appointments at or before this time (HH:MM) if given.
+    :param after: Cursor of the previous page as string, None for the first page.
+    :param limit: Maximum number of appointments on a page.
+    :return: Tuple of the verified appointments without result on the page and the cursor of the next page or
+    None if there are no more appointments.
+    """
+    query = db.session.query(Appointment) \
+        .join(Result, isouter=True) \
+        .options(joinedload(Appointment.person)) \
+        .filter(and_(Appointment.verified == 'Y', Result.id.is_(None)))
+    if day:
+        query = query.filter(Appointment.appointment_day == dt.date.fromisoformat(day))
+    if time_from:
+        query = query.filter(Appointment.appointment_time >= dt.datetime.strptime(time_from, "%H:%M").time())
+    if time_to:
+        query = query.filter(Appointment.appointment_time <= dt.datetime.strptime(time_to, "%H:%M").time())
+    if after:
+        after_day, after_time, after_key = parse_appointment_cursor(cursor=after)
+        query = query.filter(or_(Appointment.appointment_day > after_day,
+                                 and_(Appointment.appointment_day == after_day,
+                                      or_(Appointment.appointment_time > after_time,
+                                          and_(Appointment.appointment_time == after_time,
+                                               Appointment.id > after_key)))))
+    appointments = query.order_by(Appointment.appointment_day, Appointment.appointment_time, Appointment.id) \
+        .limit(limit + 1).all()
+    if len(appointments) <= limit:
+        return appointments, None
+    appointments = appointments[:limit]
+    last = appointments[-1]
+    return appointments, f"{last.appointment_day.isoformat()}_{last.appointment_time.strftime('%H:%M:%S')}_{last.id}"
+
+
+def parse_appointment_cursor(cursor: str) -> tuple[dt.date, dt.time, int]:
+    """
+    Splits a page cursor as returned by get_verified_appointments into its keyset values.
+    :param cursor: Page cursor as string.
+    :return: Tuple of appointment day, appointment time and internal ID of the last appointment of the previous page.
     """
-    appointments = db.session.query(Appointment).join(Result, isouter=True).filter(and_(Appointment.verified == 'Y', Result.id.is_(None))).all()
-    return appointments
+    try:
+        day, time, key = cursor.split('_')
+        return dt.date.fromisoformat(day), dt.time.fromisoformat(time), int(key)
+    except ValueError:
+        raise ValueError(f"Invalid page cursor {cursor}.")
 
 
 def result_exists(appointment_id: str) -> bool:
@@ -211,13 +377,16 @@ def result_exists(appointment_id: str) -> bool:
     :param appointment_id: ID of the person requesting an appointment.
     :return: True if result already exists, False otherwise.
     """
-    result = Result.query.filter_by(appointment_id=appointment_id).first()
+    result = db.session.query(Result.id) \
+        .join(Appointment, Appointment.id == Result.appointment_key) \
+        .filter(Appointment.appointment_id == appointment_id).first()
     return True if result else False
 
 
+@writes_to_primary
 def add_result(appointment_id: str, person_id: str, result: str) -> bool:
     """
-    Add result to database if appointment ID exists.
+    Add result to database if appointment ID exists and queue the notification of the person in the same transaction.
     :param appointment_id: Appointment ID as string.
     :param person_id: Person ID as integer.
     :param result: Test result as string.
@@ -225,33 +394,120 @@ def add_result(appointment_id: str, person_id: str, result: str) -> bool:
     """
     if appointment_id is None:
         raise TypeError(f"No appointment ID given when trying to add result")
-    if result_exists(appointment_id=appointment_id):
-        raise RuntimeError(f"Result for person {person_id} was not added because a result already exists.")
-
     appointment = get_appointment(appointment_id=appointment_id)
     if not appointment:
         raise RuntimeError(f"Result for person {person_id} was not added because no corresponding appointment exists.")
+    if Result.query.filter_by(appointment_key=appointment.id).first():
+        raise RuntimeError(f"Result for person {person_id} was not added because a result already exists.")
 
-    result_id = token_urlsafe(nbytes=128)
+    result_id = new_public_id()
     new_result = Result(result_id=result_id,
-                        appointment_id=appointment_id,
+                        appointment_key=appointment.id,
                         person_id=person_id,
                         result=result,
                         test_day=appointment.appointment_day,
                         test_time=appointment.appointment_time)
     db.session.add(new_result)
+    if result in RESULT_COUNTERS:
+        count_stats(counts={(appointment.appointment_day, appointment.appointment_time): {RESULT_COUNTERS[result]: 1}})
+    record_queue_events(kind='result', appointment_keys=[appointment.id])
+    queue_mails(mails=[result_notification_mail(email=appointment.person.email,
+                                                first_name=appointment.person.first_name,
+                                                appointment_id=appointment.appointment_id)])
     db.session.commit()
     db.session.close()
     return True
 
 
+def add_results(results: dict[str, str]) -> tuple[list[dict], dict[str, str]]:
+    """
+    Add results for many appointments at once. All appointments are validated with a single query and all results
+    are inserted in one transaction together with the notifications of the persons. If a concurrent request adds a
+    result for one of the appointments in the meantime, the unique constraint on the appointment rejects the insert;
+    the transaction is then rolled back and the check is repeated, so the duplicates are reported as errors and the
+    other results are added.
+    :param results: Dictionary mapping appointment internal IDs (primary keys) as strings to test results.
+    :return: Tuple of a list with the details of each person a result was added for (key, email, first name and
+    appointment ID) and a dictionary mapping the keys of rejected entries to the reason.
+    """
+    errors = {key: f"Result for appointment {key} was not added because the result is invalid."
+              for key, result in results.items() if not test_result_is_valid(result)}
+    while True:
+        keys = [key for key in results if key not in errors]
+        new_results, added, counts = check_results(results=results, keys=keys, errors=errors)
+        if not new_results:
+            break
+        try:
+            db.session.execute(insert(Result), new_results)
+        except IntegrityError:
+            db.session.rollback()
+            rejected = len(errors)
+            check_results(results=results, keys=keys, errors=errors)
+            if len(errors) == rejected:
+                raise
+            continue
+        count_stats(counts=counts)
+        record_queue_events(kind='result', appointment_keys=[result['appointment_key'] for result in new_results])
+        queue_mails(mails=[result_notification_mail(email=person['email'], first_name=person['first_name'],
+                                                    appointment_id=person['appointment_id']) for person in added])
+        db.session.commit()
+        break
+    db.session.close()
+    return added, errors
+
+
+def check_results(results: dict[str, str], keys: list[str], errors: dict[str, str]) \
+        -> tuple[list[dict], list[dict], dict[SlotKey, dict[str, int]]]:
+    """
+    Validates the appointments of the given results with a single query. Appointments that do not exist or already
+    have a result are added to errors.
+    :param results: Dictionary mapping appointment internal IDs (primary keys) as strings to test results.
+    :param keys: Keys of the results to check.
+    :param errors: Dictionary mapping the keys of rejected entries to the reason, updated in place.
+    :return: Tuple of the rows to insert into the result table, the details of each person a result is added for and
+    the amounts to add to the statistics per slot (see count_stats).
+    """
+    found = set()
+    new_results = []
+    added = []
+    counts = {}
+    rows = db.session.query(Appointment, Person.email, Person.first_name, Result.id) \
+        .join(Person, Person.person_id == Appointment.person_id) \
+        .join(Result, isouter=True) \
+        .filter(Appointment.id.in_(keys)).all() if keys else []
+    for appointment, email, first_name, result_id in rows:
+        key = str(appointment.id)
+        found.add(key)
+        if result_id is not None:
+            errors[key] = f"Result for person {appointment.person_id} was not added because a result already exists."
+            continue
+        new_results.append({'result_id': new_public_id(),
+                            'appointment_key': appointment.id,
+                            'person_id': appointment.person_id,
+                            'result': results[key],
+                            'test_day': appointment.appointment_day,
+                            'test_time': appointment.appointment_time})
+        added.append({'key': key, 'email': email, 'first_name': first_name,
+                      'appointment_id': appointment.appointment_id})
+        slot_counts = counts.setdefault((appointment.appointment_day, appointment.appointment_time), {})
+        counter = RESULT_COUNTERS[results[key]]
+        slot_counts[counter] = slot_counts.get(counter, 0) + 1
+    for key in keys:
+        if key not in found:
+            errors[key] = f"Result for appointment {key} was not added because no corresponding appointment exists."
+    return new_results, added, counts
+
+
+@reads_from_replica
 def get_result_by_app_id(appointment_id: str) -> Optional[Result]:
     """
     Return Result object for given appointment ID.
     :param appointment_id: Appointment ID as string.
     :return: Result object or None if no such object exists.
     """
-    result = Result.query.filter_by(appointment_id=appointment_id).first()
+    result = Result.query \
+        .join(Appointment, Appointment.id == Result.appointment_key) \
+        .filter(Appointment.appointment_id == appointment_id).first()
     return result if result else None
 
 
@@ -275,6 +531,19 @@ def get_user_pw(username: str) -> str:
     return user.password
 
 
+def get_login(username: str) -> Optional[tuple[int, str, Optional[str], bool]]:
+    """
+    Returns everything a login needs to know about a user with a single query joining User and Staff.
+    :param username: Email address of the user as string.
+    :return: Tuple of user ID, username, password hash and True if the user is an admin or None if the user does not
+    exist.
+    """
+    row = db.session.query(User.id, User.username, User.password, Staff.admin) \
+        .join(Staff, Staff.email == User.username, isouter=True) \
+        .filter(User.username == username).first()
+    return (row[0], row[1], row[2], row[3] == 'Y') if row else None
+
+
 def get_staff(username: str) -> Optional[User]:
     """
     Returns the User object for the given email address.
@@ -285,6 +554,18 @@ def get_staff(username: str) -> Optional[User]:
     return staff if staff else None
 
 
+def get_identity(user_id: str) -> Optional[tuple[int, str, bool]]:
+    """
+    Returns ID, username and admin flag of a user with a single query joining User and Staff.
+    :param user_id: User ID as string.
+    :return: Tuple of user ID, username and True if the user is an admin or None if the user does not exist.
+    """
+    row = db.session.query(User.id, User.username, Staff.admin) \
+        .join(Staff, Staff.email == User.username, isouter=True) \
+        .filter(User.id == user_id).first()
+    return (row[0], row[1], row[2] == 'Y') if row else None
+
+
 def is_admin(username: str) -> bool:
     """
     Checks whether user is an admin or not.
@@ -293,3 +574,173 @@ def is_admin(username: str) -> bool:
     """
     staff = Staff.query.filter_by(email=username).first()
     return staff.admin == 'Y' if staff else False
+
+
+def record_queue_events(kind: str, appointment_keys: list[int]) -> None:
+    """
+    Records changes of the staff queue for the live staff and admin panels, see events. Does not commit, so the
+    changes are only announced if the surrounding transaction succeeds.
+    :param kind: verified if the appointments were verified, result if results were added for them.
+    :param appointment_keys: Internal IDs (primary keys) of the changed appointments.
+    :return: None.
+    """
+    if appointment_keys:
+        db.session.execute(insert(QueueEvent), [{'kind': kind, 'appointment_key': key} for key in appointment_keys])
+
+
+def get_last_queue_event_id(grace: int) -> int:
+    """
+    Returns the ID of the latest change of the staff queue that is older than the grace period. Event IDs are assigned
+    when the event is inserted, not when it is committed, so younger events may still be followed by events with
+    lower IDs and are delivered to the panels again until they are older.
+    :param grace: Seconds after which the transaction of an event is assumed to be committed.
+    :return: Event ID, 0 if the queue never changed.
+    """
+    return db.session.query(QueueEvent.id).filter(QueueEvent.created_at <= seconds_from_now(seconds=-grace)) \
+        .order_by(QueueEvent.id.desc()).limit(1).scalar() or 0
+
+
+def get_queue_events(after: int, limit: int, grace: int) \
+        -> list[tuple[QueueEvent, Optional[Appointment], bool, bool]]:
+    """
+    Returns the changes of the staff queue after the given event with the changed appointments and their persons.
+    :param after: ID of the last event that is already known.
+    :param limit: Maximum number of events.
+    :param grace: Seconds after which the transaction of an event is assumed to be committed, see
+    get_last_queue_event_id.
+    :return: List of tuples of the event, the appointment or None if it was deleted meanwhile, True if the
+    appointment has a result and True if the event is older than the grace period, in the order of the event IDs.
+    """
+    settled = QueueEvent.created_at <= seconds_from_now(seconds=-grace)
+    rows = db.session.query(QueueEvent, Appointment, Result.id, settled) \
+        .join(Appointment, Appointment.id == QueueEvent.appointment_key, isouter=True) \
+        .join(Result, Result.appointment_key == Appointment.id, isouter=True) \
+        .options(joinedload(Appointment.person)) \
+        .filter(QueueEvent.id > after) \
+        .order_by(QueueEvent.id).limit(limit).all()
+    return [(event, appointment, result_id is not None, bool(is_settled))
+            for event, appointment, result_id, is_settled in rows]
+
+
+def booking_confirmation_mail(person: dict, appointment_id: str) -> dict:
+    """
+    Returns the queued email confirming a booking, see queue_mails.
+    :param person: Person and appointment details as a dictionary as sent by the booking form.
+    :param appointment_id: Appointment ID of the new appointment.
+    :return: Dictionary with kind, recipient and payload of the email.
+    """
+    return {'kind': 'booking_confirmation', 'recipient': person['email1'],
+            'payload': json.dumps({'first_name': person['first_name'], 'appointment_day': person['appointment_day'],
+                                   'appointment_time': person['appointment_time'],
+                                   'appointment_id': appointment_id})}
+
+
+def result_notification_mail(email: str, first_name: str, appointment_id: str) -> dict:
+    """
+    Returns the queued email notifying a person that their result is available, see queue_mails.
+    :param email: Email address of the person.
+    :param first_name: First name of the person.
+    :param appointment_id: Appointment ID the result was added for.
+    :return: Dictionary with kind, recipient and payload of the email.
+    """
+    return {'kind': 'result_notification', 'recipient': email,
+            'payload': json.dumps({'first_name': first_name, 'appointment_id': appointment_id})}
+
+
+def queue_mails(mails: list[dict]) -> None:
+    """
+    Queues emails to be sent later by the mail worker. Does not commit, so the emails are only queued if the
+    surrounding transaction succeeds.
+    :param mails: List of dictionaries with kind, recipient and payload (JSON string) of each email.
+    :return: None.
+    """
+    if mails:
+        db.session.execute(insert(MailQueue), mails)
+
+
+def seconds_from_now(seconds: int):
+    """
+    Returns the time the given number of seconds after the current time of the database, so all schedule times of
+    queued emails and the ages of queue events are compared against the same clock as their default func.now().
+    :param seconds: Number of seconds, negative for a time in the past.
+    :return: SQL expression.
+    """
+    if DB_BACKEND == 'sqlite':
+        return func.datetime('now', f"{int(seconds):+d} seconds")
+    return func.timestampadd(literal_column('SECOND'), int(seconds), func.now())
+
+
+def claim_mails(limit: int, lease: int) -> tuple[list[MailQueue], Optional[dt.datetime]]:
+    """
+    Claims the queued emails that are due longest for delivery. Claimed emails are not due again until the lease
+    ends, so concurrent mail workers never send the same email, and emails of a worker that died are sent again after
+    the lease.
+    :param limit: Maximum number of emails.
+    :param lease: Seconds the emails are reserved for this delivery.
+    :return: Tuple of the claimed MailQueue objects in the order they were queued and the time of the database when
+    they were claimed or None if no email is due.
+    """
+    due = and_(MailQueue.sent_at.is_(None), MailQueue.next_attempt_at <= func.now())
+    mail_ids = db.session.execute(select(MailQueue.id).where(due)
+                                  .order_by(MailQueue.next_attempt_at, MailQueue.id).limit(limit)).scalars().all()
+    if not mail_ids:
+        db.session.commit()
+        return [], None
+    claim = token_urlsafe(24)
+    db.session.execute(update(MailQueue).where(and_(MailQueue.id.in_(mail_ids), due))
+                       .values(claim=claim, next_attempt_at=seconds_from_now(seconds=lease)))
+    now = db.session.execute(select(func.now())).scalar()
+    db.session.commit()
+    claimed = MailQueue.query.filter(MailQueue.id.in_(mail_ids), MailQueue.claim == claim) \
+        .order_by(MailQueue.id).all()
+    return claimed, now
+
+
+def mark_mails_sent(mail_ids: list[int], claim: str) -> None:
+    """
+    Marks queued emails as sent. Emails another delivery claimed after the lease ended are left to that delivery.
+    :param mail_ids: IDs of the queued emails.
+    :param claim: Claim of the delivery that sent them.
+    :return: None.
+    """
+    if mail_ids:
+        db.session.execute(update(MailQueue).where(and_(MailQueue.id.in_(mail_ids), MailQueue.claim == claim))
+                           .values(sent_at=func.now(), next_attempt_at=None, claim=None,
+                                   attempts=MailQueue.attempts + 1))
+        db.session.commit()
+
+
+def mark_mails_failed(failures: dict[int, tuple[Optional[int], str]], claim: str) -> None:
+    """
+    Counts a failed delivery attempt for queued emails and schedules their next attempt. Emails without a next
+    attempt are moved to the dead letters, they stay in the table with their last error but are not sent anymore.
+    Like mark_mails_sent, only emails still claimed by the delivery are changed.
+    :param failures: Dictionary mapping the IDs of the queued emails to tuples of the seconds until the next attempt
+    or None for dead letters and the error.
+    :param claim: Claim of the delivery that failed.
+    :return: None.
+    """
+    for mail_id, (delay, error) in failures.items():
+        values = {'attempts': MailQueue.attempts + 1, 'claim': None, 'last_error': error[:300]}
+        if delay is None:
+            values.update(next_attempt_at=None, dead_at=func.now())
+        else:
+            values.update(next_attempt_at=seconds_from_now(seconds=delay))
+        db.session.execute(update(MailQueue).where(and_(MailQueue.id == mail_id, MailQueue.claim == claim))
+                           .values(**values))
+    if failures:
+        db.session.commit()
+
+
+def get_mail_queue_depth() -> dict[str, int]:
+    """
+    Counts the unsent emails.
+    :return: Dictionary with the number of emails that are due, waiting for their next attempt or dead letters.
+    """
+    row = db.session.execute(select(
+        func.count(case((MailQueue.next_attempt_at <= func.now(), 1))),
+        func.count(case((MailQueue.next_attempt_at > func.now(), 1))),
+        func.count(case((MailQueue.next_attempt_at.is_(None), 1))))
+        .where(MailQueue.sent_at.is_(None))).one()
+    db.session.commit()
+    return {'due': row[0], 'waiting': row[1], 'dead': row[2]}
@@ -0,0 +1,195 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+from flask import Flask
+from .config import LOGIN_THROTTLE_PATH, LOGIN_USER_BURST, LOGIN_USER_PER_MINUTE, LOGIN_IP_BURST, \
+    LOGIN_IP_PER_MINUTE
+
+PRUNE_INTERVAL = 60.0
+
+
+class TokenBucket:
+    """
+    Allowance of login attempts: up to burst attempts at once, refilled by per_minute attempts per minute.
+    """
+
+    def __init__(self, name: str, burst: int, per_minute: float, failures_only: bool = False) -> None:
+        """
+        :param name: Name of the bucket as used in the store and the metrics, e.g. username or ip.
+        :param burst: Attempts allowed at once, 0 disables the bucket.
+        :param per_minute: Attempts refilled per minute.
+        :param failures_only: True if only failed attempts take from the bucket, so successful logins never use it up.
+        """
+        self.name = name
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.failures_only = failures_only
+
+    def tokens(self, stored: Optional[tuple[float, float]], now: float) -> float:
+        """
+        Returns the attempts left in a bucket.
+        :param stored: Tuple of the attempts left and the time they were stored or None for a full bucket.
+        :param now: Current time as UNIX timestamp.
+        :return: Attempts left, fractions count towards the next attempt.
+        """
+        if stored is None:
+            return self.burst
+        return min(self.burst, stored[0] + max(0.0, now - stored[1]) * self.rate)
+
+    def full_after(self) -> float:
+        """
+        Returns the seconds after which an empty bucket is full again, so its stored state can be dropped.
+        :return: Seconds.
+        """
+        return self.burst / self.rate if self.rate else float('inf')
+
+
+class LoginThrottle:
+    """
+    Token buckets of login attempts per username and per client IP address. The buckets are kept in a local SQLite
+    file, so all worker processes of a server share them, and are checked before the user is looked up and the
+    password is hashed, so rejected attempts cost neither a query nor a hash.
+    """
+
+    def __init__(self, path: str, buckets: list[TokenBucket]) -> None:
+        """
+        :param path: Path of the SQLite file, created if it does not exist, or empty for the instance folder.
+        :param buckets: Token buckets, in the order in which they are reported when exhausted.
+        """
+        self.path = path
+        self.buckets = [bucket for bucket in buckets if bucket.burst > 0]
+        self._local = threading.local()
+        self._pruned = 0.0
+
+    def init_app(self, app: Flask) -> None:
+        """
+        Keeps the SQLite file in the instance folder of the application unless a path is configured.
+        :param app: Flask application.
+        :return: None.
+        """
+        if not self.path:
+            os.makedirs(app.instance_path, exist_ok=True)
+            self.path = os.path.join(app.instance_path, 'login-throttle.db')
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the SQLite file.
+        :return: Connection in autocommit mode, transactions are started explicitly.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS login_bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated REAL NOT NULL) WITHOUT ROWID')
+            self._local.connection = connection
+        return connection
+
+    def keyed(self, username: str, address: Optional[str]) -> list[tuple[TokenBucket, str]]:
+        """
+        Returns the buckets with the keys of the given username and client IP address.
+        :param username: Username of the attempt.
+        :param address: IP address of the client or None if unknown.
+        :return: List of tuples of the bucket and its key in the store.
+        """
+        keys = {'username': username.strip().lower()[:254], 'ip': address or 'unknown'}
+        return [(bucket, f"{bucket.name}:{keys[bucket.name]}") for bucket in self.buckets]
+
+    def take(self, buckets: list[tuple[TokenBucket, str]], now: float, charged: Callable[[TokenBucket], bool],
+             reject: bool) -> Optional[tuple[str, float]]:
+        """
+        Takes one attempt from the charged buckets in one transaction.
+        :param buckets: List of tuples of the bucket and its key in the store.
+        :param now: Current time as UNIX timestamp.
+        :param charged: Function returning whether an attempt is taken from a bucket.
+        :param reject: True to take nothing if a bucket has no attempt left, False to take from the charged buckets
+        down to zero.
+        :return: None or, if rejected, a tuple of the name of the exhausted bucket and the seconds until it allows
+        the next attempt.
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            left = []
+            for bucket, key in buckets:
+                stored = connection.execute('SELECT tokens, updated FROM login_bucket WHERE key = ?',
+                                            (key,)).fetchone()
+                tokens = bucket.tokens(stored=stored, now=now)
+                if reject and tokens < 1:
+                    connection.execute('ROLLBACK')
+                    return bucket.name, (1 - tokens) / bucket.rate if bucket.rate else float('inf')
+                if charged(bucket):
+                    left.append((key, max(0.0, tokens - 1), now))
+            connection.executemany('INSERT OR REPLACE INTO login_bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                                   left)
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return None
+
+    def attempt(self, username: str, address: Optional[str], now: Optional[float] = None) \
+            -> Optional[tuple[str, float]]:
+        """
+        Checks that the buckets of the given username and client IP address have an attempt left and takes one from
+        the buckets that count every attempt. Rejected attempts do not take anything, so the buckets refill while an
+        attack goes on.
+        :param username: Username of the attempt.
+        :param address: IP address of the client or None if unknown.
+        :param now: Current time as UNIX timestamp, defaults to now.
+        :return: None if the attempt is allowed or a tuple of the name of the exhausted bucket and the seconds until
+        it allows the next attempt.
+        """
+        now = time.time() if now is None else now
+        buckets = self.keyed(username=username, address=address)
+        if not buckets:
+            return None
+        try:
+            throttled = self.take(buckets=buckets, now=now, charged=lambda bucket: not bucket.failures_only,
+                                  reject=True)
+            if throttled is None and now - self._pruned >= PRUNE_INTERVAL:
+                self._pruned = now
+                self.prune(now=now)
+        except sqlite3.Error:
+            # Without the store, logins are only slowed down by the password hash as before.
+            return None
+        return throttled
+
+    def failed(self, username: str, address: Optional[str], now: Optional[float] = None) -> None:
+        """
+        Takes one attempt from the buckets that only count failed attempts, after the password was wrong.
+        :param username: Username of the attempt.
+        :param address: IP address of the client or None if unknown.
+        :param now: Current time as UNIX timestamp, defaults to now.
+        :return: None.
+        """
+        buckets = [(bucket, key) for bucket, key in self.keyed(username=username, address=address)
+                   if bucket.failures_only]
+        if not buckets:
+            return
+        try:
+            self.take(buckets=buckets, now=time.time() if now is None else now, charged=lambda bucket: True,
+                      reject=False)
+        except sqlite3.Error:
+            return
+
+    def prune(self, now: float) -> None:
+        """
+        Drops the buckets that are full again, as a missing bucket counts as full.
+        :param now: Current time as UNIX timestamp.
+        :return: None.
+        """
+        connection = self.connection()
+        for bucket in self.buckets:
+            connection.execute('DELETE FROM login_bucket WHERE key >= ? AND key < ? AND updated < ?',
+                               (f"{bucket.name}:", f"{bucket.name};", now - bucket.full_after()))
+
+
+login_throttle = LoginThrottle(path=LOGIN_THROTTLE_PATH,
+                               buckets=[TokenBucket(name='username', burst=LOGIN_USER_BURST,
+                                                    per_minute=LOGIN_USER_PER_MINUTE, failures_only=True),
+                                        TokenBucket(name='ip', burst=LOGIN_IP_BURST, per_minute=LOGIN_IP_PER_MINUTE)])
@@ -1,38 +1,62 @@
 import datetime as dt
 import re
+from functools import lru_cache
+from typing import Callable, Iterable, NamedTuple, Optional
+
+DATE_PATTERN = re.compile("\\d{4}-\\d{2}-\\d{2}")
+TIME_PATTERN = re.compile("(\\d{1,2}):(\\d{2})")
+EMAIL_PATTERN = re.compile("[^@]+@[^@]+\\.[^@]+")
+TEL_PATTERN = re.compile("\\+?\\d{11,14}")
+HOUSE_NUMBER_PATTERN = re.compile("\\d{1,4}[a-zA-Z]?")
+POSTCODE_PATTERN = re.compile("\\d{5}")
+# Appointment and result IDs are 16 random bytes in URL-safe base64, legacy IDs used 128 random bytes.
+PUBLIC_ID_PATTERN = re.compile("[A-Za-z0-9_-]{22}|[A-Za-z0-9_-]{150,171}")
 
 
 def request_is_valid(request: dict) -> bool:
     """
     Checks if data in the given Request is valid.
     :param request: Flask Request object contain the data from the form.
-    :return: True if the data adheres to the given rules, False otherwise.
-    """
-    if not appointment_is_valid(date=request['appointment_day'], time=request['appointment_time']):
-        raise ValueError("Please select valid appointment details.")
-    if not name_is_valid(request['first_name']) or not name_is_valid(request['last_name']):
-        raise ValueError("Please provide a valid name.")
-    if not email_is_valid(request['email1']):
-        raise ValueError("Please provide a valid email address.")
-    if request['email1'] != request['email2']:
-        raise ValueError("Email addresses do not match. Please check your inputs.")
-    if not tel_is_valid(request['tel']):
-        raise ValueError("Please provide a valid telephone number with a country code (+49 for Germany).")
-    if not birthdate_is_valid(request['birthdate']):
-        raise ValueError("Please select a valid birthdate.")
-    if not name_is_valid(request['street']):
-        raise ValueError("Please provide a valid street name.")
-    if not house_number_is_valid(request['number']):
-        raise ValueError("Please provide a valid house number.")
-    if not postcode_is_valid(request['post_code']):
-        raise ValueError("Please provide a valid post code.")
-    if not name_is_valid(request['city']):
-        raise ValueError("Please provide a valid city name.")
-    if not name_is_valid(request['country']):
-        raise ValueError("Please provide a valid country name.")
+    :return: True if the data adheres to the given rules, raises a ValueError with the message of the first invalid
+    field otherwise.
+    """
+    errors = validate(record=request)
+    if errors:
+        raise ValueError(next(iter(errors.values())))
     return True
 
 
+@lru_cache(maxsize=1024)
+def parse_date(date: str) -> Optional[dt.date]:
+    """
+    Parses a date of format YYYY-MM-DD.
+    :param date: Date as a string.
+    :return: Date or None if the string is no valid date of that format.
+    """
+    if not DATE_PATTERN.fullmatch(date):
+        return None
+    try:
+        return dt.date.fromisoformat(date)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def parse_time(time: str) -> Optional[dt.time]:
+    """
+    Parses a time of format HH:MM.
+    :param time: Time as a string.
+    :return: Time or None if the string is no valid time of that format.
+    """
+    match = TIME_PATTERN.fullmatch(time)
+    if not match:
+        return None
+    try:
+        return dt.time(hour=int(match.group(1)), minute=int(match.group(2)))
+    except ValueError:
+        return None
+
+
 def name_is_valid(name: str) -> bool:
     """
     Check if name is a valid string with only letters in it.
@@ -48,9 +72,7 @@ def date_is_valid(date: str) -> bool:
     :param date: Date passed as string.
     :return: True if date has format YYYY-MM-DD, False otherwise.
     """
-    if re.fullmatch("\\d{4}-\\d{2}-\\d{2}", date):
-        return True
-    return False
+    return parse_date(date) is not None
 
 
 def time_is_valid(time: str) -> bool:
@@ -59,22 +81,22 @@ def time_is_valid(time: str) -> bool:
     :param time: Time as a string.
     :return: True if given adheres to format HH:MM, False otherwise.
     """
-    if re.fullmatch("\\d{1,2}:\\d{2}", time):
-        return True
-    return False
+    return parse_time(time) is not None
 
 
-def appointment_is_valid(date: str, time: str) -> bool:
+def appointment_is_valid(date: str, time: str, now: Optional[dt.datetime] = None) -> bool:
     """
     Check whether given appointment date and time are not in the past.
     :param date: Date given as a string.
     :param time: Time given as a string.
+    :param now: Current date and time, defaults to now.
     :return: True if appointment is in the future, False otherwise.
     """
-    if date_is_valid(date=date) and time_is_valid(time=time):
-        appointment = dt.datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
-        return appointment > dt.datetime.now()
-    return False
+    appointment_day = parse_date(date)
+    appointment_time = parse_time(time)
+    if appointment_day is None or appointment_time is None:
+        return False
+    return dt.datetime.combine(appointment_day, appointment_time) > (now or dt.datetime.now())
 
 
 def email_is_valid(email: str) -> bool:
@@ -83,9 +105,7 @@ def email_is_valid(email: str) -> bool:
     :param email: Email address as a string.
     :return: True if email is a valid email address, False otherwise.
     """
-    if not re.fullmatch("[^@]+@[^@]+\\.[^@]+", email):
-        return False
-    return True
+    return EMAIL_PATTERN.fullmatch(email) is not None
 
 
 def birthdate_is_valid(birthdate: str) -> bool:
@@ -94,14 +114,8 @@ def birthdate_is_valid(birthdate: str) -> bool:
     :param birthdate: Birthdate to check as string.
     :return: True if birthdate has expected format lies in the past, False otherwise.
     """
-    if not date_is_valid(birthdate):
-        return False
-    try:
-        birthdate_dt = dt.datetime.strptime(birthdate, "%Y-%m-%d")
-    except ValueError as e:
-        print("Birthdate has wrong format:", e)
-        return False
-    return birthdate_dt < dt.datetime.today()
+    birthdate_dt = parse_date(birthdate)
+    return birthdate_dt is not None and birthdate_dt <= dt.date.today()
 
 
 def tel_is_valid(tel: str) -> bool:
@@ -110,10 +124,7 @@ def tel_is_valid(tel: str) -> bool:
     :param tel: Telephone number as a string.
     :return: True if telephone number is a valid telephone number, False otherwise.
     """
-    tel_no_spaces = ''.join(tel.split())
-    if re.fullmatch("\\+?\\d{11,14}", tel_no_spaces):
-        return True
-    return False
+    return TEL_PATTERN.fullmatch(''.join(tel.split())) is not None
 
 
 def house_number_is_valid(house_number: str) -> bool:
@@ -122,9 +133,7 @@ def house_number_is_valid(house_number: str) -> bool:
     :param house_number: House number as a string.
     :return: True if house number has format [number][optional letter], False otherwise.
     """
-    if re.fullmatch("\\d{1,4}[a-zA-Z]?", house_number):
-        return True
-    return False
+    return HOUSE_NUMBER_PATTERN.fullmatch(house_number) is not None
 
 
 def postcode_is_valid(postcode: str) -> bool:
@@ -133,6 +142,155 @@ def postcode_is_valid(postcode: str) -> bool:
     :param postcode: Postcode as a string.
     :return: True if postcode is a 5-digit number, False otherwise.
     """
-    if re.fullmatch("\\d{5}", postcode):
-        return True
-    return False
+    return POSTCODE_PATTERN.fullmatch(postcode) is not None
+
+
+def test_result_is_valid(result: str) -> bool:
+    """
+    Check if given test result is one of the known test results.
+    :param result: Test result as a string.
+    :return: True if test result is POSITIVE or NEGATIVE, False otherwise.
+    """
+    return result in ('POSITIVE', 'NEGATIVE')
+
+
+def public_id_is_valid(public_id: str) -> bool:
+    """
+    Check if given appointment or result ID has the format of the generated IDs, so malformed IDs from links can be
+    rejected without a database lookup.
+    :param public_id: Appointment or result ID as a string.
+    :return: True if the ID has the expected length and characters, False otherwise.
+    """
+    return PUBLIC_ID_PATTERN.fullmatch(public_id) is not None
+
+
+def appointment_in_future(record: dict, now: dt.datetime) -> bool:
+    """
+    Check whether the appointment of a booking is not in the past.
+    :param record: Booking as a dictionary.
+    :param now: Current date and time.
+    :return: True if the appointment is in the future, False otherwise.
+    """
+    return appointment_is_valid(date=record['appointment_day'], time=record['appointment_time'], now=now)
+
+
+def emails_match(record: dict, now: dt.datetime) -> bool:
+    """
+    Check whether both email addresses of a booking are the same.
+    :param record: Booking as a dictionary.
+    :param now: Current date and time, unused.
+    :return: True if the email addresses are equal, False otherwise.
+    """
+    return record['email1'] == record['email2']
+
+
+# Checks of single values by type name.
+FIELD_CHECKS = {'name': name_is_valid,
+                'date': date_is_valid,
+                'time': time_is_valid,
+                'email': email_is_valid,
+                'birthdate': birthdate_is_valid,
+                'tel': tel_is_valid,
+                'house_number': house_number_is_valid,
+                'post_code': postcode_is_valid,
+                'test_result': test_result_is_valid,
+                'public_id': public_id_is_valid}
+
+# Checks across several fields of a record by name, with the fields they read.
+RECORD_CHECKS = {'future_appointment': (appointment_in_future, ('appointment_day', 'appointment_time')),
+                 'same_email': (emails_match, ('email1', 'email2'))}
+
+
+class Rule(NamedTuple):
+    field: str
+    check: Callable
+    message: str
+    reads: tuple[str, ...] = ()
+
+
+def compile_schema(schema: list[tuple[str, str, str]]) -> list[Rule]:
+    """
+    Compiles a declarative schema into rules, resolving the names of the checks.
+    :param schema: List of tuples of field, name of a field or record check and error message, in the order the
+    errors should be reported.
+    :return: List of rules, value checks have no fields to read, record checks list the fields they read.
+    """
+    rules = []
+    for field, check, message in schema:
+        if check in FIELD_CHECKS:
+            rules.append(Rule(field=field, check=FIELD_CHECKS[check], message=message))
+        elif check in RECORD_CHECKS:
+            record_check, reads = RECORD_CHECKS[check]
+            rules.append(Rule(field=field, check=record_check, message=message, reads=reads))
+        else:
+            raise ValueError(f"Unknown check {check} for field {field}.")
+    return rules
+
+
+BOOKING_SCHEMA = compile_schema([
+    ('appointment_day', 'date', "Please select valid appointment details."),
+    ('appointment_time', 'time', "Please select valid appointment details."),
+    ('appointment_time', 'future_appointment', "Please select valid appointment details."),
+    ('first_name', 'name', "Please provide a valid name."),
+    ('last_name', 'name', "Please provide a valid name."),
+    ('email1', 'email', "Please provide a valid email address."),
+    ('email2', 'same_email', "Email addresses do not match. Please check your inputs."),
+    ('tel', 'tel', "Please provide a valid telephone number with a country code (+49 for Germany)."),
+    ('birthdate', 'birthdate', "Please select a valid birthdate."),
+    ('street', 'name', "Please provide a valid street name."),
+    ('number', 'house_number', "Please provide a valid house number."),
+    ('post_code', 'post_code', "Please provide a valid post code."),
+    ('city', 'name', "Please provide a valid city name."),
+    ('country', 'name', "Please provide a valid country name."),
+])
+
+
+def validate_many(records: Iterable[dict], schema: list[Rule] = BOOKING_SCHEMA,
+                  now: Optional[dt.datetime] = None) -> dict[int, dict[str, str]]:
+    """
+    Validates many records against a compiled schema, collecting all errors of every record. Each distinct value is
+    only checked once per batch, so columns with few distinct values, like appointment days or cities of a group
+    booking, cost one check each. Missing fields and values that are no strings are invalid.
+    :param records: Records as dictionaries, e.g. rows of a file import.
+    :param schema: Compiled schema as returned by compile_schema.
+    :param now: Current date and time for checks against the past, defaults to now.
+    :return: Dictionary mapping the position of every invalid record to a dictionary mapping its invalid fields to
+    the error messages, in schema order. Valid records are not included.
+    """
+    now = now or dt.datetime.now()
+    checked = {rule.check: {} for rule in schema if not rule.reads}
+    report = {}
+    for index, record in enumerate(records):
+        errors = {}
+        for rule in schema:
+            if rule.field in errors:
+                continue
+            if rule.reads:
+                if any(field in errors for field in rule.reads):
+                    continue
+                valid = all(isinstance(record.get(field), str) for field in rule.reads) and rule.check(record, now)
+            else:
+                value = record.get(rule.field)
+                if not isinstance(value, str):
+                    valid = False
+                else:
+                    results = checked[rule.check]
+                    valid = results.get(value)
+                    if valid is None:
+                        valid = results[value] = rule.check(value)
+            if not valid:
+                errors[rule.field] = rule.message
+        if errors:
+            report[index] = errors
+    return report
+
+
+def validate(record: dict, schema: list[Rule] = BOOKING_SCHEMA, now: Optional[dt.datetime] = None) -> dict[str, str]:
+    """
+    Validates a single record against a compiled schema, collecting the errors of all fields.
+    :param record: Record as a dictionary, e.g. the data of the booking form.
+    :param schema: Compiled schema as returned by compile_schema.
+    :param now: Current date and time for checks against the past, defaults to now.
+    :return: Dictionary mapping the invalid fields to error messages in schema order, empty if the record is valid.
+    """
+    return validate_many(records=[record], schema=schema, now=now).get(0, {})
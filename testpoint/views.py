@@ -1,16 +1,32 @@
-import ssl
-
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, Response, render_template, request, flash, redirect, url_for, make_response, session
 from flask_login import current_user
-from .validation import request_is_valid, birthdate_is_valid, email_is_valid
+from .validation import validate, birthdate_is_valid, email_is_valid, public_id_is_valid
 import datetime as dt
-from .storagehandler import add_person, add_appointment, get_person_id, get_person, get_appointment, \
-    get_result_by_app_id, is_admin
-from .notification import send_booking_confirmation
+from typing import Callable, Optional
+from .config import SLOTS_BOOKING_DAYS, WEBSITE_CACHE_MAX_AGE
+from .storagehandler import book_appointment, get_person_id, get_person, get_appointment, get_result_by_app_id
+from .metrics import BOOKINGS
+from .pagecache import APPOINTMENT_MAX_AGE, page_etag, page_is_cacheable, rendered_pages, set_cache_headers
+from .slots import get_available_slots, SLOT_TIMES
 
 views = Blueprint('views', __name__)
 
 
+def cached_page(etag: str, render: Callable[[], str], max_age: int) -> Response:
+    """
+    Serves a public page from the page cache, rendering it only if this worker has not rendered it yet. Answers
+    conditional requests for a page the client already has with 304 Not Modified.
+    :param etag: Entity tag of the page, see pagecache.page_etag.
+    :param render: Function rendering the page.
+    :param max_age: Seconds browsers and proxies may reuse the page without asking again.
+    :return: Response.
+    """
+    body, last_modified = rendered_pages.get(etag=etag) or rendered_pages.put(etag=etag, body=render())
+    response = make_response(body)
+    set_cache_headers(response=response, etag=etag, last_modified=last_modified, max_age=max_age)
+    return response.make_conditional(request)
+
+
 @views.route('/')
 def home():
     """
@@ -19,10 +35,31 @@ def home():
     :return: HTML template for the homepage.
     """
     if current_user.is_authenticated:
-        if is_admin(current_user.username):
+        if current_user.is_admin:
             return redirect(url_for('routes.admin'))
         return redirect(url_for('routes.staff'))
-    return render_template('home.html')
+    if not page_is_cacheable(authenticated=False, session=session):
+        return render_template('home.html')
+    return cached_page(etag=page_etag('home.html'), render=lambda: render_template('home.html'),
+                       max_age=WEBSITE_CACHE_MAX_AGE)
+
+
+def render_appointment_page(user_input: Optional[dict] = None, availability: Optional[dict] = None) -> str:
+    """
+    Renders the appointment booking page offering only slots that still have room.
+    :param user_input: Form data to fill the form with again or None for an empty form.
+    :param availability: Bookable slots as returned by get_available_slots or None to get them.
+    :return: String of HTML template for appointment booking page.
+    """
+    if availability is None:
+        availability = get_available_slots()
+    offered = {slot_time for slot_times in availability.values() for slot_time in slot_times}
+    return render_template('appointment.html',
+                           user_input=user_input,
+                           slots=[slot for slot in SLOT_TIMES if f"{slot.hour}:{slot.minute:02d}" in offered],
+                           availability=availability,
+                           today=dt.date.today(),
+                           max_days=dt.date.today() + dt.timedelta(days=SLOTS_BOOKING_DAYS))
 
 
 @views.route('/appointment/', methods=['GET', 'POST'])
@@ -33,45 +70,34 @@ def appointment() -> any:
     """
     if request.method == 'POST':
         user_input = request.form.to_dict()
-        try:
-            request_is_valid(request=user_input)
-        except ValueError as e:
-            flash(f"{e}", category='error')
-            return render_template('appointment.html',
-                                   user_input=user_input,
-                                   slots=[dt.time(hour=h, minute=m) for h in range(8, 23) for m in [0, 15, 30, 45]],
-                                   today=dt.date.today(),
-                                   max_days=dt.date.today() + dt.timedelta(days=14))
-
-        add_person(person=user_input)
+        errors = validate(record=user_input)
+        if errors:
+            BOOKINGS.labels(outcome='invalid').inc()
+            for message in dict.fromkeys(errors.values()):
+                flash(message, category='error')
+            return render_appointment_page(user_input=user_input)
 
         try:
-            app_added = add_appointment(email=user_input['email1'],
-                                        appointment_day=user_input['appointment_day'],
-                                        appointment_time=user_input['appointment_time'])
-        except TypeError as e:
+            appointment_id = book_appointment(person=user_input)
+        except RuntimeError as e:
+            BOOKINGS.labels(outcome='full').inc()
             flash(f"{e}", category='error')
-            return redirect(url_for('views.appointment'))
-        if app_added:
-            try:
-                send_booking_confirmation(email=user_input['email1'],
-                                          first_name=user_input['first_name'],
-                                          appointment_day=user_input['appointment_day'],
-                                          appointment_time=user_input['appointment_time'])
-                flash('Appointment booked successfully! Please check your inbox for the booking confirmation.',
-                      category='success')
-            except ssl.CertificateError:
-                flash('Appointment booked successfully but mail server could not send the booking confirmation.',
-                      category='error')
+            return render_appointment_page(user_input=user_input)
+        BOOKINGS.labels(outcome='booked' if appointment_id else 'duplicate').inc()
+        if appointment_id:
+            flash('Appointment booked successfully! The booking confirmation will arrive in your inbox shortly.',
+                  category='success')
         else:
             flash('Appointment is already booked! Please check your inbox for the booking confirmation.',
                   category='error')
         return redirect(url_for('views.home'))
 
-    return render_template('appointment.html',
-                           slots=[dt.time(hour=h, minute=m) for h in range(8, 23) for m in [0, 15, 30, 45]],
-                           today=dt.date.today(),
-                           max_days=dt.date.today()+dt.timedelta(days=14))
+    availability = get_available_slots()
+    if not page_is_cacheable(authenticated=current_user.is_authenticated, session=session):
+        return render_appointment_page(availability=availability)
+    return cached_page(etag=page_etag('appointment.html', dt.date.today().isoformat(), availability),
+                       render=lambda: render_appointment_page(availability=availability),
+                       max_age=APPOINTMENT_MAX_AGE)
 
 
 @views.route('/results/<app_id>/', methods=['GET', 'POST'])
@@ -81,7 +107,7 @@ def results(app_id: str) -> str:
     :param app_id: Appointment ID to get the corresponding result of.
     :return: HTML templates for entering credentials,
     """
-    if not get_appointment(appointment_id=app_id):
+    if not public_id_is_valid(app_id) or not get_appointment(appointment_id=app_id):
         return render_template('sorry.html')
 
     if request.method == 'POST':